@@ -0,0 +1,115 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set
+from config import logger, CONVERSACIONES_CONCURRENTES, INGESTA_MODO
+from main import OHIBot, ESPERA_CON_CONVERSACIONES
+from metrics import registro
+from send_queue import PRIORIDAD_LECTURA
+from whatsapp import WhatsAppDriver
+
+
+class ActorNavegador:
+    """Acceso asíncrono al navegador a través del despachador.
+
+    El despachador sigue siendo el único hilo que toca WebDriver; aquí solo se
+    espera su Future sin bloquear el bucle de eventos.
+    """
+
+    def __init__(self, transporte):
+        self.transporte = transporte
+
+    async def ejecutar(self, funcion: Callable[[WhatsAppDriver], Any], prioridad: int = PRIORIDAD_LECTURA) -> Any:
+        return await asyncio.wrap_future(self.transporte.ejecutar(funcion, prioridad))
+
+
+class OHIBotAsync:
+    """Núcleo asyncio de OHIBot: conversaciones de distintos números en paralelo.
+
+    Cada mensaje se procesa con ``OHIBot.procesar_mensaje`` en un pool de hilos,
+    así que una consulta lenta a Supabase solo retrasa la conversación que la
+    espera. Los mensajes de un mismo número se encadenan para conservar su
+    orden. El email de cancelación ya sale por la cola de correo; el
+    navegador se lee a través de ``ActorNavegador`` y las respuestas salen por
+    el transporte del bot, como en el bucle síncrono.
+    """
+
+    def __init__(self, bot: Optional[OHIBot] = None, concurrencia: int = CONVERSACIONES_CONCURRENTES):
+        # Aquí el orden por número lo garantiza despachar, no el pool de hilos del bucle síncrono
+        self.bot = bot or OHIBot(trabajadores=1)
+        if self.bot.conversaciones is not None:
+            raise ValueError("El núcleo asyncio necesita un OHIBot con trabajadores=1")
+        self.actor = ActorNavegador(self.bot.transporte)
+        self._executor = ThreadPoolExecutor(max_workers=concurrencia, thread_name_prefix="conversacion")
+        self._ultimas: Dict[str, "asyncio.Future"] = {}
+        self._tareas: Set["asyncio.Future"] = set()
+        registro.medidor("ohibot_conversaciones_activas", "Números con mensajes en proceso o en espera en el núcleo asyncio",
+                         funcion=lambda: len(self._ultimas))
+
+    def despachar(self, numero: str, mensaje: str, id_mensaje: Optional[str] = None) -> "asyncio.Future":
+        """Programa el mensaje detrás de los pendientes del mismo número."""
+        anterior = self._ultimas.get(numero)
+        tarea = asyncio.ensure_future(self._procesar_en_orden(anterior, numero, mensaje, id_mensaje))
+        self._ultimas[numero] = tarea
+        self._tareas.add(tarea)
+
+        def terminar(t):
+            self._tareas.discard(t)
+            if self._ultimas.get(numero) is t:
+                del self._ultimas[numero]
+
+        tarea.add_done_callback(terminar)
+        return tarea
+
+    async def _procesar_en_orden(self, anterior, numero: str, mensaje: str, id_mensaje: Optional[str]) -> None:
+        if anterior is not None:
+            await asyncio.wait([anterior])
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._executor, self.bot.procesar_mensaje, numero, mensaje, id_mensaje)
+        except Exception as e:
+            logger.error(f"Error procesando mensaje de {numero}: {e}", exc_info=True)
+
+    async def esperar_pendientes(self) -> None:
+        """Espera a que terminen todos los mensajes ya despachados."""
+        while self._tareas:
+            await asyncio.wait(list(self._tareas))
+
+    async def _leer_bandeja(self) -> Optional[List]:
+        if INGESTA_MODO == "observer":
+            # Con conversaciones en curso sus respuestas esperan detrás de esta espera
+            timeout = ESPERA_CON_CONVERSACIONES if self._ultimas else 5
+            return await self.actor.ejecutar(lambda driver: self.bot.escanear_bandeja(driver, timeout))
+        return await self.actor.ejecutar(self.bot.escanear_bandeja)
+
+    async def bucle_bandeja(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            lote = await self._leer_bandeja()
+            while self.bot.bandeja.total_pendientes:
+                self.despachar(*self.bot.bandeja.siguiente())
+            if time.monotonic() - self.bot._ultimo_desalojo > 60:
+                await loop.run_in_executor(self._executor, self.bot.desalojar_sesiones_inactivas)
+            if lote is None or INGESTA_MODO != "observer":
+                await asyncio.sleep(5)
+
+    async def iniciar(self) -> None:
+        """Arranca los servicios del bot y atiende la bandeja hasta que se cancele."""
+        self.bot.arrancar_servicios()
+        logger.info("OHIBot (asyncio) iniciado. Esperando mensajes...")
+        try:
+            await self.bucle_bandeja()
+        finally:
+            await self.esperar_pendientes()
+            self.cerrar()
+            self.bot.detener_servicios()
+
+    def cerrar(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(OHIBotAsync().iniciar())
+    except KeyboardInterrupt:
+        logger.info("Deteniendo OHIBot...")
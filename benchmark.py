@@ -0,0 +1,452 @@
+"""Micro-benchmarks de OHIBot.
+
+Uso:
+    python benchmark.py normalizador [--iteraciones 200]
+    python benchmark.py motor [--mensajes 200000]
+    python benchmark.py conversaciones [--pacientes 5000] [--minimo 0] [--latencia-db-ms 0] [--asincrono]
+    python benchmark.py extremo [--pacientes 20] [--ingesta observer] [--retardo-envio-ms 0] [--timeout 30]
+
+``extremo`` necesita Edge y su driver: el bot real maneja un Edge headless
+contra la imitación de fake_whatsapp.py.
+"""
+import argparse
+import asyncio
+import gc
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+from engine import MotorConversacion
+from normalizer import normalizar_mensaje
+
+
+def _normalizar_referencia(texto: str) -> str:
+    """Copia de la implementación original de ``OHIBot.normalizar_mensaje``."""
+    if not texto:
+        return ""
+
+    replacements = {
+        'á': 'a', 'é': 'e', 'í': 'i', 'ó': 'o', 'ú': 'u', 'ü': 'u',
+        'Á': 'A', 'É': 'E', 'Í': 'I', 'Ó': 'O', 'Ú': 'U', 'Ü': 'U',
+        'ñ': 'n', 'Ñ': 'N'
+    }
+    for old, new in replacements.items():
+        texto = texto.replace(old, new)
+
+    texto_sin_emojis = texto.encode('ascii', 'ignore').decode('ascii')
+    texto_limpio = re.sub(r'[^\w\s.,;:?¿!¡]', '', texto_sin_emojis)
+    texto_limpio = re.sub(r'\s+', ' ', texto_limpio)
+    texto_limpio = re.sub(r'(\d+)\.\s*', r'\1. ', texto_limpio)
+    texto_limpio = re.sub(r':\s*', ': ', texto_limpio)
+    texto_normalizado = texto_limpio.lower().strip()
+
+    if "escribiendo" in texto_normalizado:
+        return "escribiendo"
+    return texto_normalizado
+
+
+MENSAJES_FRECUENTES = [
+    "Hola", "hola", "Cita", "cita", "CC", "ti", "1234567890", "cancelar cita",
+    "1", "2", "si", "sí", "no", "terminar", "escribiendo...", "Escribiendo…",
+    "👋 ¡Hola! Soy *BOHI* 🤖✨, tu asistente virtual de citas médicas.",
+    "🔢 Ahora, por favor escribe tu *número de documento* (sin puntos ni espacios):",
+    "❌ El tipo de documento que ingresaste no es válido. Por favor intenta de nuevo.",
+    "📅 *Estas son tus citas programadas:*👨‍⚕️ *Médico:* Dr. Pérez🏥 *Especialidad:* Cardiología",
+    "⚠️ ¿Deseas cancelar una cita? Escribe *cancelar cita*.",
+    "1.medico  general\t2.   odontología", "fecha:20250417 hora :  10:30",
+    "Ñandú ÜBER straße façade à la carte ﬁ ２０２５ ²",
+]
+
+_ALFABETO = "abcxyzABCXYZ0123456789 \t\n.,;:?¿!¡*-_()áéíóúüñÁÉÍÓÚÜÑàçßøﬁ２²😀👋🏥✅❌⚠️"
+
+
+def corpus_normalizador(tamano: int = 2000, semilla: int = 7) -> List[str]:
+    """Mensajes frecuentes más texto aleatorio con tildes, emojis y puntuación."""
+    aleatorio = random.Random(semilla)
+    generados = [
+        "".join(aleatorio.choice(_ALFABETO) for _ in range(aleatorio.randint(0, 80)))
+        for _ in range(tamano)
+    ]
+    return MENSAJES_FRECUENTES + generados
+
+
+def _medir(funcion: Callable[[str], str], corpus: List[str], iteraciones: int) -> float:
+    inicio = time.perf_counter()
+    for _ in range(iteraciones):
+        for texto in corpus:
+            funcion(texto)
+    return len(corpus) * iteraciones / (time.perf_counter() - inicio)
+
+
+def benchmark_normalizador(iteraciones: int) -> int:
+    corpus = corpus_normalizador()
+    diferencias = [t for t in corpus if _normalizar_referencia(t) != normalizar_mensaje.__wrapped__(t)]
+    if diferencias:
+        print(f"❌ {len(diferencias)} mensajes difieren de la implementación original, p. ej. {diferencias[0]!r}")
+        return 1
+    print(f"✅ Salida idéntica a la implementación original en {len(corpus)} mensajes")
+
+    # Tráfico realista: pocas entradas distintas que se repiten mucho
+    trafico = MENSAJES_FRECUENTES * 100
+    normalizar_mensaje.cache_clear()
+    resultados = [
+        ("referencia (corpus)", _medir(_normalizar_referencia, corpus, iteraciones)),
+        ("sin memo (corpus)", _medir(normalizar_mensaje.__wrapped__, corpus, iteraciones)),
+        ("referencia (tráfico)", _medir(_normalizar_referencia, trafico, iteraciones)),
+        ("con memo (tráfico)", _medir(normalizar_mensaje, trafico, iteraciones)),
+    ]
+    for nombre, por_segundo in resultados:
+        print(f"{nombre:<22} {por_segundo:>14,.0f} mensajes/s")
+    return 0
+
+
+class _SesionSintetica:
+    __slots__ = ("estado", "ultimo_mensaje")
+
+    def __init__(self):
+        self.estado = 0
+        self.ultimo_mensaje = None
+
+
+# Mismo recorrido que un paciente real: hola → cita → tipo → documento → cancelar → selección → si
+FLUJO_CONVERSACION = ["hola", "cita", "cc", "123456", "cancelar cita", "1", "si"]
+
+
+def _motor_sintetico(flujos_extra: int) -> MotorConversacion:
+    """Motor con la forma de la tabla de OHIBot más ``flujos_extra`` estados de relleno."""
+    motor = MotorConversacion()
+    motor.agregar_guardia(lambda numero, sesion, mensaje: mensaje == "escribiendo")
+    motor.agregar_guardia(lambda numero, sesion, mensaje: mensaje == sesion.ultimo_mensaje)
+    responder = lambda numero, sesion, mensaje: mensaje
+    motor.registrar(0, responder, 0, entrada="hola")
+    motor.registrar(0, responder, 1, entrada="cita")
+    motor.registrar(1, responder, 2, entrada=("cc", "ti", "ce", "pa"))
+    motor.registrar(1, responder)
+    motor.registrar(2, responder, 3, condicion=str.isdigit)
+    motor.registrar(2, responder)
+    motor.registrar(3, responder, 4, entrada="cancelar cita")
+    motor.registrar(4, responder, 5, condicion=str.isdigit)
+    motor.registrar(5, responder, 0, entrada=("si", "no"))
+    for estado in range(100, 100 + flujos_extra):
+        motor.registrar(estado, responder, 0, entrada=("uno", "dos", "tres"))
+        motor.registrar(estado, responder, 0, condicion=str.isdigit)
+        motor.registrar(estado, responder)
+    return motor
+
+
+def benchmark_motor(mensajes: int) -> int:
+    for flujos_extra in (0, 1000):
+        motor = _motor_sintetico(flujos_extra)
+        sesiones = [_SesionSintetica() for _ in range(1000)]
+        inicio = time.perf_counter()
+        for i in range(mensajes):
+            sesion = sesiones[i % len(sesiones)]
+            mensaje = FLUJO_CONVERSACION[(i // len(sesiones)) % len(FLUJO_CONVERSACION)]
+            sesion.ultimo_mensaje = motor.ejecutar("+570000000", sesion, mensaje)
+        duracion = time.perf_counter() - inicio
+        print(f"motor con {flujos_extra:>4} flujos extra {mensajes / duracion:>14,.0f} mensajes/s")
+    return 0
+
+
+def _percentil(ordenados: List[float], q: float) -> float:
+    return ordenados[min(len(ordenados) - 1, int(q * len(ordenados)))] if ordenados else 0.0
+
+
+def _flujo_paciente(i: int) -> List[str]:
+    """hola → cita → tipo → documento → cancelar → selección → si/no (alternando)."""
+    return ["hola", "cita", "cc", str(1000000 + i), "cancelar cita", "1", "si" if i % 2 == 0 else "no"]
+
+
+async def _conversaciones_asincronas(bot, flujos, duraciones: List[float]) -> None:
+    from async_bot import OHIBotAsync
+
+    nucleo = OHIBotAsync(bot)
+    for paso in range(len(flujos[0][1])):
+        for numero, flujo in flujos:
+            t0 = time.perf_counter()
+            tarea = nucleo.despachar(numero, flujo[paso], f"false_{numero}_{paso}")
+            tarea.add_done_callback(lambda _, t0=t0: duraciones.append(time.perf_counter() - t0))
+    await nucleo.esperar_pendientes()
+    nucleo.cerrar()
+
+
+def _conversaciones_en_pool(bot, flujos, duraciones: List[float], trabajadores: int) -> List[dict]:
+    from workers import PoolConversaciones
+
+    def procesar(numero: str, mensaje: str, id_mensaje: str) -> None:
+        t0 = time.perf_counter()
+        bot.procesar_mensaje(numero, mensaje, id_mensaje)
+        duraciones.append(time.perf_counter() - t0)
+
+    pool = PoolConversaciones(procesar, trabajadores, nombre="benchmark")
+    pool.iniciar()
+    for paso in range(len(flujos[0][1])):
+        for numero, flujo in flujos:
+            pool.enviar(numero, flujo[paso], f"false_{numero}_{paso}")
+    pool.esperar()
+    estadisticas = pool.estadisticas()
+    pool.detener()
+    return estadisticas
+
+
+def _citas_en_memoria(pacientes: int, latencia_db: float = 0.0):
+    """Usa el backend de citas en memoria con dos citas confirmadas por paciente."""
+    os.environ.setdefault("CITAS_BACKEND", "memoria")
+    os.environ["SESSION_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="ohibot-bench-"), "sesiones.db")
+
+    import database
+    from citas_memoria import ClienteCitasMemoria
+
+    cliente = ClienteCitasMemoria()
+    database.usar_cliente_citas(cliente)
+    database.notificar_cancelacion = lambda cita: None  # sin SMTP
+    fecha = (datetime.now() + timedelta(days=3)).strftime("%Y-%m-%d")
+    cliente.table("Citas").insert([
+        {
+            "tipoDocumento": "CC", "documento": str(1000000 + i), "nombrePaciente": f"Paciente {i}",
+            "especialidad": especialidad, "nombreMedico": "Dr. Pérez", "fechaCita": fecha,
+            "telefonoPaciente": f"300{i:07d}", "confirmacionCita": "si",
+        }
+        for i in range(pacientes)
+        for especialidad in ("Medicina general", "Odontología")
+    ]).execute()
+    cliente.latencia = latencia_db
+    return cliente
+
+
+def benchmark_conversaciones(
+    pacientes: int, minimo: float, latencia_db: float = 0.0, asincrono: bool = False, trabajadores: int = 0
+) -> int:
+    """Conversaciones completas por ``OHIBot.procesar_mensaje`` con citas en memoria y sin navegador.
+
+    Con ``asincrono`` los mensajes pasan por el núcleo de async_bot.py y la
+    latencia de cada mensaje incluye su espera detrás de los del mismo número.
+    Con ``trabajadores`` pasan por ``PoolConversaciones`` (workers.py).
+    """
+    logging.disable(logging.WARNING)
+    cliente = _citas_en_memoria(pacientes + 1000, latencia_db)
+
+    import main as bot_main
+    from send_queue import TransporteNulo
+
+    transporte = TransporteNulo()
+    # El reparto de mensajes lo hace el propio benchmark
+    bot = bot_main.OHIBot(transporte=transporte, trabajadores=1)
+
+    # Los pacientes avanzan intercalados, un paso de todos antes del siguiente
+    flujos = [(f"+57300{i:07d}", _flujo_paciente(i)) for i in range(pacientes)]
+    duraciones: List[float] = []
+    por_trabajador: List[dict] = []
+    inicio = time.perf_counter()
+    if asincrono:
+        asyncio.run(_conversaciones_asincronas(bot, flujos, duraciones))
+    elif trabajadores:
+        por_trabajador = _conversaciones_en_pool(bot, flujos, duraciones, trabajadores)
+    else:
+        for paso in range(len(flujos[0][1])):
+            for numero, flujo in flujos:
+                t0 = time.perf_counter()
+                bot.procesar_mensaje(numero, flujo[paso], f"false_{numero}_{paso}")
+                duraciones.append(time.perf_counter() - t0)
+    total = time.perf_counter() - inicio
+    respuestas = transporte.enviados
+
+    canceladas = len(cliente.table("Citas").select("id").eq("confirmacionCita", "no").execute().data)
+    esperadas = (pacientes + 1) // 2
+    finales = {bot.estado_usuarios.get(numero).estado for numero, _ in flujos}
+    if canceladas != esperadas or finales != {bot_main.EstadoUsuario.INICIO}:
+        print(f"❌ Flujo incorrecto: {canceladas} citas canceladas (esperadas {esperadas}), estados finales {finales}")
+        return 1
+
+    # Memoria de las sesiones residentes: pacientes nuevos hasta tener citas en sesión
+    cliente.latencia = 0.0
+    muestras = min(pacientes, 1000)
+    gc.collect()
+    tracemalloc.start()
+    antes = tracemalloc.get_traced_memory()[0]
+    for i in range(pacientes, pacientes + muestras):
+        numero = f"+57300{i:07d}"
+        for paso, mensaje in enumerate(_flujo_paciente(i)[:4]):
+            bot.procesar_mensaje(numero, mensaje, f"false_{numero}_{paso}")
+    gc.collect()
+    por_sesion = (tracemalloc.get_traced_memory()[0] - antes) / muestras
+    tracemalloc.stop()
+    bot.estado_usuarios.cerrar()
+
+    duraciones.sort()
+    por_segundo = len(duraciones) / total
+    print(f"{pacientes} conversaciones, {len(duraciones)} mensajes en {total:.2f} s ({respuestas} respuestas)")
+    print(f"{'mensajes/s':<16} {por_segundo:>12,.0f}")
+    print(f"{'conversaciones/s':<16} {pacientes / total:>12,.1f}")
+    print(f"{'p50':<16} {_percentil(duraciones, 0.5) * 1000:>12.3f} ms")
+    print(f"{'p99':<16} {_percentil(duraciones, 0.99) * 1000:>12.3f} ms")
+    print(f"{'máximo':<16} {duraciones[-1] * 1000:>12.3f} ms")
+    print(f"{'memoria/sesión':<16} {por_sesion / 1024:>12.2f} KiB")
+    for estado in por_trabajador:
+        print(f"trabajador {estado['trabajador']:<5} {estado['procesados']:>12,} mensajes  "
+              f"utilización {estado['utilizacion']:.0%}")
+    if minimo and por_segundo < minimo:
+        print(f"❌ {por_segundo:,.0f} mensajes/s está por debajo del mínimo de {minimo:,.0f}")
+        return 1
+    return 0
+
+
+def _esperar_respuestas(falso, pendientes: Dict[str, float], leidos: int, latencias: List[float], timeout: float) -> int:
+    """Empareja la primera respuesta a cada número con su mensaje inyectado.
+
+    Termina cuando todos tienen respuesta y no sale nada más durante medio
+    segundo (un mensaje puede tener varias respuestas), o tras ``timeout``.
+    Devuelve cuántos enviados de la imitación van leídos.
+    """
+    limite = time.monotonic() + timeout
+    ultimo_envio = time.monotonic()
+    while time.monotonic() < limite:
+        nuevos = falso.enviados(leidos)
+        if nuevos:
+            leidos += len(nuevos)
+            ultimo_envio = time.monotonic()
+            for enviado in nuevos:
+                inyectado = pendientes.pop(enviado["numero"], None)
+                if inyectado is not None:
+                    latencias.append(enviado["instante"] - inyectado)
+        elif not pendientes and time.monotonic() - ultimo_envio > 0.5:
+            break
+        time.sleep(0.02)
+    return leidos
+
+
+def benchmark_extremo(
+    pacientes: int, ingesta: str = "observer", retardo_envio: float = 0.0, timeout: float = 30, minimo: float = 0
+) -> int:
+    """Conversaciones completas de punta a punta: OHIBot y Edge headless contra fake_whatsapp.py.
+
+    Cada paso del flujo se inyecta a todos los pacientes a la vez y se espera
+    a sus respuestas. La latencia va de la inyección del mensaje a la primera
+    respuesta que la imitación recibe para ese número.
+    """
+    from fake_whatsapp import WhatsAppFalso
+
+    falso = WhatsAppFalso(retardo_envio=retardo_envio).iniciar()
+    url = falso.url
+    # Antes de importar main: el driver global y el despachador leen estas variables al importarse
+    os.environ.update({
+        "WHATSAPP_URL": url,
+        "WHATSAPP_PERFIL": "servidor",
+        "WHATSAPP_SESION_DIR": os.path.join(tempfile.mkdtemp(prefix="ohibot-e2e-"), "perfil"),
+        "INGESTA_MODO": ingesta,
+        "METRICAS_PUERTO": "0",
+    })
+    logging.disable(logging.WARNING)
+    cliente = _citas_en_memoria(pacientes)
+
+    import main as bot_main
+
+    # Sin arrancar_servicios: el planificador enviaría recordatorios de las citas de prueba
+    bot = bot_main.OHIBot()
+    bot.transporte.iniciar()
+    if bot.conversaciones:
+        bot.conversaciones.iniciar()
+    detener = threading.Event()
+    hilo = None
+    try:
+        inicio = time.perf_counter()
+        if bot.transporte.ejecutar(lambda driver: driver.iniciar_driver()).result() is None:
+            print(f"❌ No se pudo abrir Edge contra la imitación en {url}")
+            return 1
+        arranque = time.perf_counter() - inicio
+
+        def atender() -> None:
+            while not detener.is_set():
+                bot.atender_bandeja()
+
+        hilo = threading.Thread(target=atender, name="bandeja", daemon=True)
+        hilo.start()
+
+        flujos = [(f"+57300{i:07d}", _flujo_paciente(i)) for i in range(pacientes)]
+        latencias: List[float] = []
+        leidos = sin_respuesta = 0
+        inicio = time.perf_counter()
+        for paso in range(len(flujos[0][1])):
+            pendientes: Dict[str, float] = {}
+            for numero, flujo in flujos:
+                pendientes[numero] = time.time()
+                falso.inyectar(numero, flujo[paso])
+            leidos = _esperar_respuestas(falso, pendientes, leidos, latencias, timeout)
+            sin_respuesta += len(pendientes)
+        total = time.perf_counter() - inicio
+    finally:
+        detener.set()
+        if hilo:
+            hilo.join(10)
+        bot.detener_servicios()
+        falso.detener()
+
+    mensajes = pacientes * len(flujos[0][1])
+    canceladas = len(cliente.table("Citas").select("id").eq("confirmacionCita", "no").execute().data)
+    esperadas = (pacientes + 1) // 2
+    latencias.sort()
+    por_segundo = mensajes / total
+    print(f"{pacientes} conversaciones, {mensajes} mensajes en {total:.2f} s ({leidos} respuestas, ingesta {ingesta})")
+    print(f"{'arranque Edge':<16} {arranque:>12.2f} s")
+    print(f"{'mensajes/s':<16} {por_segundo:>12,.1f}")
+    print(f"{'p50':<16} {_percentil(latencias, 0.5) * 1000:>12.0f} ms")
+    print(f"{'p99':<16} {_percentil(latencias, 0.99) * 1000:>12.0f} ms")
+    print(f"{'máximo':<16} {(latencias[-1] if latencias else 0) * 1000:>12.0f} ms")
+    if sin_respuesta or canceladas != esperadas:
+        print(f"❌ {sin_respuesta} mensajes sin respuesta en {timeout:.0f} s; "
+              f"{canceladas} citas canceladas (esperadas {esperadas})")
+        return 1
+    if minimo and por_segundo < minimo:
+        print(f"❌ {por_segundo:,.1f} mensajes/s está por debajo del mínimo de {minimo:,.1f}")
+        return 1
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    normalizador = subparsers.add_parser("normalizador", help="Throughput y equivalencia del normalizador")
+    normalizador.add_argument("--iteraciones", type=int, default=200)
+
+    motor = subparsers.add_parser("motor", help="Mensajes/s a través del motor de conversación")
+    motor.add_argument("--mensajes", type=int, default=200000)
+
+    conversaciones = subparsers.add_parser("conversaciones", help="Flujo completo de OHIBot con citas en memoria")
+    conversaciones.add_argument("--pacientes", type=int, default=5000)
+    conversaciones.add_argument("--minimo", type=float, default=0, help="Falla si no se alcanzan estos mensajes/s")
+    conversaciones.add_argument("--latencia-db-ms", type=float, default=0, help="Latencia simulada por consulta a Citas")
+    conversaciones.add_argument("--asincrono", action="store_true", help="Procesa con el núcleo asyncio (async_bot.py)")
+    conversaciones.add_argument("--trabajadores", type=int, default=0, help="Procesa con N hilos por paciente (workers.py)")
+
+    extremo = subparsers.add_parser("extremo", help="OHIBot y Edge headless contra la imitación de WhatsApp Web")
+    extremo.add_argument("--pacientes", type=int, default=20)
+    extremo.add_argument("--ingesta", choices=("observer", "polling"), default="observer")
+    extremo.add_argument("--retardo-envio-ms", type=float, default=0, help="Retardo simulado de cada envío en la imitación")
+    extremo.add_argument("--timeout", type=float, default=30, help="Espera máxima (s) de las respuestas de cada paso")
+    extremo.add_argument("--minimo", type=float, default=0, help="Falla si no se alcanzan estos mensajes/s")
+
+    args = parser.parse_args(argv)
+    if args.benchmark == "normalizador":
+        return benchmark_normalizador(args.iteraciones)
+    if args.benchmark == "motor":
+        return benchmark_motor(args.mensajes)
+    if args.benchmark == "conversaciones":
+        return benchmark_conversaciones(
+            args.pacientes, args.minimo, args.latencia_db_ms / 1000, args.asincrono, args.trabajadores
+        )
+    if args.benchmark == "extremo":
+        return benchmark_extremo(args.pacientes, args.ingesta, args.retardo_envio_ms / 1000, args.timeout, args.minimo)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
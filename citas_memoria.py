@@ -0,0 +1,155 @@
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
+
+
+class RespuestaMemoria:
+    def __init__(self, data: List[Dict[str, Any]]):
+        self.data = data
+
+
+class ConsultaMemoria:
+    """Subconjunto del constructor de consultas de Supabase que usa database.py.
+
+    Admite ``select``, ``insert``, ``update``, los filtros ``eq``/``gt``/``gte``,
+    ``order`` y ``range``. Los filtros ``eq`` sobre columnas indexadas no
+    recorren la tabla completa.
+    """
+
+    def __init__(self, tabla: "TablaMemoria", latencia: float = 0.0):
+        self._tabla = tabla
+        self._latencia = latencia
+        self._columnas: Optional[List[str]] = None
+        self._filtros: List[Callable[[Dict[str, Any]], bool]] = []
+        self._igualdades: Dict[str, Any] = {}
+        self._orden: Optional[str] = None
+        self._descendente = False
+        self._rango: Optional[tuple] = None
+        self._cambios: Optional[Dict[str, Any]] = None
+        self._nuevas: Optional[List[Dict[str, Any]]] = None
+
+    def select(self, columnas: str = "*") -> "ConsultaMemoria":
+        self._columnas = None if columnas.strip() == "*" else [c.strip() for c in columnas.split(",")]
+        return self
+
+    def insert(self, filas: Union[Dict[str, Any], List[Dict[str, Any]]]) -> "ConsultaMemoria":
+        self._nuevas = [filas] if isinstance(filas, dict) else list(filas)
+        return self
+
+    def update(self, cambios: Dict[str, Any]) -> "ConsultaMemoria":
+        self._cambios = dict(cambios)
+        return self
+
+    def eq(self, columna: str, valor: Any) -> "ConsultaMemoria":
+        self._igualdades[columna] = valor
+        self._filtros.append(lambda fila: fila.get(columna) == valor)
+        return self
+
+    def gt(self, columna: str, valor: Any) -> "ConsultaMemoria":
+        self._filtros.append(lambda fila: fila.get(columna) is not None and fila[columna] > valor)
+        return self
+
+    def gte(self, columna: str, valor: Any) -> "ConsultaMemoria":
+        self._filtros.append(lambda fila: fila.get(columna) is not None and fila[columna] >= valor)
+        return self
+
+    def order(self, columna: str, desc: bool = False) -> "ConsultaMemoria":
+        self._orden = columna
+        self._descendente = desc
+        return self
+
+    def range(self, inicio: int, fin: int) -> "ConsultaMemoria":
+        self._rango = (inicio, fin)
+        return self
+
+    def execute(self) -> RespuestaMemoria:
+        if self._latencia:
+            time.sleep(self._latencia)
+        if self._nuevas is not None:
+            return RespuestaMemoria(self._tabla.insertar(self._nuevas))
+        filas = self._tabla.filtrar(self._igualdades, self._filtros, modificar=self._cambios)
+        if self._orden is not None:
+            filas.sort(key=lambda fila: fila.get(self._orden), reverse=self._descendente)
+        if self._rango is not None:
+            filas = filas[self._rango[0]:self._rango[1] + 1]
+        if self._columnas is not None:
+            filas = [{c: fila.get(c) for c in self._columnas} for fila in filas]
+        return RespuestaMemoria(filas)
+
+
+class TablaMemoria:
+    """Filas de una tabla con índices por igualdad en ``indices``."""
+
+    def __init__(self, indices: Iterable[str] = ("id",)):
+        self._filas: Dict[int, Dict[str, Any]] = {}
+        self._indices: Dict[str, Dict[Any, Dict[int, Dict[str, Any]]]] = {c: defaultdict(dict) for c in indices}
+        self._siguiente_id = 1
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._filas)
+
+    def insertar(self, filas: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        insertadas = []
+        with self._lock:
+            for fila in filas:
+                fila = dict(fila)
+                if fila.get("id") is None:
+                    fila["id"] = self._siguiente_id
+                self._siguiente_id = max(self._siguiente_id, fila["id"] + 1)
+                self._filas[fila["id"]] = fila
+                for columna, indice in self._indices.items():
+                    indice[fila.get(columna)][fila["id"]] = fila
+                insertadas.append(dict(fila))
+        return insertadas
+
+    def filtrar(
+        self,
+        igualdades: Dict[str, Any],
+        filtros: List[Callable[[Dict[str, Any]], bool]],
+        modificar: Optional[Dict[str, Any]] = None,
+    ) -> List[Dict[str, Any]]:
+        """Filas que cumplen todos los filtros (copias), aplicando ``modificar`` si se indica."""
+        with self._lock:
+            indexadas = [columna for columna in igualdades if columna in self._indices]
+            if indexadas:
+                candidatas = list(self._indices[indexadas[0]].get(igualdades[indexadas[0]], {}).values())
+            else:
+                candidatas = list(self._filas.values())
+            resultado = []
+            for fila in candidatas:
+                if not all(filtro(fila) for filtro in filtros):
+                    continue
+                if modificar:
+                    self._modificar(fila, modificar)
+                resultado.append(dict(fila))
+            return resultado
+
+    def _modificar(self, fila: Dict[str, Any], cambios: Dict[str, Any]) -> None:
+        for columna, valor in cambios.items():
+            if columna in self._indices:
+                self._indices[columna][fila.get(columna)].pop(fila["id"], None)
+                self._indices[columna][valor][fila["id"]] = fila
+            fila[columna] = valor
+
+
+class ClienteCitasMemoria:
+    """Sustituto en memoria del cliente de Supabase para pruebas y benchmarks.
+
+    ``latencia`` (segundos) simula el viaje de red en cada ``execute``.
+    """
+
+    INDICES = {"Citas": ("id", "documento", "fechaCita")}
+
+    def __init__(self, latencia: float = 0.0):
+        self.latencia = latencia
+        self._tablas: Dict[str, TablaMemoria] = {}
+        self._lock = threading.Lock()
+
+    def table(self, nombre: str) -> ConsultaMemoria:
+        with self._lock:
+            tabla = self._tablas.get(nombre)
+            if tabla is None:
+                tabla = self._tablas[nombre] = TablaMemoria(self.INDICES.get(nombre, ("id",)))
+        return ConsultaMemoria(tabla, self.latencia)
@@ -1,5 +1,4 @@
 import os
-from supabase import create_client
 from dotenv import load_dotenv
 import logging
 from urllib.parse import urlparse
@@ -19,16 +18,73 @@ def validate_supabase_url(url: str) -> bool:
     except Exception:
         return False
 
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "estado_usuarios.db")
+# Minutos sin interacción tras los cuales una sesión sale de memoria (sigue en disco)
+SESION_TTL_MIN = int(os.getenv("SESION_TTL_MIN", "30"))
+# Hora local (HH:MM) del envío diario de recordatorios
+RECORDATORIOS_HORA = os.getenv("RECORDATORIOS_HORA", "08:00")
+# Ritmo de envío de recordatorios (mensajes/s): arranca en RECORDATORIOS_TASA y se adapta
+# entre el mínimo y el máximo según la latencia observada frente a la objetivo (s)
+RECORDATORIOS_TASA = float(os.getenv("RECORDATORIOS_TASA", "0.5"))
+RECORDATORIOS_TASA_MIN = float(os.getenv("RECORDATORIOS_TASA_MIN", "0.05"))
+RECORDATORIOS_TASA_MAX = float(os.getenv("RECORDATORIOS_TASA_MAX", "2"))
+RECORDATORIOS_LATENCIA_OBJETIVO = float(os.getenv("RECORDATORIOS_LATENCIA_OBJETIVO", "5"))
+# Ejecuciones con fallo tras las que un recordatorio se abandona (p. ej. un número sin WhatsApp)
+RECORDATORIOS_MAX_INTENTOS = int(os.getenv("RECORDATORIOS_MAX_INTENTOS", "3"))
+# "polling": escanea la lista de chats cada 5 s; "observer": eventos de un MutationObserver
+INGESTA_MODO = os.getenv("INGESTA_MODO", "polling")
+# Leer cada mensaje entrante con su data-id para procesarlo exactamente una vez
+INGESTA_POR_ID = os.getenv("INGESTA_POR_ID", "1") == "1"
+# Sesiones de WhatsApp Web que se abren además de la principal para repartir los
+# recordatorios (1 = sin pool, solo la principal; N > 1 = la principal y N más)
+WHATSAPP_POOL_SIZE = int(os.getenv("WHATSAPP_POOL_SIZE", "1"))
+
+# Hilos del bucle síncrono que procesan mensajes en paralelo, uno fijo por paciente (1 = en línea)
+TRABAJADORES_CONVERSACION = int(os.getenv("TRABAJADORES_CONVERSACION", "4"))
+
+# Conversaciones procesadas a la vez por el núcleo asyncio (async_bot.py)
+CONVERSACIONES_CONCURRENTES = int(os.getenv("CONVERSACIONES_CONCURRENTES", "16"))
+
+# Despliegue en varios procesos (supervisor.py): este proceso atiende los números con
+# shard_de(numero, SHARD_TOTAL) == SHARD_INDICE
+SHARD_INDICE = int(os.getenv("SHARD_INDICE", "0"))
+SHARD_TOTAL = int(os.getenv("SHARD_TOTAL", "1"))
+if not 0 <= SHARD_INDICE < max(SHARD_TOTAL, 1):
+    raise ConfigError(f"Error: SHARD_INDICE debe estar entre 0 y {SHARD_TOTAL - 1}.")
+
+# WhatsApp admite hasta 4 dispositivos vinculados por cuenta; cada sesión abierta ocupa uno
+MAX_DISPOSITIVOS_VINCULADOS = 4
+DISPOSITIVOS_POR_PROCESO = 1 + (WHATSAPP_POOL_SIZE if WHATSAPP_POOL_SIZE > 1 else 0)
+if max(SHARD_TOTAL, 1) * DISPOSITIVOS_POR_PROCESO > MAX_DISPOSITIVOS_VINCULADOS:
+    raise ConfigError(
+        f"Error: {max(SHARD_TOTAL, 1)} shards con WHATSAPP_POOL_SIZE={WHATSAPP_POOL_SIZE} abren "
+        f"{max(SHARD_TOTAL, 1) * DISPOSITIVOS_POR_PROCESO} sesiones de WhatsApp Web; "
+        f"el máximo es {MAX_DISPOSITIVOS_VINCULADOS} dispositivos vinculados."
+    )
+
+# Endpoint local de métricas en formato Prometheus (0 = desactivado)
+METRICAS_PUERTO = int(os.getenv("METRICAS_PUERTO", "9108"))
+METRICAS_HOST = os.getenv("METRICAS_HOST", "127.0.0.1")
+
+# "supabase" (por defecto) o "memoria": citas en memoria, sin red, para pruebas y benchmarks
+CITAS_BACKEND = os.getenv("CITAS_BACKEND", "supabase")
+
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+supabase = None
 
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise ConfigError("Error: SUPABASE_URL o SUPABASE_KEY no están configuradas. en el archivo .env")
+if CITAS_BACKEND == "supabase":
+    from supabase import create_client
 
-if not validate_supabase_url(SUPABASE_URL):
-    raise ConfigError("Error: SUPABASE_URL no es una URL válida.")
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        raise ConfigError("Error: SUPABASE_URL o SUPABASE_KEY no están configuradas. en el archivo .env")
 
-try: 
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-except Exception as e:
-    raise ConfigError(f"Error al crear el cliente de Supabase: {e}")
\ No newline at end of file
+    if not validate_supabase_url(SUPABASE_URL):
+        raise ConfigError("Error: SUPABASE_URL no es una URL válida.")
+
+    try:
+        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    except Exception as e:
+        raise ConfigError(f"Error al crear el cliente de Supabase: {e}")
+elif CITAS_BACKEND != "memoria":
+    raise ConfigError(f"Error: CITAS_BACKEND debe ser 'supabase' o 'memoria', no '{CITAS_BACKEND}'.")
@@ -1,9 +1,14 @@
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Any
+from typing import Optional, Dict, Any, Iterable, Iterator, Tuple
 from pydantic import BaseModel
 from config import supabase, logger
+from citas_memoria import ClienteCitasMemoria
 import logging
-from email_service import EmailService
+from email_service import notificar_cancelacion
+from metrics import registro
 
 class Cita(BaseModel):
     id: Optional[int] = None
@@ -16,8 +21,82 @@ class Cita(BaseModel):
     telefonoPaciente: str
     confirmacionCita: Optional[str] = None
 
+# Columnas que usa el mensaje de recordatorio (más el id para trazabilidad)
+COLUMNAS_RECORDATORIO = (
+    "id", "nombrePaciente", "especialidad", "nombreMedico",
+    "fechaCita", "telefonoPaciente", "confirmacionCita",
+)
 
 
+class CacheCitas:
+    """Cache LRU con expiración para las búsquedas de citas por documento.
+
+    También guarda los resultados vacíos para no repetir consultas de
+    documentos sin citas durante la misma conversación.
+    """
+
+    def __init__(self, capacidad: int = 1024, ttl: float = 300):
+        self.capacidad = capacidad
+        self.ttl = ttl
+        self._entradas: "OrderedDict[Tuple[str, str], Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, clave: Tuple[str, str]) -> Tuple[bool, Any]:
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None or entrada[0] < time.monotonic():
+                if entrada is not None:
+                    del self._entradas[clave]
+                self.fallos += 1
+                return False, None
+            self._entradas.move_to_end(clave)
+            self.aciertos += 1
+            return True, entrada[1]
+
+    def guardar(self, clave: Tuple[str, str], valor: Any) -> None:
+        with self._lock:
+            self._entradas[clave] = (time.monotonic() + self.ttl, valor)
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.capacidad:
+                self._entradas.popitem(last=False)
+
+    def invalidar(self, clave: Tuple[str, str]) -> None:
+        with self._lock:
+            self._entradas.pop(clave, None)
+
+    def limpiar(self) -> None:
+        with self._lock:
+            self._entradas.clear()
+
+    def estadisticas(self) -> Dict[str, int]:
+        return {"aciertos": self.aciertos, "fallos": self.fallos, "entradas": len(self._entradas)}
+
+cache_citas = CacheCitas()
+
+# Cliente de la tabla Citas: Supabase o, con CITAS_BACKEND=memoria, el sustituto en memoria
+cliente_citas = supabase if supabase is not None else ClienteCitasMemoria()
+
+
+def usar_cliente_citas(cliente) -> None:
+    """Cambia el backend de citas (p. ej. por un ``ClienteCitasMemoria``) y vacía la cache."""
+    global cliente_citas
+    cliente_citas = cliente
+    cache_citas.limpiar()
+
+registro.contador("ohibot_cache_citas_aciertos_total", "Búsquedas de citas resueltas desde la cache", funcion=lambda: cache_citas.aciertos)
+registro.contador("ohibot_cache_citas_fallos_total", "Búsquedas de citas que consultaron la base de datos", funcion=lambda: cache_citas.fallos)
+registro.medidor("ohibot_cache_citas_entradas", "Documentos en la cache de citas", funcion=lambda: len(cache_citas._entradas))
+
+
+def _latencia_db(operacion: str):
+    return registro.histograma("ohibot_db_segundos", "Duración de las consultas a Supabase", operacion=operacion)
+
+
+def _errores_db(operacion: str):
+    return registro.contador("ohibot_db_errores_total", "Consultas a Supabase fallidas", operacion=operacion)
+
 def buscar_cita(tipo_documento: str, documento: str) -> Optional[Cita]:
     """Busca una cita en la base de datos por documento con validación."""
     try:
@@ -26,62 +105,103 @@ def buscar_cita(tipo_documento: str, documento: str) -> Optional[Cita]:
             logger.warning(f"Documento no numérico: {documento}")
             return None
 
-        fecha_actual = datetime.now().strftime("%Y-%m-%d")
-
-        response = supabase.table("Citas").select("*").eq(
-            "tipoDocumento", tipo_documento.upper()
-        ).eq("documento", documento).execute()
+        clave = (tipo_documento.upper(), documento)
+        encontrado, citas = cache_citas.obtener(clave)
+        if encontrado:
+            return citas
 
-        citas_filtradas = []
+        fecha_actual = datetime.now().strftime("%Y-%m-%d")
 
-        for cita in response.data:
-            if cita["fechaCita"] >= fecha_actual:
-                citas_filtradas.append(cita)
+        with _latencia_db("buscar_cita").medir():
+            response = cliente_citas.table("Citas").select("*").eq(
+                "tipoDocumento", clave[0]
+            ).eq("documento", documento).gte("fechaCita", fecha_actual).execute()
 
-        return [Cita(**cita) for cita in citas_filtradas] if citas_filtradas else None
+        citas = [Cita(**cita) for cita in response.data] if response.data else None
+        cache_citas.guardar(clave, citas)
+        return citas
     except Exception as e:
+        _errores_db("buscar_cita").incrementar()
         logger.error(f"Error al buscar cita: {e}", exc_info=True)
         return None
     
 def actualizar_confirmacion_cita(cita_id: int, confirmacion : str) -> bool:
-    """Actualiza la confirmación de la cita en la base de datos."""
+    """Actualiza la confirmación de la cita en la base de datos.
+
+    La actualización devuelve la fila modificada, así que no hace falta una
+    consulta previa. El email de cancelación se envía en segundo plano.
+    """
     try:
         confirmacion = confirmacion.lower()
         if confirmacion not in ["si", "no"]:
             logger.warning(f"El valor de confirmación {confirmacion} no es válido. Debe ser 'si' o 'no'.")
             return False
-        
-        # Obtenemos los datos actuales de la cita
-        response = supabase.table("Citas").select("*").eq("id", cita_id).execute()
-        if not response.data:
+
+        with _latencia_db("actualizar_confirmacion").medir():
+            update_response = cliente_citas.table("Citas").update({"confirmacionCita": confirmacion}).eq("id", cita_id).execute()
+        if not update_response.data:
             logger.warning(f"Cita no encontrada: ID {cita_id}")
             return False
-            
-        cita_actual = Cita(**response.data[0])
 
-        update_response = supabase.table("Citas").update({"confirmacionCita": confirmacion}).eq("id", cita_id).execute()
+        cita_actual = Cita(**update_response.data[0])
+        cache_citas.invalidar((cita_actual.tipoDocumento.upper(), cita_actual.documento))
 
-        if update_response.data:
-            # Si se actualizó a "no", enviamos email
-            if confirmacion == "no":
-                email_service = EmailService()
-                email_service.enviar_email_cancelacion(cita_actual)
-            return True
-        return False
+        # Si se actualizó a "no", se notifica por email sin bloquear la respuesta
+        if confirmacion == "no":
+            notificar_cancelacion(cita_actual)
+        return True
     
     except Exception as e:
+        _errores_db("actualizar_confirmacion").incrementar()
         logger.error(f"Error al actualizar la confirmación de la cita: {e}", exc_info=True)
         return False
-    
-def obtener_citas_proximas(dias: int = 3) -> List[Cita]:
-    try:
-        fecha_objetivo = (datetime.now() + timedelta(days=3)).strftime("%Y-%m-%d")
 
-        response = supabase.table("Citas").select("*").eq("fechaCita", fecha_objetivo).execute()
-     
+def fecha_citas_proximas(dias: int = 3, desde: Optional[datetime] = None) -> str:
+    return ((desde or datetime.now()) + timedelta(days=dias)).strftime("%Y-%m-%d")
 
-        return [Cita(**cita) for cita in response.data] if response.data else []
-    
-    except Exception as e:
-        logger.error(f"Error al obtener citas próximas: {e}", exc_info=True)
-        return []
\ No newline at end of file
+
+def iterar_citas_proximas(
+    dias: int = 3,
+    tamano_pagina: int = 500,
+    columnas: Iterable[str] = COLUMNAS_RECORDATORIO,
+    desde_id: int = 0,
+    fecha: Optional[str] = None,
+) -> Iterator[Cita]:
+    """Recorre por páginas las citas confirmadas para dentro de ``dias`` días (o del día ``fecha``).
+
+    El filtro de confirmación se aplica en el servidor y solo se piden las
+    columnas de ``columnas``, así que los objetos ``Cita`` se construyen sin
+    validar y los campos no pedidos no existen. Se pagina por ``id`` en vez de
+    por desplazamiento para no saltarse filas si alguna cita cambia de estado
+    mientras se recorre, y se puede retomar después de ``desde_id``.
+
+    Si falla una página se relanza el error en vez de terminar en silencio:
+    quien recorre no debe tomar una lista a medias por completa.
+    """
+    fecha_objetivo = fecha or fecha_citas_proximas(dias)
+    seleccion = ",".join(columnas)
+    ultimo_id = desde_id
+    latencia = _latencia_db("pagina_citas_proximas")
+    while True:
+        try:
+            with latencia.medir():
+                response = (
+                    cliente_citas.table("Citas").select(seleccion)
+                    .eq("fechaCita", fecha_objetivo)
+                    .eq("confirmacionCita", "si")
+                    .gt("id", ultimo_id)
+                    .order("id")
+                    .range(0, tamano_pagina - 1)
+                    .execute()
+                )
+        except Exception as e:
+            _errores_db("pagina_citas_proximas").incrementar()
+            logger.error(f"Error al obtener citas próximas (después del id {ultimo_id}): {e}", exc_info=True)
+            raise
+
+        filas = response.data or []
+        for fila in filas:
+            yield Cita.model_construct(**fila)
+        if len(filas) < tamano_pagina:
+            return
+        ultimo_id = filas[-1]["id"]
@@ -1,35 +1,132 @@
 import os
+import queue
 import smtplib
+import threading
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Optional
 from dotenv import load_dotenv
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from config import logger
+from metrics import registro
 
 
 # Cargar variables de entorno
 load_dotenv()
 
+@dataclass(frozen=True)
+class ConfiguracionSMTP:
+    smtp_server: str
+    smtp_port: int
+    smtp_user: Optional[str]
+    smtp_password: Optional[str]
+    sender_email: Optional[str]
+    receive_email: Optional[str]
+    starttls: bool = True
+    idle_timeout: float = 60  # segundos sin uso antes de cerrar la conexión
+    workers: int = 2
+    cola_max: int = 1000
+
+@lru_cache(maxsize=1)
+def cargar_configuracion() -> ConfiguracionSMTP:
+    """Lee la configuración SMTP del entorno una sola vez por proceso."""
+    configuracion = ConfiguracionSMTP(
+        smtp_server=os.getenv("SMTP_SERVER"),
+        smtp_port=int(os.getenv("SMTP_PORT", "587")),
+        smtp_user=os.getenv("SMTP_USER"),
+        smtp_password=os.getenv("SMTP_PASSWORD"),
+        sender_email=os.getenv("SENDER_EMAIL"),
+        receive_email=os.getenv("RECEIVE_EMAIL"),
+        starttls=os.getenv("SMTP_STARTTLS", "1") == "1",
+        idle_timeout=float(os.getenv("SMTP_IDLE_TIMEOUT", "60")),
+        workers=int(os.getenv("SMTP_WORKERS", "2")),
+        cola_max=int(os.getenv("SMTP_COLA_MAX", "1000")),
+    )
+    # Sin STARTTLS (p. ej. un servidor SMTP local de pruebas) no se exige login
+    credenciales = [configuracion.smtp_user, configuracion.smtp_password] if configuracion.starttls else []
+    if not all([configuracion.smtp_server, *credenciales]):
+        logger.error("Faltan configuraciones SMTP en las variables de entorno")
+        raise ValueError("Configuración SMTP incompleta")
+    return configuracion
+
 class EmailService:
-    def __init__(self):
-        self.smtp_server = os.getenv("SMTP_SERVER")
-        self.smtp_port = int(os.getenv("SMTP_PORT"))
-        self.smtp_user = os.getenv("SMTP_USER")
-        self.smtp_password = os.getenv("SMTP_PASSWORD")
-        self.sender_email = os.getenv("SENDER_EMAIL")
-        self.receive_email = os.getenv("RECEIVE_EMAIL")
-
-        if not all([self.smtp_server, self.smtp_user, self.smtp_password]):
-            logger.error("Faltan configuraciones SMTP en las variables de entorno")
-            raise ValueError("Configuración SMTP incompleta")
+    """Envía emails reutilizando una conexión SMTP autenticada.
+
+    La conexión se abre en el primer envío, se comprueba con ``NOOP`` si lleva
+    tiempo inactiva y se cierra tras ``idle_timeout`` segundos sin uso. No es
+    segura entre hilos: cada hilo debe tener su propia instancia.
+    """
+
+    def __init__(self, configuracion: Optional[ConfiguracionSMTP] = None):
+        configuracion = configuracion or cargar_configuracion()
+        self.configuracion = configuracion
+        self.smtp_server = configuracion.smtp_server
+        self.smtp_port = configuracion.smtp_port
+        self.smtp_user = configuracion.smtp_user
+        self.smtp_password = configuracion.smtp_password
+        self.sender_email = configuracion.sender_email
+        self.receive_email = configuracion.receive_email
+        self._conexion: Optional[smtplib.SMTP] = None
+        self._ultimo_uso = 0.0
+
+    def _obtener_conexion(self) -> smtplib.SMTP:
+        if self._conexion is not None:
+            inactiva = time.monotonic() - self._ultimo_uso
+            if inactiva > self.configuracion.idle_timeout or not self._conexion_viva():
+                self.cerrar()
+        if self._conexion is None:
+            server = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=30)
+            server.ehlo()
+            if self.configuracion.starttls:
+                server.starttls()
+                server.ehlo()
+            if self.smtp_user and self.smtp_password:
+                server.login(self.smtp_user, self.smtp_password)
+            self._conexion = server
+        return self._conexion
+
+    def _conexion_viva(self) -> bool:
+        try:
+            return self._conexion.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def cerrar(self) -> None:
+        """Cierra la conexión SMTP si está abierta."""
+        if self._conexion is None:
+            return
+        try:
+            self._conexion.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._conexion = None
+
+    def cerrar_si_inactiva(self) -> None:
+        if self._conexion is not None and time.monotonic() - self._ultimo_uso > self.configuracion.idle_timeout:
+            self.cerrar()
+
+    def _enviar(self, msg: MIMEMultipart) -> None:
+        """Envía por la conexión actual y reconecta una vez si el servidor la cerró."""
+        for intento in range(2):
+            try:
+                self._obtener_conexion().sendmail(self.sender_email, msg['To'], msg.as_string())
+                self._ultimo_uso = time.monotonic()
+                return
+            except smtplib.SMTPServerDisconnected:
+                self._conexion = None
+                if intento:
+                    raise
 
     def enviar_email_cancelacion(self, cita):
         """Envía email de cancelación usando Gmail"""
         try:
             msg = MIMEMultipart()
             msg['From'] = self.sender_email
-            msg['To'] = self.receive_email 
+            msg['To'] = self.receive_email
             msg['Subject'] = f"Cancelación de cita - {cita.nombrePaciente}"
-            
+
             body = f"""
             <h2>Cancelación de cita médica</h2>
             <p>Se ha cancelado la siguiente cita:</p>
@@ -42,25 +139,148 @@ class EmailService:
                 <li><strong>Teléfono:</strong> {cita.telefonoPaciente}</li>
             </ul>
             """
-            
+
             msg.attach(MIMEText(body, 'html'))  # Usamos HTML para mejor formato
 
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                server.ehlo()
-                server.starttls()
-                server.login(self.smtp_user, self.smtp_password)
-                server.sendmail(
-                    self.sender_email, 
-                    msg['To'], 
-                    msg.as_string()
-                )
-                
+            self._enviar(msg)
+
             logger.info(f"Email enviado a {msg['To']} sobre cancelación de cita {cita.id}")
             return True
-            
+
         except smtplib.SMTPAuthenticationError:
             logger.error("Error de autenticación con el servidor SMTP")
+            self.cerrar()
             return False
         except Exception as e:
             logger.error(f"Error al enviar email: {str(e)}")
-            return False
\ No newline at end of file
+            self.cerrar()
+            return False
+
+
+class ColaCorreo:
+    """Cola acotada de emails atendida por hilos con su propia conexión SMTP.
+
+    Si la cola está llena el email se descarta y se registra, para que una
+    ráfaga de cancelaciones nunca bloquee al chatbot.
+    """
+
+    def __init__(self, configuracion: Optional[ConfiguracionSMTP] = None):
+        self.configuracion = configuracion or cargar_configuracion()
+        self._cola: "queue.Queue" = queue.Queue(maxsize=self.configuracion.cola_max)
+        self._hilos: List[threading.Thread] = []
+        # _cerrando: terminar al vaciar la cola; _detenido: terminar tras el email en curso
+        self._cerrando = threading.Event()
+        self._detenido = threading.Event()
+        self.latencia = registro.histograma("ohibot_correo_segundos", "Duración del envío de cada email")
+        registro.medidor("ohibot_correo_profundidad", "Emails pendientes en la cola", funcion=lambda: self.profundidad)
+        self.enviados = 0
+        self.fallidos = 0
+        self.descartados = 0
+        self._lock = threading.Lock()
+
+    def iniciar(self) -> None:
+        if self._hilos:
+            return
+        self._cerrando.clear()
+        self._detenido.clear()
+        for i in range(self.configuracion.workers):
+            hilo = threading.Thread(target=self._trabajador, name=f"correo-{i}", daemon=True)
+            hilo.start()
+            self._hilos.append(hilo)
+
+    def detener(self, timeout: float = 30) -> int:
+        """Envía lo pendiente y termina los hilos. Devuelve cuántos emails quedaron sin enviar.
+
+        Vuelve en ``timeout`` segundos aunque el SMTP no responda: lo que quede
+        en la cola entonces se registra como perdido.
+        """
+        limite = time.monotonic() + timeout
+        self._cerrando.set()
+        for hilo in self._hilos:
+            hilo.join(max(limite - time.monotonic(), 0))
+        self._detenido.set()
+        self._hilos = []
+        perdidos = 0
+        while True:
+            try:
+                cita = self._cola.get_nowait()
+            except queue.Empty:
+                break
+            perdidos += 1
+            logger.error(f"No se notificó la cancelación de la cita {cita.id}: el correo se detuvo antes de enviarla")
+        return perdidos
+
+    def encolar_cancelacion(self, cita) -> bool:
+        try:
+            self._cola.put_nowait(cita)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.descartados += 1
+            logger.error(f"Cola de correo llena, no se notificará la cancelación de la cita {cita.id}")
+            return False
+
+    @property
+    def profundidad(self) -> int:
+        return self._cola.qsize()
+
+    def estadisticas(self) -> Dict[str, object]:
+        return {
+            "profundidad": self.profundidad,
+            "enviados": self.enviados,
+            "fallidos": self.fallidos,
+            "descartados": self.descartados,
+            "latencia": self.latencia.resumen(),
+        }
+
+    def _trabajador(self) -> None:
+        servicio = EmailService(self.configuracion)
+        while not self._detenido.is_set():
+            try:
+                # Espera corta para ver a tiempo la orden de cerrar
+                cita = self._cola.get(timeout=0.5)
+            except queue.Empty:
+                if self._cerrando.is_set():
+                    break
+                servicio.cerrar_si_inactiva()
+                continue
+            with self.latencia.medir():
+                exito = servicio.enviar_email_cancelacion(cita)
+            with self._lock:
+                if exito:
+                    self.enviados += 1
+                else:
+                    self.fallidos += 1
+        servicio.cerrar()
+
+
+_cola_correo: Optional[ColaCorreo] = None
+_lock_cola = threading.Lock()
+
+
+def obtener_cola_correo() -> ColaCorreo:
+    """Devuelve la cola de correo del proceso, iniciándola la primera vez."""
+    global _cola_correo
+    with _lock_cola:
+        if _cola_correo is None:
+            _cola_correo = ColaCorreo()
+            _cola_correo.iniciar()
+        return _cola_correo
+
+
+def detener_cola_correo(timeout: float = 30) -> None:
+    """Vacía y detiene la cola de correo del proceso, si llegó a crearse."""
+    global _cola_correo
+    with _lock_cola:
+        cola, _cola_correo = _cola_correo, None
+    if cola is not None:
+        cola.detener(timeout)
+        logger.info(f"Cola de correo detenida: {cola.enviados} enviados, {cola.fallidos} fallidos")
+
+
+def notificar_cancelacion(cita) -> None:
+    """Encola el email de cancelación para enviarlo en segundo plano."""
+    try:
+        obtener_cola_correo().encolar_cancelacion(cita)
+    except ValueError as e:
+        logger.error(f"No se pudo notificar la cancelación de la cita {cita.id}: {e}")
@@ -0,0 +1,74 @@
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple, Union
+
+# (numero, sesion, mensaje normalizado) -> respuesta a enviar, o None
+Manejador = Callable[[str, Any, str], Optional[str]]
+Guardia = Callable[[str, Any, str], bool]
+
+
+@dataclass(frozen=True)
+class Transicion:
+    manejador: Manejador
+    # Estado al que pasa la sesión; None si el manejador decide (o no cambia)
+    siguiente: Optional[Hashable] = None
+
+
+class MotorConversacion:
+    """Motor de conversación dirigido por una tabla de transiciones.
+
+    Cada estado tiene entradas exactas (búsqueda O(1) por ``(estado, texto)``),
+    condiciones en orden de registro y un manejador por defecto. Las guardias
+    comunes (bloqueo, "escribiendo", eco del propio bot) se ejecutan una sola
+    vez por mensaje antes de resolver la transición, así que agregar flujos no
+    agrega trabajo por mensaje.
+    """
+
+    def __init__(self):
+        self._exactas: Dict[Tuple[Hashable, str], Transicion] = {}
+        self._condicionales: Dict[Hashable, List[Tuple[Callable[[str], bool], Transicion]]] = {}
+        self._por_defecto: Dict[Hashable, Transicion] = {}
+        self._guardias: List[Guardia] = []
+
+    def agregar_guardia(self, guardia: Guardia) -> None:
+        """``guardia`` devuelve True si el mensaje debe descartarse."""
+        self._guardias.append(guardia)
+
+    def registrar(
+        self,
+        estado: Hashable,
+        manejador: Manejador,
+        siguiente: Optional[Hashable] = None,
+        entrada: Union[str, Iterable[str], None] = None,
+        condicion: Optional[Callable[[str], bool]] = None,
+    ) -> None:
+        """Registra una transición exacta (``entrada``), condicional o por defecto."""
+        transicion = Transicion(manejador, siguiente)
+        if entrada is not None:
+            for texto in ([entrada] if isinstance(entrada, str) else entrada):
+                self._exactas[(estado, texto)] = transicion
+        elif condicion is not None:
+            self._condicionales.setdefault(estado, []).append((condicion, transicion))
+        else:
+            self._por_defecto[estado] = transicion
+
+    def resolver(self, estado: Hashable, mensaje: str) -> Optional[Transicion]:
+        transicion = self._exactas.get((estado, mensaje))
+        if transicion is not None:
+            return transicion
+        for condicion, transicion in self._condicionales.get(estado, ()):
+            if condicion(mensaje):
+                return transicion
+        return self._por_defecto.get(estado)
+
+    def ejecutar(self, numero: str, sesion, mensaje: str) -> Optional[str]:
+        """Aplica guardias y transición sobre ``sesion``. Devuelve la respuesta, si hay."""
+        for guardia in self._guardias:
+            if guardia(numero, sesion, mensaje):
+                return None
+        transicion = self.resolver(sesion.estado, mensaje)
+        if transicion is None:
+            return None
+        respuesta = transicion.manejador(numero, sesion, mensaje)
+        if transicion.siguiente is not None:
+            sesion.estado = transicion.siguiente
+        return respuesta
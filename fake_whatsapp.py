@@ -0,0 +1,445 @@
+"""Imitación local de WhatsApp Web para pruebas y benchmarks sin teléfono ni red.
+
+Sirve una página con los mismos selectores que usan ``whatsapp.py`` e
+``inbox.py`` (lista de chats ``role="grid"`` con ``_ak8q``/``_ak8k``, buscador
+``data-tab="3"``, caja de mensaje en el ``footer``, botón ``aria-label="Enviar"``,
+burbujas ``data-id`` con su icono de estado y la ruta ``/send?phone=&text=``).
+Los mensajes entrantes se inyectan por HTTP.
+
+Uso:
+    python fake_whatsapp.py servir [--puerto 8765] [--retardo-envio-ms 0]
+    python fake_whatsapp.py inyectar --numero +573001234567 --texto hola [--url http://127.0.0.1:8765]
+
+Para apuntar el bot a la imitación: ``WHATSAPP_URL=http://127.0.0.1:8765``.
+``python benchmark.py extremo`` la levanta y mide el bot completo contra ella.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+PAGINA = """<!DOCTYPE html>
+<html lang="es">
+<head>
+<meta charset="utf-8">
+<title>WhatsApp (local)</title>
+<style>
+body { margin: 0; font-family: sans-serif; display: flex; height: 100vh; }
+#side { width: 30%; border-right: 1px solid #ccc; overflow: auto; }
+#side > div[data-tab="3"] { padding: 8px; border-bottom: 1px solid #ccc; min-height: 20px; }
+div[role="row"] { padding: 8px; border-bottom: 1px solid #eee; cursor: pointer; }
+div[role="row"][aria-selected="true"] { background: #e9edef; }
+div._ak8k { color: #667781; white-space: nowrap; overflow: hidden; }
+#main { flex: 1; display: flex; flex-direction: column; }
+#mensajes { flex: 1; overflow: auto; padding: 8px; }
+#mensajes > div { margin: 4px 0; }
+#mensajes > div.message-out { text-align: right; }
+footer { display: flex; border-top: 1px solid #ccc; }
+footer > div[contenteditable] { flex: 1; min-height: 24px; padding: 8px; }
+</style>
+</head>
+<body>
+<div id="side">
+  <div contenteditable="true" data-tab="3" role="textbox" title="Buscar"></div>
+  <div role="grid" aria-label="Lista de chats"></div>
+</div>
+<div id="main">
+  <div id="mensajes"></div>
+  <footer>
+    <div contenteditable="true" data-tab="10" role="textbox" title="Escribe un mensaje"></div>
+    <button data-tab="11" aria-label="Enviar">Enviar</button>
+  </footer>
+</div>
+<script>
+const grid = document.querySelector('div[role="grid"]');
+const buscador = document.querySelector('div[data-tab="3"]');
+const caja = document.querySelector('footer div[contenteditable="true"]');
+const boton = document.querySelector('button[aria-label="Enviar"]');
+const lista = document.getElementById("mensajes");
+const filas = new Map();
+const burbujas = new Map();
+let abierto = null;
+let version = -1;
+let chats = [];
+let filtro = "";
+
+function api(ruta, datos) {
+  const opciones = datos === undefined ? {} : {
+    method: "POST", headers: {"Content-Type": "application/json"}, body: JSON.stringify(datos)
+  };
+  return fetch(ruta, opciones).then((r) => r.json());
+}
+
+function jid(numero) {
+  return numero.replace("+", "") + "@c.us";
+}
+
+function fila(numero) {
+  let f = filas.get(numero);
+  if (!f) {
+    f = document.createElement("div");
+    f.setAttribute("role", "row");
+    f.setAttribute("aria-selected", "false");
+    f.innerHTML = '<div class="_ak8q"><span></span></div><div class="_ak8k"></div><span class="badge"></span>';
+    const titulo = f.querySelector("div._ak8q span");
+    titulo.setAttribute("title", numero);
+    titulo.textContent = numero;
+    f.addEventListener("click", () => abrir(numero));
+    filas.set(numero, f);
+  }
+  return f;
+}
+
+function pintarChats() {
+  const visibles = chats.filter((c) => !filtro || c.numero.includes(filtro));
+  const numeros = new Set(visibles.map((c) => c.numero));
+  for (const hijo of Array.from(grid.children)) {
+    if (!numeros.has(hijo.querySelector("span[title]").getAttribute("title"))) hijo.remove();
+  }
+  visibles.forEach((chat, i) => {
+    const f = fila(chat.numero);
+    const vista = f.querySelector("div._ak8k");
+    if (vista.textContent !== chat.vistaPrevia) vista.textContent = chat.vistaPrevia;
+    const noLeidos = chat.numero === abierto ? 0 : chat.noLeidos;
+    const badge = f.querySelector("span.badge");
+    if (noLeidos && badge.textContent !== String(noLeidos)) {
+      badge.setAttribute("aria-label", noLeidos + " mensajes no leídos");
+      badge.textContent = String(noLeidos);
+    } else if (!noLeidos && badge.hasAttribute("aria-label")) {
+      badge.removeAttribute("aria-label");
+      badge.textContent = "";
+    }
+    const seleccionado = chat.numero === abierto ? "true" : "false";
+    if (f.getAttribute("aria-selected") !== seleccionado) f.setAttribute("aria-selected", seleccionado);
+    if (grid.children[i] !== f) grid.insertBefore(f, grid.children[i] || null);
+  });
+}
+
+function burbuja(id, texto, saliente, icono) {
+  let b = burbujas.get(id);
+  if (!b) {
+    b = document.createElement("div");
+    b.setAttribute("data-id", id);
+    b.className = saliente ? "message-out" : "message-in";
+    const span = document.createElement("span");
+    span.className = "selectable-text";
+    span.innerText = texto;
+    b.appendChild(span);
+    if (saliente) {
+      const tick = document.createElement("span");
+      b.appendChild(tick);
+    }
+    lista.appendChild(b);
+    burbujas.set(id, b);
+  }
+  if (saliente && icono) {
+    const tick = b.lastChild;
+    if (tick.getAttribute("data-icon") !== icono) tick.setAttribute("data-icon", icono);
+  }
+  return b;
+}
+
+function pintarMensajes(mensajes) {
+  for (const m of mensajes) burbuja(m.id, m.texto, m.saliente, m.saliente ? "msg-check" : null);
+  lista.scrollTop = lista.scrollHeight;
+}
+
+function refrescar() {
+  const consulta = "?version=" + version + (abierto ? "&abierto=" + encodeURIComponent(abierto) : "");
+  return api("/api/estado" + consulta).then((estado) => {
+    if (estado.version === version) return;
+    version = estado.version;
+    chats = estado.chats;
+    pintarChats();
+    if (estado.abierto === abierto && estado.mensajes) pintarMensajes(estado.mensajes);
+  });
+}
+
+function sondear() {
+  refrescar().catch(() => null).then(() => setTimeout(sondear, 100));
+}
+
+function abrir(numero) {
+  if (abierto !== numero) {
+    abierto = numero;
+    lista.innerHTML = "";
+    burbujas.clear();
+  }
+  // Como en WhatsApp Web, el filtro del buscador sigue hasta vaciarlo o pulsar Escape
+  version = -1;
+  return api("/api/abrir", {numero}).then(refrescar);
+}
+
+function enviar() {
+  const texto = caja.innerText.replace(/\\n$/, "");
+  if (!abierto || !texto.trim()) return;
+  caja.innerHTML = "";
+  const id = "true_" + jid(abierto) + "_" + Math.random().toString(16).slice(2, 14).toUpperCase();
+  burbuja(id, texto, true, "msg-time");
+  api("/api/enviar", {numero: abierto, texto, id}).then(() => burbuja(id, texto, true, "msg-check"));
+}
+
+buscador.addEventListener("input", () => {
+  filtro = buscador.innerText.replace(/\\s/g, "");
+  pintarChats();
+});
+buscador.addEventListener("keydown", (e) => {
+  if (e.key === "Escape") {
+    buscador.textContent = "";
+    filtro = "";
+    pintarChats();
+  }
+});
+caja.addEventListener("keydown", (e) => {
+  if (e.key === "Enter" && !e.shiftKey) {
+    e.preventDefault();
+    enviar();
+  }
+});
+boton.addEventListener("click", enviar);
+
+// Sin URLSearchParams: como en WhatsApp Web, "+" en phone y text es literal
+function parametro(nombre) {
+  const m = location.search.match(new RegExp("[?&]" + nombre + "=([^&]*)"));
+  if (!m) return null;
+  try { return decodeURIComponent(m[1]); } catch (e) { return m[1]; }
+}
+
+const telefono = parametro("phone");
+if (location.pathname === "/send" && telefono) {
+  abrir(telefono.startsWith("+") ? telefono : "+" + telefono).then(() => {
+    const texto = parametro("text");
+    if (texto) caja.innerText = texto;
+    sondear();
+  });
+} else {
+  sondear();
+}
+</script>
+</body>
+</html>
+"""
+
+
+def _jid(numero: str) -> str:
+    return f"{numero.lstrip('+')}@c.us"
+
+
+class EstadoWhatsAppFalso:
+    """Chats y mensajes de la imitación, seguros entre hilos.
+
+    Cada cambio incrementa ``version`` para que la página solo repinte cuando
+    hay algo nuevo.
+    """
+
+    def __init__(self, retardo_envio: float = 0.0):
+        self.retardo_envio = retardo_envio
+        self.version = 0
+        self._chats: Dict[str, Dict[str, Any]] = {}
+        self._enviados: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def _chat(self, numero: str) -> Dict[str, Any]:
+        chat = self._chats.get(numero)
+        if chat is None:
+            chat = self._chats[numero] = {"mensajes": [], "no_leidos": 0, "actividad": 0.0}
+        return chat
+
+    def inyectar(self, numero: str, texto: str) -> str:
+        """Agrega un mensaje entrante de ``numero``. Devuelve su ``data-id``."""
+        id_mensaje = f"false_{_jid(numero)}_{uuid.uuid4().hex[:20].upper()}"
+        with self._lock:
+            chat = self._chat(numero)
+            chat["mensajes"].append({"id": id_mensaje, "texto": texto, "saliente": False})
+            chat["no_leidos"] += 1
+            chat["actividad"] = time.time()
+            self.version += 1
+        return id_mensaje
+
+    def abrir(self, numero: str) -> None:
+        with self._lock:
+            self._chat(numero)["no_leidos"] = 0
+            self.version += 1
+
+    def enviar(self, numero: str, texto: str, id_mensaje: str) -> None:
+        if self.retardo_envio:
+            time.sleep(self.retardo_envio)
+        with self._lock:
+            chat = self._chat(numero)
+            chat["mensajes"].append({"id": id_mensaje, "texto": texto, "saliente": True})
+            chat["actividad"] = time.time()
+            self._enviados.append({"numero": numero, "texto": texto, "id": id_mensaje, "instante": time.time()})
+            self.version += 1
+
+    def estado(self, abierto: Optional[str], version: int) -> Dict[str, Any]:
+        with self._lock:
+            if version == self.version:
+                return {"version": self.version}
+            if abierto:
+                self._chat(abierto)["no_leidos"] = 0
+            chats = sorted(self._chats.items(), key=lambda item: item[1]["actividad"], reverse=True)
+            return {
+                "version": self.version,
+                "abierto": abierto,
+                "chats": [
+                    {
+                        "numero": numero,
+                        "vistaPrevia": chat["mensajes"][-1]["texto"].replace("\n", " ") if chat["mensajes"] else "",
+                        "noLeidos": chat["no_leidos"],
+                    }
+                    for numero, chat in chats
+                ],
+                "mensajes": list(self._chats[abierto]["mensajes"][-50:]) if abierto else None,
+            }
+
+    def enviados(self, desde: int = 0) -> List[Dict[str, Any]]:
+        with self._lock:
+            return self._enviados[desde:]
+
+    def reiniciar(self) -> None:
+        with self._lock:
+            self._chats.clear()
+            self._enviados.clear()
+            self.version += 1
+
+
+class _ManejadorWhatsAppFalso(BaseHTTPRequestHandler):
+    estado: EstadoWhatsAppFalso
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        consulta = {clave: valores[0] for clave, valores in parse_qs(url.query).items()}
+        if url.path in ("/", "/send"):
+            self._responder(200, PAGINA.encode("utf-8"), "text/html; charset=utf-8")
+        elif url.path == "/api/estado":
+            self._json(self.estado.estado(consulta.get("abierto"), int(consulta.get("version", -1))))
+        elif url.path == "/api/enviados":
+            enviados = self.estado.enviados(int(consulta.get("desde", 0)))
+            self._json({"enviados": enviados})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        longitud = int(self.headers.get("Content-Length") or 0)
+        datos = json.loads(self.rfile.read(longitud) or b"{}")
+        ruta = urlparse(self.path).path
+        if ruta == "/api/abrir":
+            self.estado.abrir(datos["numero"])
+            self._json({"ok": True})
+        elif ruta == "/api/enviar":
+            self.estado.enviar(datos["numero"], datos["texto"], datos["id"])
+            self._json({"ok": True})
+        elif ruta == "/api/inyectar":
+            self._json({"id": self.estado.inyectar(datos["numero"], datos["texto"])})
+        elif ruta == "/api/reiniciar":
+            self.estado.reiniciar()
+            self._json({"ok": True})
+        else:
+            self.send_error(404)
+
+    def _json(self, datos: Dict[str, Any]) -> None:
+        self._responder(200, json.dumps(datos).encode("utf-8"), "application/json")
+
+    def _responder(self, codigo: int, cuerpo: bytes, tipo: str) -> None:
+        self.send_response(codigo)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, *args):
+        pass
+
+
+class WhatsAppFalso:
+    """Servidor HTTP de la imitación en un hilo en segundo plano.
+
+    ``puerto=0`` elige un puerto libre; la URL final queda en ``url``.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", puerto: int = 0, retardo_envio: float = 0.0):
+        self.estado = EstadoWhatsAppFalso(retardo_envio)
+        manejador = type("Manejador", (_ManejadorWhatsAppFalso,), {"estado": self.estado})
+        self._servidor = ThreadingHTTPServer((host, puerto), manejador)
+        self._servidor.daemon_threads = True
+        self._hilo: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, puerto = self._servidor.server_address[:2]
+        return f"http://{host}:{puerto}"
+
+    def iniciar(self) -> "WhatsAppFalso":
+        self._hilo = threading.Thread(target=self._servidor.serve_forever, name="whatsapp-falso", daemon=True)
+        self._hilo.start()
+        return self
+
+    def detener(self) -> None:
+        self._servidor.shutdown()
+        self._servidor.server_close()
+
+    def inyectar(self, numero: str, texto: str) -> str:
+        return self.estado.inyectar(numero, texto)
+
+    def enviados(self, desde: int = 0) -> List[Dict[str, Any]]:
+        return self.estado.enviados(desde)
+
+    def __enter__(self) -> "WhatsAppFalso":
+        return self.iniciar()
+
+    def __exit__(self, *exc) -> None:
+        self.detener()
+
+
+def inyectar_remoto(url: str, numero: str, texto: str) -> str:
+    """Inyecta un mensaje entrante en una imitación que corre en otro proceso."""
+    peticion = urllib.request.Request(
+        f"{url.rstrip('/')}/api/inyectar",
+        data=json.dumps({"numero": numero, "texto": texto}).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(peticion, timeout=10) as respuesta:
+        return json.loads(respuesta.read())["id"]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+
+    servir = subparsers.add_parser("servir", help="Levanta la imitación de WhatsApp Web")
+    servir.add_argument("--host", default="127.0.0.1")
+    servir.add_argument("--puerto", type=int, default=8765)
+    servir.add_argument("--retardo-envio-ms", type=float, default=0)
+
+    inyectar = subparsers.add_parser("inyectar", help="Inyecta mensajes entrantes en una imitación en marcha")
+    inyectar.add_argument("--url", default="http://127.0.0.1:8765")
+    inyectar.add_argument("--numero", required=True)
+    inyectar.add_argument("--texto", required=True)
+    inyectar.add_argument("--repetir", type=int, default=1)
+
+    args = parser.parse_args(argv)
+    if args.comando == "servir":
+        falso = WhatsAppFalso(args.host, args.puerto, args.retardo_envio_ms / 1000).iniciar()
+        print(f"WhatsApp local en {falso.url} (Ctrl+C para salir)")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            falso.detener()
+        return 0
+    if args.comando == "inyectar":
+        for _ in range(args.repetir):
+            print(inyectar_remoto(args.url, args.numero, args.texto))
+        return 0
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
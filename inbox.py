@@ -0,0 +1,290 @@
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+from config import logger
+from session_store import IndiceIdsVistos
+
+# (numero, texto, data-id del mensaje o None si solo se conoce la vista previa)
+MensajeEntrante = Tuple[str, str, Optional[str]]
+
+# Recorre la lista de chats en una sola llamada y devuelve, por fila, el
+# contacto, la vista previa del último mensaje, el contador de no leídos y si
+# es el chat abierto.
+SCRIPT_LISTA_CHATS = """
+const filas = document.querySelectorAll(
+    'div[role="grid"] div[role="row"], div[role="grid"] div[role="listitem"]'
+);
+const chats = [];
+for (const fila of filas) {
+    const titulo = fila.querySelector("div._ak8q span[title]");
+    const mensaje = fila.querySelector("div._ak8k");
+    if (!titulo || !mensaje) continue;
+    const badge = fila.querySelector('span[aria-label*="no leído"], span[aria-label*="unread"]');
+    const noLeidos = badge ? parseInt(badge.textContent, 10) || 1 : 0;
+    const abierto = fila.getAttribute("aria-selected") === "true"
+        || !!fila.querySelector('[aria-selected="true"]');
+    chats.push([titulo.textContent, mensaje.textContent, noLeidos, abierto]);
+}
+return chats;
+"""
+
+
+class InboxScanner:
+    """Detecta todos los chats con mensajes nuevos en una sola pasada.
+
+    Un chat entra al lote si tiene contador de no leídos o si la vista previa
+    de su último mensaje cambió desde el escaneo anterior (el chat abierto no
+    muestra contador). Los mensajes detectados quedan en ``pendientes`` hasta
+    que se consumen.
+
+    Con ``lector_mensajes`` cada chat detectado (y siempre el chat abierto) se
+    expande a sus mensajes entrantes con el ``data-id`` estable de WhatsApp,
+    de modo que cada mensaje se entrega una sola vez aunque el texto se repita.
+    La primera vez que se lee un chat (p. ej. al arrancar) solo se entregan
+    los entrantes sin responder; lo anterior se toma como historial.
+
+    ``acepta_numero`` descarta los chats de otros shards antes de abrirlos:
+    abrir un chat lo marca como leído en todos los dispositivos vinculados.
+
+    El estado por chat se descarta con ``desalojar_inactivos``; un chat
+    desalojado que vuelve a escribir se lee como la primera vez.
+    """
+
+    def __init__(
+        self,
+        grupos_ignorados: Iterable[str] = (),
+        lector_mensajes: Optional[Callable[[str], List[Tuple[str, str]]]] = None,
+        acepta_numero: Optional[Callable[[str], bool]] = None,
+    ):
+        self.grupos_ignorados = set(grupos_ignorados)
+        self.lector_mensajes = lector_mensajes
+        self.acepta_numero = acepta_numero
+        self.pendientes: Deque[MensajeEntrante] = deque()
+        self._vistas_previas: Dict[str, str] = {}
+        self._entregados: Dict[str, str] = {}
+        self._ids_encolados: Dict[str, IndiceIdsVistos] = {}
+        self._reintentar: Set[str] = set()
+        # Último contador de no leídos por chat
+        self._no_leidos: Dict[str, int] = {}
+        # Último cambio de vista previa por chat (time.monotonic)
+        self._actividad: Dict[str, float] = {}
+
+    @property
+    def con_ids(self) -> bool:
+        return self.lector_mensajes is not None
+
+    def escanear(self, driver) -> List[MensajeEntrante]:
+        """Lee la lista de chats y encola los mensajes nuevos. Devuelve el lote."""
+        try:
+            filas = driver.execute_script(SCRIPT_LISTA_CHATS) or []
+        except Exception as e:
+            logger.error(f"Error al escanear la lista de chats: {e}", exc_info=True)
+            return []
+
+        return self._encolar(filas)
+
+    def _encolar(self, filas, modificadas: bool = False) -> List[MensajeEntrante]:
+        lote = self._filtrar(filas, modificadas)
+        if self.lector_mensajes:
+            lote = self._leer_con_ids(lote)
+        self.pendientes.extend(lote)
+        if lote:
+            logger.info(f"{len(lote)} mensajes nuevos ({len(self.pendientes)} pendientes)")
+        return lote
+
+    def _filtrar(self, filas, modificadas: bool = False) -> List[MensajeEntrante]:
+        """Chats con algo nuevo. ``modificadas``: filas que la página reportó como cambiadas."""
+        lote = []
+        for titulo, mensaje, no_leidos, *resto in filas:
+            abierto = bool(resto and resto[0])
+            numero = titulo.replace(" ", "")
+            if numero in self.grupos_ignorados or not numero.startswith("+"):
+                continue
+            if self.acepta_numero and not self.acepta_numero(numero):
+                continue
+
+            anterior = self._vistas_previas.get(numero)
+            if anterior != mensaje:
+                self._actividad[numero] = time.monotonic()
+            self._vistas_previas[numero] = mensaje
+            self._no_leidos[numero] = no_leidos
+            if self.lector_mensajes:
+                # Los IDs deciden qué es nuevo; el chat abierto y las filas que cambiaron se
+                # revisan siempre (un "si" repetido deja igual la vista previa)
+                if no_leidos or abierto or modificadas or (anterior is not None and anterior != mensaje):
+                    lote.append((numero, mensaje, None))
+                continue
+            if self._entregados.get(numero) == mensaje:
+                continue
+            if no_leidos or (anterior is not None and anterior != mensaje):
+                self._entregados[numero] = mensaje
+                lote.append((numero, mensaje, None))
+        return lote
+
+    def _leer_con_ids(self, lote: List[MensajeEntrante]) -> List[MensajeEntrante]:
+        """Sustituye cada chat detectado por sus mensajes entrantes aún no encolados.
+
+        Si no se puede leer un chat se reintenta en el siguiente escaneo en vez
+        de entregar la vista previa, que podría ser el eco del propio bot.
+        """
+        numeros = list(dict.fromkeys([numero for numero, _, _ in lote] + list(self._reintentar)))
+        self._reintentar.clear()
+        mensajes = []
+        for numero in numeros:
+            try:
+                leidos = self.lector_mensajes(numero)
+            except Exception as e:
+                logger.warning(f"No se pudieron leer los mensajes de {numero}: {e}")
+                self._reintentar.add(numero)
+                continue
+            vistos = self._ids_encolados.get(numero)
+            if vistos is None:
+                self._ids_encolados[numero] = IndiceIdsVistos(
+                    id_mensaje for id_mensaje, _ in leidos if id_mensaje.startswith("false_")
+                )
+                mensajes.extend((numero, texto, id_mensaje) for id_mensaje, texto in self._sin_responder(numero, leidos))
+                continue
+            for id_mensaje, texto in leidos:
+                if id_mensaje.startswith("false_") and vistos.agregar(id_mensaje):
+                    mensajes.append((numero, texto, id_mensaje))
+        return mensajes
+
+    def _sin_responder(self, numero: str, leidos: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """En la primera lectura de un chat, los entrantes que aún no se atendieron.
+
+        Son los posteriores al último mensaje del bot; si no hay ninguno a la
+        vista, los últimos ``no_leidos``. El resto es historial ya procesado.
+        """
+        salientes = [i for i, (id_mensaje, _) in enumerate(leidos) if id_mensaje.startswith("true_")]
+        if salientes:
+            candidatos = leidos[salientes[-1] + 1:]
+        else:
+            no_leidos = self._no_leidos.get(numero, 0)
+            candidatos = leidos[-no_leidos:] if no_leidos else []
+        return [(id_mensaje, texto) for id_mensaje, texto in candidatos if id_mensaje.startswith("false_")]
+
+    def desalojar_inactivos(self, segundos: float) -> int:
+        """Olvida los chats sin cambios en ``segundos`` y sin nada por leer. Devuelve cuántos."""
+        limite = time.monotonic() - segundos
+        inactivos = [
+            numero for numero, ultima in list(self._actividad.items())
+            if ultima < limite and not self._no_leidos.get(numero) and numero not in self._reintentar
+        ]
+        for numero in inactivos:
+            for estado in (self._vistas_previas, self._entregados, self._ids_encolados, self._no_leidos, self._actividad):
+                estado.pop(numero, None)
+        return len(inactivos)
+
+    def siguiente(self) -> MensajeEntrante:
+        """Saca el siguiente mensaje pendiente, o ``(None, None, None)`` si no hay."""
+        if not self.pendientes:
+            return None, None, None
+        return self.pendientes.popleft()
+
+    @property
+    def total_pendientes(self) -> int:
+        return len(self.pendientes)
+
+
+# Instala un MutationObserver sobre la lista de chats que acumula en memoria
+# de la página las filas modificadas. Es idempotente por carga de página.
+SCRIPT_INSTALAR_OBSERVADOR = """
+if (window.__ohibot) return true;
+const grid = document.querySelector('div[role="grid"]');
+if (!grid) return false;
+const SELECTOR_FILA = 'div[role="row"], div[role="listitem"]';
+const estado = {cola: [], despertar: null};
+const leerFila = (fila) => {
+    const titulo = fila.querySelector("div._ak8q span[title]");
+    const mensaje = fila.querySelector("div._ak8k");
+    if (!titulo || !mensaje) return null;
+    const badge = fila.querySelector('span[aria-label*="no leído"], span[aria-label*="unread"]');
+    const abierto = fila.getAttribute("aria-selected") === "true"
+        || !!fila.querySelector('[aria-selected="true"]');
+    return [titulo.textContent, mensaje.textContent, badge ? parseInt(badge.textContent, 10) || 1 : 0, abierto];
+};
+estado.observer = new MutationObserver((mutaciones) => {
+    const filas = new Set();
+    for (const m of mutaciones) {
+        const nodo = m.target.nodeType === 1 ? m.target : m.target.parentElement;
+        const fila = nodo && nodo.closest(SELECTOR_FILA);
+        if (fila) filas.add(fila);
+        for (const n of m.addedNodes) {
+            if (n.nodeType === 1 && n.matches(SELECTOR_FILA)) filas.add(n);
+        }
+    }
+    for (const fila of filas) {
+        const chat = leerFila(fila);
+        if (chat) estado.cola.push(chat);
+    }
+    if (estado.cola.length && estado.despertar) {
+        const despertar = estado.despertar;
+        estado.despertar = null;
+        despertar(estado.cola.splice(0));
+    }
+});
+estado.observer.observe(grid, {childList: true, subtree: true, characterData: true});
+window.__ohibot = estado;
+return true;
+"""
+
+SCRIPT_DRENAR_EVENTOS = """
+const estado = window.__ohibot;
+return estado ? estado.cola.splice(0) : null;
+"""
+
+SCRIPT_ESPERAR_EVENTOS = """
+const callback = arguments[arguments.length - 1];
+const estado = window.__ohibot;
+if (!estado) { callback(null); return; }
+if (estado.cola.length) { callback(estado.cola.splice(0)); return; }
+const temporizador = setTimeout(() => { estado.despertar = null; callback([]); }, arguments[0]);
+estado.despertar = (cola) => { clearTimeout(temporizador); callback(cola); };
+"""
+
+
+class ChatListObserver(InboxScanner):
+    """Ingesta por eventos: la página avisa de los cambios en la lista de chats.
+
+    En lugar de recorrer la lista completa en cada ciclo, un MutationObserver
+    inyectado acumula las filas modificadas y el bot las drena con una sola
+    llamada a ``execute_script`` o se bloquea en ``esperar`` hasta que llegue
+    alguna. Si la página se recarga, el observador se reinstala solo.
+
+    Con ``lector_mensajes`` toda fila reportada se lee por IDs aunque su vista
+    previa no haya cambiado: el evento ya indica que algo cambió en ese chat.
+    """
+
+    def _asegurar_observador(self, driver) -> bool:
+        if driver.execute_script("return !!window.__ohibot;"):
+            return True
+        if not driver.execute_script(SCRIPT_INSTALAR_OBSERVADOR):
+            return False
+        logger.info("Observador de la lista de chats instalado")
+        # Escaneo completo para registrar vistas previas y no leídos existentes
+        super().escanear(driver)
+        return True
+
+    def escanear(self, driver) -> List[MensajeEntrante]:
+        """Drena los eventos acumulados en la página sin bloquear."""
+        try:
+            eventos = driver.execute_script(SCRIPT_DRENAR_EVENTOS)
+            if eventos is None:
+                self._asegurar_observador(driver)
+                return []
+        except Exception as e:
+            logger.error(f"Error al drenar eventos de la lista de chats: {e}", exc_info=True)
+            return []
+        return self._encolar(eventos, modificadas=True)
+
+    def esperar(self, driver, timeout: float = 30) -> List[MensajeEntrante]:
+        """Bloquea hasta que la página reporte cambios o venza ``timeout`` segundos."""
+        try:
+            if not self._asegurar_observador(driver):
+                return []
+            driver.set_script_timeout(timeout + 5)
+            eventos = driver.execute_async_script(SCRIPT_ESPERAR_EVENTOS, int(timeout * 1000))
+        except Exception as e:
+            logger.error(f"Error al esperar eventos de la lista de chats: {e}", exc_info=True)
+            return []
+        return self._encolar(eventos or [], modificadas=True)
@@ -1,17 +1,49 @@
-import json
 import time
 import threading
-import re
-from typing import Dict, Optional, Tuple, List
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Iterable, Optional, Set, Tuple, List
 from enum import Enum, auto
-from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from whatsapp import whatsapp_driver
-from database import buscar_cita, actualizar_confirmacion_cita, obtener_citas_proximas, Cita
-from config import logger
+from whatsapp import WhatsAppDriver, WhatsAppDriverPool, whatsapp_driver
+from send_queue import DespachadorEnvios, despachador, PRIORIDAD_RECORDATORIO
+from inbox import InboxScanner, ChatListObserver, MensajeEntrante
+from normalizer import normalizar_mensaje
+from engine import MotorConversacion
+from database import buscar_cita, actualizar_confirmacion_cita, fecha_citas_proximas, iterar_citas_proximas, Cita
+from config import logger, SHARD_INDICE, SHARD_TOTAL, TRABAJADORES_CONVERSACION, METRICAS_HOST, METRICAS_PUERTO, SESSION_DB_PATH, SESION_TTL_MIN, RECORDATORIOS_HORA, RECORDATORIOS_TASA, RECORDATORIOS_TASA_MIN, RECORDATORIOS_TASA_MAX, RECORDATORIOS_LATENCIA_OBJETIVO, RECORDATORIOS_MAX_INTENTOS, INGESTA_MODO, INGESTA_POR_ID, WHATSAPP_POOL_SIZE
+from session_store import IndiceIdsVistos, SessionStore, SQLiteSessionStore
+from scheduler import CursorCampana, Planificador, RegistroEnvios
+from metrics import registro, iniciar_servidor
+from workers import PoolConversaciones
+from pacing import RitmoAdaptativo
+from email_service import detener_cola_correo
+from outbox import ENVIADOS
+from utils import shard_de
+
+TIPOS_DOCUMENTO = ("cc", "ti", "ce", "cd", "pa", "sc", "pe", "rc", "cn", "as", "ms", "pt")
+# Tipo de recordatorio en la bitácora de envíos: uno por cita, días antes de la fecha
+TIPO_RECORDATORIO = "cita_proxima"
+# Espera del observador (s) mientras hay conversaciones en curso: sus respuestas salen por el mismo despachador
+ESPERA_CON_CONVERSACIONES = 0.2
+
+METRICA_ESCANEO = registro.histograma("ohibot_escaneo_bandeja_segundos", "Duración de cada escaneo de la lista de chats")
+METRICA_PROCESAR = registro.histograma("ohibot_procesar_mensaje_segundos", "Duración del procesamiento de un mensaje entrante")
+METRICA_GUARDAR_ESTADO = registro.histograma("ohibot_guardar_estado_segundos", "Duración de cada guardado de sesiones")
+MENSAJES_ENTRANTES = registro.contador("ohibot_mensajes_entrantes_total", "Mensajes entrantes procesados")
+MENSAJES_DUPLICADOS = registro.contador("ohibot_mensajes_duplicados_total", "Mensajes descartados por data-id ya visto")
+RECORDATORIOS_ENVIADOS = registro.contador("ohibot_recordatorios_total", "Recordatorios por resultado", resultado="enviado")
+RECORDATORIOS_FALLIDOS = registro.contador("ohibot_recordatorios_total", "Recordatorios por resultado", resultado="fallido")
+RECORDATORIOS_ABANDONADOS = registro.contador(
+    "ohibot_recordatorios_total", "Recordatorios por resultado", resultado="abandonado"
+)
+RECORDATORIOS_YA_ENVIADOS = registro.contador("ohibot_recordatorios_total", "Recordatorios por resultado", resultado="ya_enviado")
+RECORDATORIOS_ULTIMA_EJECUCION = registro.medidor(
+    "ohibot_recordatorios_ultima_ejecucion_timestamp", "Fin de la última ejecución completa de recordatorios (epoch)"
+)
+RECORDATORIOS_TASA_ACTUAL = registro.medidor("ohibot_recordatorios_tasa", "Recordatorios por segundo permitidos por el ritmo adaptativo")
+RECORDATORIOS_PAUSAS = registro.contador("ohibot_recordatorios_pausas_total", "Pausas por fallos seguidos durante una campaña")
 
 class EstadoUsuario(Enum):
     INICIO = auto()
@@ -23,99 +55,180 @@ class EstadoUsuario(Enum):
     CANCELANDO_CITA = auto()
     CONFIRMANDO_CANCELACION = auto()
 
-@dataclass
 class SesionUsuario:
-    estado: EstadoUsuario = EstadoUsuario.INICIO
-    intentos: int = 0
-    citas_confirmadas: List[Cita] = field(default_factory=list)
-    cita_actual: Optional[Cita] = None
-    ultimo_mensaje: Optional[str] = None
-    ultimo_mensaje_bloqueo: Optional[datetime] = None 
-    tipo_documento: Optional[str] = None
-    ultima_interaccion: datetime = datetime.now()
-    bloqueado_hasta: Optional[datetime] = None
+    """Estado de la conversación con un número, compacto en memoria.
+
+    De las citas solo se guardan los IDs; los datos completos se recuperan con
+    ``buscar_cita``, que durante la conversación responde desde su cache.
+    """
+
+    __slots__ = (
+        "estado", "intentos", "citas_confirmadas_ids", "cita_actual_id", "ultimo_mensaje",
+        "ultimo_mensaje_bloqueo", "tipo_documento", "documento", "ultima_interaccion",
+        "bloqueado_hasta", "ids_vistos",
+    )
+
+    def __init__(
+        self,
+        estado: EstadoUsuario = EstadoUsuario.INICIO,
+        intentos: int = 0,
+        citas_confirmadas_ids: Tuple[int, ...] = (),
+        cita_actual_id: Optional[int] = None,
+        ultimo_mensaje: Optional[str] = None,
+        ultimo_mensaje_bloqueo: Optional[datetime] = None,
+        tipo_documento: Optional[str] = None,
+        documento: Optional[str] = None,
+        ultima_interaccion: Optional[datetime] = None,
+        bloqueado_hasta: Optional[datetime] = None,
+        ids_vistos: Optional[IndiceIdsVistos] = None,
+    ):
+        self.estado = estado
+        self.intentos = intentos
+        self.citas_confirmadas_ids = tuple(citas_confirmadas_ids)
+        self.cita_actual_id = cita_actual_id
+        self.ultimo_mensaje = ultimo_mensaje
+        self.ultimo_mensaje_bloqueo = ultimo_mensaje_bloqueo
+        self.tipo_documento = tipo_documento
+        self.documento = documento
+        self.ultima_interaccion = ultima_interaccion or datetime.now()
+        self.bloqueado_hasta = bloqueado_hasta
+        self.ids_vistos = ids_vistos if ids_vistos is not None else IndiceIdsVistos()
+
+def serializar_sesion(sesion: SesionUsuario) -> dict:
+    return {
+        "estado": sesion.estado.name,
+        "intentos": sesion.intentos,
+        "tipo_documento": sesion.tipo_documento,
+        "documento": sesion.documento,
+        "ultimo_mensaje": sesion.ultimo_mensaje,
+        "ultima_interaccion": sesion.ultima_interaccion.isoformat(),
+        "bloqueado_hasta": sesion.bloqueado_hasta.isoformat() if sesion.bloqueado_hasta else None,
+        "cita_actual_id": sesion.cita_actual_id,
+        "citas_confirmadas_ids": list(sesion.citas_confirmadas_ids),
+        "ids_vistos": sesion.ids_vistos.a_lista()
+    }
+
+def deserializar_sesion(sesion_data: dict) -> SesionUsuario:
+    bloqueado_hasta = (
+        datetime.fromisoformat(sesion_data["bloqueado_hasta"]) 
+        if sesion_data.get("bloqueado_hasta") 
+        else None
+    )
+    # Formato anterior: la cita actual se guardaba completa
+    cita_actual_id = sesion_data.get("cita_actual_id")
+    if cita_actual_id is None and sesion_data.get("cita_actual"):
+        cita_actual_id = sesion_data["cita_actual"].get("id")
+    return SesionUsuario(
+        estado=EstadoUsuario[sesion_data["estado"]],
+        intentos=sesion_data["intentos"],
+        tipo_documento=sesion_data.get("tipo_documento"),
+        documento=sesion_data.get("documento"),
+        ultimo_mensaje=sesion_data.get("ultimo_mensaje"),
+        ultima_interaccion=datetime.fromisoformat(sesion_data["ultima_interaccion"]),
+        bloqueado_hasta=bloqueado_hasta,
+        cita_actual_id=cita_actual_id,
+        citas_confirmadas_ids=sesion_data.get("citas_confirmadas_ids", ()),
+        ids_vistos=IndiceIdsVistos(sesion_data.get("ids_vistos", ()))
+    )
 
 class OHIBot:
-    def __init__(self):
-        self.estado_usuarios: Dict[str, SesionUsuario] = {}
+    def __init__(self, transporte: Optional[DespachadorEnvios] = None, trabajadores: int = TRABAJADORES_CONVERSACION):
+        # Todo lo que toca el navegador pasa por el transporte (el despachador global por defecto)
+        self.transporte = transporte or despachador
+        self.estado_usuarios: SessionStore
         self.cargar_estado()
         self.grupos_ignorados = ["EgresadosIngSistUPC", "EspañitaSoviética"]
+        self.pool = WhatsAppDriverPool(WHATSAPP_POOL_SIZE) if WHATSAPP_POOL_SIZE > 1 else None
+        lector = whatsapp_driver.leer_mensajes_entrantes if INGESTA_POR_ID else None
+        acepta = self.es_de_este_shard if SHARD_TOTAL > 1 else None
+        if INGESTA_MODO == "observer":
+            self.bandeja = ChatListObserver(self.grupos_ignorados, lector, acepta)
+        else:
+            self.bandeja = InboxScanner(self.grupos_ignorados, lector, acepta)
         self.max_intentos = 10
         self.tiempo_bloqueo = timedelta(minutes=30)
+        self.motor = self._construir_motor()
+        self.ttl_sesion = timedelta(minutes=SESION_TTL_MIN)
+        self._ultimo_desalojo = time.monotonic()
+        self.planificador = Planificador(SESSION_DB_PATH)
+        self.registro_envios = RegistroEnvios(SESSION_DB_PATH)
+        self.cursor_campanas = CursorCampana(SESSION_DB_PATH)
+        self.campana_recordatorios = f"recordatorios_{SHARD_INDICE}" if SHARD_TOTAL > 1 else "recordatorios"
+        self.servidor_metricas = None
+        # Con más de un trabajador, los mensajes se procesan en paralelo por paciente
+        self.conversaciones = PoolConversaciones(self.procesar_mensaje, trabajadores) if trabajadores > 1 else None
+        registro.medidor("ohibot_sesiones_en_memoria", "Sesiones de usuario residentes en memoria",
+                         funcion=lambda: len(self.estado_usuarios))
 
     def cargar_estado(self):
-        try:
-            with open("estado_usuarios.json", "r") as f:
-                data = json.load(f)
-                for numero, sesion_data in data.items():
-                    bloqueado_hasta = (
-                        datetime.fromisoformat(sesion_data["bloqueado_hasta"]) 
-                        if sesion_data.get("bloqueado_hasta") 
-                        else None
-                    )
-                    self.estado_usuarios[numero] = SesionUsuario(
-                        estado=EstadoUsuario[sesion_data["estado"]],
-                        intentos=sesion_data["intentos"],
-                        tipo_documento=sesion_data.get("tipo_documento"),
-                        ultimo_mensaje=sesion_data.get("ultimo_mensaje"),
-                        ultima_interaccion=datetime.fromisoformat(sesion_data["ultima_interaccion"]),
-                        bloqueado_hasta=bloqueado_hasta,
-                        cita_actual=Cita(**sesion_data["cita_actual"]) if sesion_data.get("cita_actual") else None
-                    )
-        except (FileNotFoundError, json.JSONDecodeError, KeyError) as e:
-            logger.warning(f"No se pudo cargar el estado: {e}")
-            self.estado_usuarios = {}
-
-    def guardar_estado(self):
-        estado_serializable = {}
-        for numero, sesion in self.estado_usuarios.items():
-            estado_serializable[numero] = {
-                "estado": sesion.estado.name,
-                "intentos": sesion.intentos,
-                "tipo_documento": sesion.tipo_documento,
-                "ultimo_mensaje": sesion.ultimo_mensaje,
-                "ultima_interaccion": sesion.ultima_interaccion.isoformat(),
-                "bloqueado_hasta": sesion.bloqueado_hasta.isoformat() if sesion.bloqueado_hasta else None,
-                "cita_actual": sesion.cita_actual.model_dump() if sesion.cita_actual else None
-            }
-        try:
-            with open("estado_usuarios.json", "w") as f:
-                json.dump(estado_serializable, f, indent=2)
-        except Exception as e:
-            logger.error(f"Error al guardar estado: {e}")
+        """Abre el almacén de sesiones; cada sesión se carga al consultarla."""
+        self.estado_usuarios = SQLiteSessionStore(
+            SESSION_DB_PATH, serializar_sesion, deserializar_sesion, compartido=SHARD_TOTAL > 1
+        )
+        self.estado_usuarios.importar_json("estado_usuarios.json")
+
+    def guardar_estado(self, numero: Optional[str] = None):
+        """Persiste solo las sesiones modificadas (o la de ``numero``)."""
+        with METRICA_GUARDAR_ESTADO.medir():
+            self.estado_usuarios.guardar(numero)
+
+    @staticmethod
+    def es_de_este_shard(numero: str) -> bool:
+        """Si este proceso atiende a ``numero`` en un despliegue de varios procesos."""
+        return shard_de(numero, SHARD_TOTAL) == SHARD_INDICE
+
+    def desalojar_sesiones_inactivas(self) -> int:
+        """Saca de memoria las sesiones sin interacción en ``ttl_sesion``; siguen en disco."""
+        self._ultimo_desalojo = time.monotonic()
+        limite = datetime.now() - self.ttl_sesion
+        desalojadas = self.estado_usuarios.desalojar(lambda sesion: sesion.ultima_interaccion < limite)
+        # El estado de la bandeja es del hilo del navegador
+        segundos = self.ttl_sesion.total_seconds()
+        self.transporte.ejecutar(lambda _driver: self.bandeja.desalojar_inactivos(segundos))
+        if desalojadas:
+            logger.info(f"{desalojadas} sesiones inactivas fuera de memoria ({len(self.estado_usuarios)} activas)")
+        return desalojadas
+
+    def obtener_mensajes_nuevos(self) -> List[MensajeEntrante]:
+        """Escanea todos los chats con mensajes nuevos y devuelve el lote detectado."""
+        return self.transporte.ejecutar(self.escanear_bandeja).result() or []
+
+    def esperar_mensajes_nuevos(self, timeout: float = 5) -> List[MensajeEntrante]:
+        """Bloquea hasta que el observador de la página reporte mensajes nuevos.
+
+        El timeout es corto porque la espera ocupa el despachador: los
+        recordatorios encolados mientras tanto esperan como máximo ese tiempo.
+        Con conversaciones en curso se usa ``ESPERA_CON_CONVERSACIONES``.
+        """
+        lote = self.transporte.ejecutar(lambda driver: self.escanear_bandeja(driver, timeout)).result()
+        if lote is None:
+            time.sleep(5)
+        return lote or []
+
+    def escanear_bandeja(self, driver: WhatsAppDriver, timeout: Optional[float] = None):
+        """Escanea la bandeja, o con ``timeout`` espera al observador.
+
+        Se ejecuta en el hilo del despachador (``transporte.ejecutar``).
+        Devuelve ``None`` si no hay navegador.
+        """
+        navegador = driver.iniciar_driver()
+        if not navegador:
+            return None
+        if timeout is None:
+            with METRICA_ESCANEO.medir():
+                return self.bandeja.escanear(navegador)
+        return self.bandeja.esperar(navegador, timeout)
 
     def obtener_ultimo_mensaje(self) -> Tuple[Optional[str], Optional[str]]:
-        """Obtiene el último mensaje recibido con manejo robusto de errores."""
-        try:
-            driver = whatsapp_driver.iniciar_driver()
-            if not driver:
-                return None, None
-
-            contactos = WebDriverWait(driver, 10).until(
-                EC.presence_of_all_elements_located((By.XPATH, "//div[contains(@class, '_ak8q')]//span[@title]"))
-            )
-            mensajes = WebDriverWait(driver, 10).until(
-                EC.presence_of_all_elements_located((By.XPATH, "//div[contains(@class, '_ak8k')]"))
-            )
-
-            if mensajes and contactos:
-                ultimo_mensaje = mensajes[0].text
-                ultimo_contacto = contactos[0].text.replace(" ", "")
+        """Devuelve el siguiente mensaje pendiente, escaneando si no queda ninguno."""
+        if not self.bandeja.total_pendientes:
+            self.obtener_mensajes_nuevos()
+        numero, mensaje, _ = self.bandeja.siguiente()
+        return numero, mensaje
 
-                if ultimo_contacto in self.grupos_ignorados:
-                    return None, None
-
-                if ultimo_contacto.startswith("+"):
-                    return ultimo_contacto, ultimo_mensaje
-
-            return None, None
-        except Exception as e:
-            logger.error(f"Error al obtener mensaje: {e}", exc_info=True)
-            return None, None
-
-    def usuario_bloqueado(self, numero: str) -> bool:
+    def usuario_bloqueado(self, numero: str, sesion: Optional[SesionUsuario] = None) -> bool:
         """Verifica si el usuario está temporalmente bloqueado."""
-        sesion = self.estado_usuarios.get(numero, SesionUsuario())
+        sesion = sesion or self.estado_usuarios.get(numero, SesionUsuario())
         if sesion.bloqueado_hasta and datetime.now() < sesion.bloqueado_hasta:
             tiempo_restante = sesion.bloqueado_hasta - datetime.now()
             minutos = int(tiempo_restante.total_seconds() / 60)
@@ -123,386 +236,209 @@ class OHIBot:
             ultimo_mensaje_bloqueo = getattr(sesion, "ultimo_mensaje_bloqueo", None)
             if not ultimo_mensaje_bloqueo or (datetime.now() - ultimo_mensaje_bloqueo).total_seconds() > 600:
                 
-                whatsapp_driver.enviar_mensaje(
+                self.transporte.encolar(
                     numero,
                     f"⏳ Has excedido el número máximo de intentos. Por favor intenta nuevamente en {minutos} minutos."
                 )
                 
                 sesion.ultimo_mensaje_bloqueo = datetime.now()
-                self.estado_usuarios[numero] = sesion
-                self.guardar_estado()
 
             
             return True
         elif sesion.bloqueado_hasta:
             sesion.bloqueado_hasta = None
             sesion.intentos = 0
-            self.estado_usuarios[numero] = sesion
         return False
     
     def normalizar_mensaje(self, texto: str) -> str:
+        return normalizar_mensaje(texto)
+
+    def _construir_motor(self) -> MotorConversacion:
+        """Tabla de transiciones del chatbot: (estado, mensaje) -> manejador y siguiente estado."""
+        motor = MotorConversacion()
+        motor.agregar_guardia(lambda numero, sesion, mensaje: self.usuario_bloqueado(numero, sesion))
+        motor.agregar_guardia(lambda numero, sesion, mensaje: mensaje == "escribiendo")
+        if not self.bandeja.con_ids:
+            # Sin data-id solo se puede reconocer el eco comparando el texto
+            motor.agregar_guardia(self._es_eco)
+
+        E = EstadoUsuario
+        motor.registrar(E.INICIO, self._saludar, E.INICIO, entrada="hola")
+        motor.registrar(E.INICIO, self._pedir_tipo_documento, E.ESPERANDO_TIPO_DOCUMENTO, entrada="cita")
+
+        motor.registrar(E.ESPERANDO_TIPO_DOCUMENTO, self._recibir_tipo_documento, E.ESPERANDO_NUMERO_DOCUMENTO, entrada=TIPOS_DOCUMENTO)
+        motor.registrar(E.ESPERANDO_TIPO_DOCUMENTO, self._tipo_documento_invalido)
+
+        motor.registrar(E.ESPERANDO_NUMERO_DOCUMENTO, self._consultar_citas, condicion=str.isdigit)
+        motor.registrar(E.ESPERANDO_NUMERO_DOCUMENTO, self._numero_documento_invalido)
+
+        motor.registrar(E.SELECIONANDO_OPCIONES, self._listar_citas_confirmadas, entrada="cancelar cita")
+        motor.registrar(E.SELECIONANDO_OPCIONES, self._reiniciar, E.INICIO, entrada="cita")
+
+        motor.registrar(E.CANCELANDO_CITA, self._terminar_cancelacion, E.INICIO, entrada="terminar")
+        motor.registrar(E.CANCELANDO_CITA, self._seleccionar_cita, condicion=str.isdigit)
+        motor.registrar(E.CANCELANDO_CITA, self._seleccion_no_numerica)
+
+        motor.registrar(E.CONFIRMANDO_CANCELACION, self._terminar_cancelacion, E.INICIO, entrada="terminar")
+        motor.registrar(E.CONFIRMANDO_CANCELACION, self._cancelar_cita, E.INICIO, entrada="si")
+        motor.registrar(E.CONFIRMANDO_CANCELACION, self._mantener_cita, E.INICIO, entrada="no")
+        motor.registrar(E.CONFIRMANDO_CANCELACION, self._confirmacion_invalida)
+        return motor
+
+    def _es_eco(self, numero: str, sesion: SesionUsuario, mensaje: str) -> bool:
+        """Detecta el último mensaje del propio bot leído de vuelta en la lista de chats."""
+        if not sesion.ultimo_mensaje:
+            return False
+        return mensaje == sesion.ultimo_mensaje or mensaje.startswith(sesion.ultimo_mensaje.split()[0])
+
+    def _registrar_intento_fallido(
+        self, sesion: SesionUsuario, respuesta: str,
+        respuesta_bloqueo: str = "⏳ Has excedido el número máximo de intentos. Por favor intenta nuevamente más tarde."
+    ) -> str:
+        sesion.intentos += 1
+        if sesion.intentos >= self.max_intentos:
+            sesion.bloqueado_hasta = datetime.now() + self.tiempo_bloqueo
+            return respuesta_bloqueo
+        return respuesta
+
+    def _reiniciar(self, numero: str, sesion: SesionUsuario, mensaje: str) -> None:
+        sesion.estado = EstadoUsuario.INICIO
+        sesion.cita_actual_id = None
+        sesion.citas_confirmadas_ids = ()
+
+    def _saludar(self, numero: str, sesion: SesionUsuario, mensaje: str) -> str:
+        return (
+            "👋 ¡Hola! Soy *BOHI* 🤖✨, tu asistente virtual de citas médicas.%0A%0A"
+            "¿Te gustaría consultar tus próximas citas? Escribe *Cita* para comenzar. 🩺"
+        )
 
-        if not texto:
-            return ""
-
-        # Diccionario de reemplazo para tildes
-        replacements = {
-            'á': 'a',
-            'é': 'e',
-            'í': 'i',
-            'ó': 'o',
-            'ú': 'u',
-            'ü': 'u',
-            'Á': 'A',
-            'É': 'E',
-            'Í': 'I',
-            'Ó': 'O',
-            'Ú': 'U',
-            'Ü': 'U',
-            'ñ': 'n',
-            'Ñ': 'N'
-        }
-
-        # Reemplazar caracteres acentuados
-        for old, new in replacements.items():
-            texto = texto.replace(old, new)
-
-        # Remover emojis (conservando signos de puntuación)
-        texto_sin_emojis = texto.encode('ascii', 'ignore').decode('ascii')
-
-        # Conservar letras, números, espacios y signos de puntuación básicos
-        texto_limpio = re.sub(r'[^\w\s.,;:?¿!¡]', '', texto_sin_emojis)
-
-         # 1. Reemplazar múltiples espacios por uno solo
-        texto_limpio = re.sub(r'\s+', ' ', texto_limpio)
-
-        # Estandarizar formato de listas: "1. medico" → "1. medico" (espacio después del punto)
-        texto_limpio = re.sub(r'(\d+)\.\s*', r'\1. ', texto_limpio)
-
-        # Estandarizar dos puntos: "fecha:20250417" → "fecha: 20250417"
-        texto_limpio = re.sub(r':\s*', ': ', texto_limpio) 
-
-        # Convertir a minúsculas y quitar espacios extras
-        texto_normalizado = texto_limpio.lower().strip()
+    def _pedir_tipo_documento(self, numero: str, sesion: SesionUsuario, mensaje: str) -> str:
+        return (
+            "🆔 Para continuar, indícame el *tipo de documento* (solo las siglas):%0A%0A"
+            "- Cédula de Ciudadanía: *CC*%0A"
+            "- Tarjeta de Identidad: *TI*%0A"
+            "- Cédula de Extranjería: *CE*%0A"
+            "- Carné Diplomático: *CD*%0A"
+            "- Pasaporte: *PA*%0A"
+            "- Salvoconducto de Permanencia: *SC*%0A"
+            "- Permiso Especial de Permanencia: *PE*%0A"
+            "- Registro Civil: *RC*%0A"
+            "- Certificado de Nacido Vivo: *CN*%0A"
+            "- Adulto sin Identificación: *AS*%0A"
+            "- Menor sin Identificación: *MS*%0A"
+            "- Permiso por Protección Temporal: *PT*"
+        )
 
+    def _recibir_tipo_documento(self, numero: str, sesion: SesionUsuario, mensaje: str) -> str:
+        sesion.tipo_documento = mensaje.upper()
+        sesion.intentos = 0
+        return "🔢 Ahora, por favor escribe tu *número de documento* (sin puntos ni espacios):"
 
-        # Manejar caso especial de "escribiendo..."
-        if "escribiendo" in texto_normalizado:
-            return "escribiendo"
+    def _tipo_documento_invalido(self, numero: str, sesion: SesionUsuario, mensaje: str) -> str:
+        return self._registrar_intento_fallido(
+            sesion,
+            "❌ El tipo de documento que ingresaste no es válido. Por favor intenta de nuevo.",
+            "⏳ Has superado el número máximo de intentos. Intenta más tarde.",
+        )
 
-        return texto_normalizado
+    def _consultar_citas(self, numero: str, sesion: SesionUsuario, mensaje: str) -> str:
+        citas = buscar_cita(sesion.tipo_documento, mensaje)
+        sesion.documento = mensaje
+        sesion.intentos = 0
 
-    def manejar_mensaje_inicio(self, numero: str, mensaje: str):
-        """Maneja el estado INICIO de la conversación."""
-        sesion = self.estado_usuarios.get(numero, SesionUsuario())
-        
-        if mensaje.lower() == "hola":
-            respuesta = (
-                "👋 ¡Hola! Soy *BOHI* 🤖✨, tu asistente virtual de citas médicas.%0A%0A"
-                "¿Te gustaría consultar tus próximas citas? Escribe *Cita* para comenzar. 🩺"
-            )
-            whatsapp_driver.enviar_mensaje(numero, respuesta)
+        if not citas:
             sesion.estado = EstadoUsuario.INICIO
-            sesion.ultimo_mensaje = self.normalizar_mensaje(respuesta)
-        
-        elif mensaje.lower() == "cita" and sesion.estado == EstadoUsuario.INICIO:
-            respuesta = (
-                "🆔 Para continuar, indícame el *tipo de documento* (solo las siglas):%0A%0A"
-                "- Cédula de Ciudadanía: *CC*%0A"
-                "- Tarjeta de Identidad: *TI*%0A"
-                "- Cédula de Extranjería: *CE*%0A"
-                "- Carné Diplomático: *CD*%0A"
-                "- Pasaporte: *PA*%0A"
-                "- Salvoconducto de Permanencia: *SC*%0A"
-                "- Permiso Especial de Permanencia: *PE*%0A"
-                "- Registro Civil: *RC*%0A"
-                "- Certificado de Nacido Vivo: *CN*%0A"
-                "- Adulto sin Identificación: *AS*%0A"
-                "- Menor sin Identificación: *MS*%0A"
-                "- Permiso por Protección Temporal: *PT*"
-            )
-            whatsapp_driver.enviar_mensaje(numero, respuesta)
-            sesion.estado = EstadoUsuario.ESPERANDO_TIPO_DOCUMENTO
-            sesion.ultimo_mensaje = self.normalizar_mensaje(respuesta.replace("%0A", ""))
-        
-        self.estado_usuarios[numero] = sesion
-        self.guardar_estado()
-
-    def manejar_tipo_documento(self, numero: str, mensaje: str):
-        """Maneja la entrada del tipo de documento con verificación de repetición."""
-        
-        sesion = self.estado_usuarios.get(numero)
-        mensaje = self.normalizar_mensaje(mensaje)
-
-        if (
-            not sesion or
-            self.usuario_bloqueado(numero) or
-            mensaje.lower() in ["escribiendo", "escribiendo..."] or
-            (
-                sesion.ultimo_mensaje and 
-                mensaje.strip().lower() == sesion.ultimo_mensaje.lower()
+            return (
+                "⚠️ No se encontraron citas registradas con este documento.%0A"
+                "Si deseas intentarlo de nuevo, escribe *Cita*."
             )
-        ):
-            return
-
-        tipo_doc = mensaje.lower().strip()
-        if tipo_doc in ["cc", "ti", "ce", "cd", "pa", "sc", "pe", "rc", "cn", "as", "ms", "pt"]:
-            sesion.tipo_documento = tipo_doc.upper()
-            sesion.estado = EstadoUsuario.ESPERANDO_NUMERO_DOCUMENTO
-            sesion.intentos = 0
-            respuesta = "🔢 Ahora, por favor escribe tu *número de documento* (sin puntos ni espacios):"
-            whatsapp_driver.enviar_mensaje(numero, respuesta)
-            sesion.ultimo_mensaje = self.normalizar_mensaje(respuesta)
-
-        else:
-            # Solo contar como intento si es un mensaje nuevo
-            if not sesion.ultimo_mensaje or "error tipo documento" or "escribiendo" not in sesion.ultimo_mensaje.lower():
-                sesion.intentos += 1
-            
-            if sesion.intentos >= self.max_intentos:
-                sesion.bloqueado_hasta = datetime.now() + self.tiempo_bloqueo
-                respuesta = "⏳ Has superado el número máximo de intentos. Intenta más tarde."
-            else:
-                respuesta = "❌ El tipo de documento que ingresaste no es válido. Por favor intenta de nuevo."
-            
-            whatsapp_driver.enviar_mensaje(numero, respuesta)
-            sesion.ultimo_mensaje = self.normalizar_mensaje(respuesta)
 
-        self.estado_usuarios[numero] = sesion
-        self.guardar_estado()
-
-    def manejar_numero_documento(self, numero: str, mensaje: str):
-        """Maneja la entrada del número de documento con verificación de repetición."""
-        sesion = self.estado_usuarios.get(numero)
-        mensaje = self.normalizar_mensaje(mensaje)
-
-        if (
-            not sesion or
-            self.usuario_bloqueado(numero) or
-            mensaje.lower() in ["escribiendo", "escribiendo..."] or
-            (
-                sesion.ultimo_mensaje and 
-                mensaje.strip().lower() == sesion.ultimo_mensaje.lower() or
-                mensaje.lower().startswith(sesion.ultimo_mensaje.lower().split()[0]) 
-            )
-        ):
-            return
-        
-
-        if mensaje.isdigit():
-
-            citas = buscar_cita(sesion.tipo_documento, mensaje)
-            sesion.intentos = 0
-            
-            if citas:
-                sesion.citas_confirmadas = [cita for cita in citas if cita.confirmacionCita == "si"]
-                respuesta = "📅 *Estas son tus citas programadas:*%0A%0A"
-                for cita in citas:
-                    estado = "✅ Confirmada" if cita.confirmacionCita.lower() == "si" else "❌ No asistirás"
-                    respuesta += (
-                        f"👨‍⚕️ *Médico:* {cita.nombreMedico}%0A"
-                        f"🏥 *Especialidad:* {cita.especialidad}%0A"
-                        f"📅 *Fecha:* {cita.fechaCita}%0A"
-                        f"{estado}%0A%0A"
-                    )
-                respuesta += (
-                    "⚠️ ¿Deseas cancelar una cita? Escribe *cancelar cita*.%0A"
-                    "🩺 ¿Deseas consultar otra cita? Escribe *Cita*."
-                )
-                sesion.estado = EstadoUsuario.SELECIONANDO_OPCIONES
-            else:
-                respuesta = (
-                    "⚠️ No se encontraron citas registradas con este documento.%0A"
-                    "Si deseas intentarlo de nuevo, escribe *Cita*."
-                )
-                sesion.estado = EstadoUsuario.INICIO
-            
-            whatsapp_driver.enviar_mensaje(numero, respuesta)
-            sesion.ultimo_mensaje = self.normalizar_mensaje(respuesta.replace("%0A", ""))
-       
-        else:
-            # Solo contar como intento si es un mensaje nuevo
-            if not sesion.ultimo_mensaje or "error número documento" not in sesion.ultimo_mensaje.lower():
-                sesion.intentos += 1
-            
-            if sesion.intentos >= self.max_intentos:
-                sesion.bloqueado_hasta = datetime.now() + self.tiempo_bloqueo
-                respuesta = "⏳ Has excedido el número máximo de intentos. Por favor intenta nuevamente más tarde."
-            else:
-                respuesta = "❌ El número de documento ingresado no es válido. Inténtalo de nuevo (solo números)."
-            
-            whatsapp_driver.enviar_mensaje(numero, respuesta)
-            sesion.ultimo_mensaje = self.normalizar_mensaje(respuesta)
-            
-        self.estado_usuarios[numero] = sesion
-        self.guardar_estado()
-
-    def manejar_seleccion_opciones(self, numero: str, mensaje: str):
-        """Maneja la selección de cita cuando hay múltiples opciones."""
-        sesion = self.estado_usuarios.get(numero)
-        mensaje = self.normalizar_mensaje(mensaje)
-
-
-        if (
-            not sesion or
-            self.usuario_bloqueado(numero) or
-            mensaje.lower() in ["escribiendo", "escribiendo..."] or
-            (
-                sesion.ultimo_mensaje and 
-                mensaje.strip().lower() == sesion.ultimo_mensaje.lower() or 
-                mensaje.lower().startswith(sesion.ultimo_mensaje.lower().split()[0]) 
-            )
-        ):
-            return
-        
-
-        if mensaje.lower().strip() == "cancelar cita" and sesion.citas_confirmadas:
-            respuesta = "⚠️ ¿Cuál de tus citas confirmadas deseas cancelar?%0A%0A"
-            for i, cita in enumerate(sesion.citas_confirmadas):
-                respuesta += (
-                    f"{i+1}. 👨‍⚕️ *Médico:* {cita.nombreMedico}%0A"
-                    f"   🏥 *Especialidad:* {cita.especialidad}%0A"
-                    f"   📅 *Fecha:* {cita.fechaCita}%0A%0A"
-                )
+        sesion.citas_confirmadas_ids = tuple(cita.id for cita in citas if cita.confirmacionCita == "si")
+        respuesta = "📅 *Estas son tus citas programadas:*%0A%0A"
+        for cita in citas:
+            estado = "✅ Confirmada" if cita.confirmacionCita.lower() == "si" else "❌ No asistirás"
             respuesta += (
-                "✏️ Escribe el número de la cita que deseas cancelar.%0A"
-                "ℹ️ Para salir de este proceso, escribe *terminar*."
+                f"👨‍⚕️ *Médico:* {cita.nombreMedico}%0A"
+                f"🏥 *Especialidad:* {cita.especialidad}%0A"
+                f"📅 *Fecha:* {cita.fechaCita}%0A"
+                f"{estado}%0A%0A"
             )
+        respuesta += (
+            "⚠️ ¿Deseas cancelar una cita? Escribe *cancelar cita*.%0A"
+            "🩺 ¿Deseas consultar otra cita? Escribe *Cita*."
+        )
+        sesion.estado = EstadoUsuario.SELECIONANDO_OPCIONES
+        return respuesta
 
-            whatsapp_driver.enviar_mensaje(numero, respuesta)
-            sesion.ultimo_mensaje = self.normalizar_mensaje(respuesta.replace("%0A", ""))
-            sesion.estado = EstadoUsuario.CANCELANDO_CITA
-
-        elif mensaje.lower().strip() == "cita":
-            sesion.estado = EstadoUsuario.INICIO
-            sesion.cita_actual = None
-            sesion.citas_confirmadas = []
-
-        else:
-            return
-        
-        
-        self.estado_usuarios[numero] = sesion
-        self.guardar_estado()
-
-    def manejar_cancelacion_cita(self, numero: str, mensaje: str):
-        sesion = self.estado_usuarios.get(numero)
-        mensaje = self.normalizar_mensaje(mensaje)
+    def _numero_documento_invalido(self, numero: str, sesion: SesionUsuario, mensaje: str) -> str:
+        return self._registrar_intento_fallido(
+            sesion, "❌ El número de documento ingresado no es válido. Inténtalo de nuevo (solo números)."
+        )
 
+    def _listar_citas_confirmadas(self, numero: str, sesion: SesionUsuario, mensaje: str) -> Optional[str]:
+        citas_confirmadas = self._citas_de_sesion(sesion, sesion.citas_confirmadas_ids)
+        if not citas_confirmadas:
+            return None
 
-        if (
-            not sesion or
-            self.usuario_bloqueado(numero) or
-            mensaje.lower() in ["escribiendo", "escribiendo..."] or
-            (
-                sesion.ultimo_mensaje and 
-                mensaje.strip().lower() == sesion.ultimo_mensaje.lower() or 
-                mensaje.lower().startswith(sesion.ultimo_mensaje.lower().split()[0]) 
+        respuesta = "⚠️ ¿Cuál de tus citas confirmadas deseas cancelar?%0A%0A"
+        for i, cita in enumerate(citas_confirmadas):
+            respuesta += (
+                f"{i+1}. 👨‍⚕️ *Médico:* {cita.nombreMedico}%0A"
+                f"   🏥 *Especialidad:* {cita.especialidad}%0A"
+                f"   📅 *Fecha:* {cita.fechaCita}%0A%0A"
             )
-        ):
-            return
-        
-        if mensaje.lower().strip() == "terminar":
-            respuesta = "ℹ️ Has terminado la cancelacion de citas. Si deseas otra consulta, escribe: *Cita*."
-            whatsapp_driver.enviar_mensaje(numero, respuesta)
-            sesion.ultimo_mensaje = self.normalizar_mensaje(respuesta.replace("%0A", ""))
-            sesion.estado = EstadoUsuario.INICIO
-            sesion.cita_actual = None
-            sesion.citas_confirmadas = []
-            self.estado_usuarios[numero] = sesion
-            self.guardar_estado()
-            return
-        
-        elif mensaje.isdigit():
-            seleccion = int(mensaje)
-            if 1 <= seleccion <= len(sesion.citas_confirmadas):
-                sesion.cita_actual = sesion.citas_confirmadas[seleccion - 1]
-                respuesta = self._crear_mensaje_cita(sesion.cita_actual)
+        respuesta += (
+            "✏️ Escribe el número de la cita que deseas cancelar.%0A"
+            "ℹ️ Para salir de este proceso, escribe *terminar*."
+        )
+        sesion.estado = EstadoUsuario.CANCELANDO_CITA
+        return respuesta
+
+    def _terminar_cancelacion(self, numero: str, sesion: SesionUsuario, mensaje: str) -> str:
+        self._reiniciar(numero, sesion, mensaje)
+        return "ℹ️ Has terminado la cancelacion de citas. Si deseas otra consulta, escribe: *Cita*."
+
+    def _seleccionar_cita(self, numero: str, sesion: SesionUsuario, mensaje: str) -> str:
+        seleccion = int(mensaje)
+        total = len(sesion.citas_confirmadas_ids)
+        if 1 <= seleccion <= total:
+            cita_id = sesion.citas_confirmadas_ids[seleccion - 1]
+            citas = self._citas_de_sesion(sesion, (cita_id,))
+            if citas:
+                sesion.cita_actual_id = cita_id
                 sesion.estado = EstadoUsuario.CONFIRMANDO_CANCELACION
-            else:
-                if not sesion.ultimo_mensaje or "error número documento" not in sesion.ultimo_mensaje.lower():
-                    sesion.intentos += 1
-                
-                if sesion.intentos >= self.max_intentos:
-                    sesion.bloqueado_hasta = datetime.now() + self.tiempo_bloqueo
-                    respuesta = "⏳ Has excedido el número máximo de intentos. Por favor intenta nuevamente más tarde."
-                else:
-                    respuesta = f"❌ Selección inválida. Escribe un número entre 1 y {len(sesion.citas_confirmadas):}."
-                
-        else:
-            if not sesion.ultimo_mensaje or "error número documento" not in sesion.ultimo_mensaje.lower():
-                sesion.intentos += 1
-            
-            if sesion.intentos >= self.max_intentos:
-                sesion.bloqueado_hasta = datetime.now() + self.tiempo_bloqueo
-                respuesta = "⏳ Has excedido el número máximo de intentos. Por favor intenta nuevamente más tarde."
-            else:
-                respuesta = "❌ Por favor, escribe solo el número de la cita que deseas confirmar."
-        
-        whatsapp_driver.enviar_mensaje(numero, respuesta)
-        sesion.ultimo_mensaje = self.normalizar_mensaje(respuesta.replace("%0A", ""))
-        self.estado_usuarios[numero] = sesion
-        self.guardar_estado()
-    
-    def manejar_confirmacion_cancelacion(self, numero: str, mensaje: str):
-
-        sesion = self.estado_usuarios.get(numero)
-        mensaje = self.normalizar_mensaje(mensaje)
-
+                return self._crear_mensaje_cita(citas[0])
+        return self._registrar_intento_fallido(
+            sesion, f"❌ Selección inválida. Escribe un número entre 1 y {total}."
+        )
 
-        if (
-            not sesion or
-            self.usuario_bloqueado(numero) or
-            mensaje.lower() in ["escribiendo", "escribiendo..."] or
-            (
-                sesion.ultimo_mensaje and 
-                mensaje.strip().lower() == sesion.ultimo_mensaje.lower() or 
-                mensaje.lower().startswith(sesion.ultimo_mensaje.lower().split()[0]) 
-            )
-        ):
-            return
-        
-        if mensaje.lower().strip() == "terminar":
-            respuesta = "ℹ️ Has terminado la cancelacion de citas. Si deseas otra consulta, escribe: *Cita*."
-            whatsapp_driver.enviar_mensaje(numero, respuesta)
-            sesion.ultimo_mensaje = self.normalizar_mensaje(respuesta.replace("%0A", ""))
-            sesion.estado = EstadoUsuario.INICIO
-            sesion.cita_actual = None
-            sesion.citas_confirmadas = []
-            self.estado_usuarios[numero] = sesion
-            self.guardar_estado()
-            return
+    def _seleccion_no_numerica(self, numero: str, sesion: SesionUsuario, mensaje: str) -> str:
+        return self._registrar_intento_fallido(
+            sesion, "❌ Por favor, escribe solo el número de la cita que deseas confirmar."
+        )
 
-        if mensaje == "si":
-            exito = actualizar_confirmacion_cita(sesion.cita_actual.id, "no")
-            if exito:
-                respuesta = "✅ Tu cita ha sido *cancelada con éxito*. Si deseas hacer otra consulta, escribe: *Cita*."
-            else:
-                respuesta = "❌ Ocurrió un error al cancelar la cita. Intenta más tarde."
-            sesion.estado = EstadoUsuario.INICIO
-            sesion.cita_actual = None
-            sesion.citas_confirmadas = []
-        elif mensaje == "no":
-            respuesta = "📅 Perfecto. Tu cita *no ha sido cancelada*. Si deseas otra consulta, escribe: *Cita*."
-            sesion.estado = EstadoUsuario.INICIO
-            sesion.cita_actual = None
-            sesion.citas_confirmadas = []
-        else:
-            if not sesion.ultimo_mensaje or "error número documento" not in sesion.ultimo_mensaje.lower():
-                sesion.intentos += 1
-            
-            if sesion.intentos >= self.max_intentos:
-                sesion.bloqueado_hasta = datetime.now() + self.tiempo_bloqueo
-                respuesta = "⏳ Has excedido el número máximo de intentos. Por favor intenta nuevamente más tarde."
-            else:
-                respuesta = "❓ Por favor responde con *si* o *no* para confirmar la cancelacion."
+    def _cancelar_cita(self, numero: str, sesion: SesionUsuario, mensaje: str) -> str:
+        exito = actualizar_confirmacion_cita(sesion.cita_actual_id, "no")
+        self._reiniciar(numero, sesion, mensaje)
+        if exito:
+            return "✅ Tu cita ha sido *cancelada con éxito*. Si deseas hacer otra consulta, escribe: *Cita*."
+        return "❌ Ocurrió un error al cancelar la cita. Intenta más tarde."
 
-        whatsapp_driver.enviar_mensaje(numero, respuesta)
-        sesion.ultimo_mensaje = self.normalizar_mensaje(respuesta.replace("%0A", ""))
+    def _mantener_cita(self, numero: str, sesion: SesionUsuario, mensaje: str) -> str:
+        self._reiniciar(numero, sesion, mensaje)
+        return "📅 Perfecto. Tu cita *no ha sido cancelada*. Si deseas otra consulta, escribe: *Cita*."
 
-        self.estado_usuarios[numero] = sesion
-        self.guardar_estado()
+    def _confirmacion_invalida(self, numero: str, sesion: SesionUsuario, mensaje: str) -> str:
+        return self._registrar_intento_fallido(
+            sesion, "❓ Por favor responde con *si* o *no* para confirmar la cancelacion."
+        )
 
+    def _citas_de_sesion(self, sesion: SesionUsuario, ids: Tuple[int, ...]) -> List[Cita]:
+        """Recupera las citas de ``ids`` a partir del documento de la sesión."""
+        if not ids or not sesion.tipo_documento or not sesion.documento:
+            return []
+        por_id = {cita.id: cita for cita in buscar_cita(sesion.tipo_documento, sesion.documento) or []}
+        return [por_id[cita_id] for cita_id in ids if cita_id in por_id]
 
     def _crear_mensaje_cita(self, cita: Cita) -> str:
 
@@ -517,86 +453,235 @@ class OHIBot:
             f"ℹ️ Si deseas salir, escribe *terminar*."
         )
 
-    def procesar_mensaje(self, numero: str, mensaje: str):
-        """Procesa el mensaje según el estado actual del usuario."""
+    def procesar_mensaje(self, numero: str, mensaje: str, id_mensaje: Optional[str] = None):
+        """Procesa el mensaje según el estado actual del usuario.
+
+        El motor aplica las guardias y la transición; la sesión se guarda una
+        sola vez por mensaje, después de encolar la respuesta. Si se conoce el
+        ``data-id`` del mensaje, uno ya visto se descarta sin tocar la sesión.
+        """
         if not numero or not mensaje:
             return
+        with METRICA_PROCESAR.medir():
+            self._procesar_mensaje(numero, mensaje, id_mensaje)
+
+    def _procesar_mensaje(self, numero: str, mensaje: str, id_mensaje: Optional[str]):
+        with self.estado_usuarios.bloqueo(numero):
+            self._procesar_con_sesion(numero, mensaje, id_mensaje)
 
+    def _procesar_con_sesion(self, numero: str, mensaje: str, id_mensaje: Optional[str]):
         sesion = self.estado_usuarios.get(numero, SesionUsuario())
+        if id_mensaje is not None and not sesion.ids_vistos.agregar(id_mensaje):
+            MENSAJES_DUPLICADOS.incrementar()
+            return
+        MENSAJES_ENTRANTES.incrementar()
         sesion.ultima_interaccion = datetime.now()
-    
 
-        if sesion.estado == EstadoUsuario.INICIO:
-            self.manejar_mensaje_inicio(numero, mensaje)
-        elif sesion.estado == EstadoUsuario.ESPERANDO_TIPO_DOCUMENTO:
-            self.manejar_tipo_documento(numero, mensaje)
-        elif sesion.estado == EstadoUsuario.ESPERANDO_NUMERO_DOCUMENTO:
-            self.manejar_numero_documento(numero, mensaje)
-        elif sesion.estado == EstadoUsuario.SELECIONANDO_OPCIONES:
-            self.manejar_seleccion_opciones(numero, mensaje)
-        elif sesion.estado == EstadoUsuario.CANCELANDO_CITA:
-            self.manejar_cancelacion_cita(numero, mensaje)
-        elif sesion.estado == EstadoUsuario.CONFIRMANDO_CANCELACION:
-            self.manejar_confirmacion_cancelacion(numero, mensaje)
-        
+        respuesta = self.motor.ejecutar(numero, sesion, self.normalizar_mensaje(mensaje))
+        if respuesta:
+            self.transporte.encolar(numero, respuesta)
+            sesion.ultimo_mensaje = self.normalizar_mensaje(respuesta.replace("%0A", ""))
+
         self.estado_usuarios[numero] = sesion
-        self.guardar_estado()
+        self.guardar_estado(numero)
+
+    def enviar_recordatorios(self, programada: Optional[datetime] = None) -> int:
+        """Campaña de recordatorios de las citas próximas que aún no constan como enviados.
+
+        La fecha de las citas se calcula desde el turno ``programada`` del
+        planificador (por defecto, ahora): un turno atrasado recuerda las citas
+        que le tocaban, no las de tres días después de ponerse al día.
+
+        Cada envío espera su turno en un ``RitmoAdaptativo`` y se anota en
+        ``registro_envios`` en cuanto se confirma. El cursor de la campaña marca
+        la última cita con todo lo anterior resuelto, así que una ejecución
+        interrumpida retoma en la siguiente sin enviar. Si algo queda sin enviar
+        se lanza un error para que el planificador reintente; un recordatorio
+        que falla en ``RECORDATORIOS_MAX_INTENTOS`` ejecuciones se abandona y
+        cuenta como resuelto.
+        """
+        if not self._esperar_conexion_whatsapp():
+            raise ConnectionError("WhatsApp no está conectado")
+
+        fecha = fecha_citas_proximas(desde=programada)
+        if fecha < datetime.now().strftime("%Y-%m-%d"):
+            logger.warning(f"Recordatorios del {fecha} omitidos: las citas ya pasaron")
+            return 0
+        desde = self.cursor_campanas.leer(self.campana_recordatorios, fecha)
+        if desde:
+            logger.info(f"Retomando los recordatorios del {fecha} después de la cita {desde}")
+
+        def guardar_cursor(ultimo_id: int) -> None:
+            self.cursor_campanas.avanzar(self.campana_recordatorios, fecha, ultimo_id)
+
+        # Se envía a medida que llegan las páginas de la consulta
+        citas = iterar_citas_proximas(desde_id=desde, fecha=fecha)
+        if self.pool:
+            total, fallidos = self._enviar_recordatorios_en_pool(list(citas), guardar_cursor)
+        else:
+            total, fallidos = self._enviar_recordatorios_en_orden(citas, guardar_cursor)
+
+        if fallidos:
+            raise RuntimeError(f"{fallidos} de {total} recordatorios sin enviar")
+        if not total:
+            logger.info("No hay recordatorios pendientes")
+        self.registro_envios.purgar()
+        if self.transporte.bandeja_salida:
+            self.transporte.bandeja_salida.purgar()
+        RECORDATORIOS_ULTIMA_EJECUCION.fijar(time.time())
+        return total
+
+    def _enviar_recordatorios_en_orden(self, citas: Iterable[Cita], guardar_cursor: Callable[[int], None]) -> Tuple[int, int]:
+        """Envía por el transporte principal. Devuelve (intentados, fallidos)."""
+        ritmo = self._nuevo_ritmo()
+        total = fallidos = 0
+        ultimo_id = None
+        try:
+            for cita in citas:
+                if self._recordatorio_pendiente(cita):
+                    total += 1
+                    if not self._enviar_con_ritmo(ritmo, cita, self._enviar_mensaje_seguro, self._esperar_conexion_whatsapp):
+                        fallidos += 1
+                    elif not fallidos:
+                        guardar_cursor(cita.id)
+                if not fallidos:
+                    ultimo_id = cita.id
+        finally:
+            if ultimo_id is not None:
+                guardar_cursor(ultimo_id)
+        return total, fallidos
+
+    def _recordatorio_pendiente(self, cita: Cita) -> bool:
+        # Cada proceso envía solo los recordatorios de su shard
+        if not self.es_de_este_shard(f"+57{cita.telefonoPaciente}"):
+            return False
+        if self.registro_envios.enviado(cita.id, TIPO_RECORDATORIO):
+            RECORDATORIOS_YA_ENVIADOS.incrementar()
+            return False
+        # Abandonado en una ejecución anterior
+        return self.registro_envios.intentos(cita.id, TIPO_RECORDATORIO) < RECORDATORIOS_MAX_INTENTOS
+
+    def _anotar_recordatorio(self, cita: Cita, enviado: bool) -> bool:
+        """Registra el resultado de un recordatorio en la bitácora y las métricas.
+
+        Devuelve si quedó resuelto: enviado o abandonado por agotar sus intentos.
+        """
+        if enviado:
+            self.registro_envios.registrar(cita.id, TIPO_RECORDATORIO)
+            RECORDATORIOS_ENVIADOS.incrementar()
+            return True
+        RECORDATORIOS_FALLIDOS.incrementar()
+        intentos = self.registro_envios.anotar_fallo(cita.id, TIPO_RECORDATORIO)
+        if intentos >= RECORDATORIOS_MAX_INTENTOS:
+            RECORDATORIOS_ABANDONADOS.incrementar()
+            logger.error(f"Recordatorio de la cita {cita.id} ({cita.nombrePaciente}) abandonado tras {intentos} intentos")
+            return True
+        logger.error(f"No se pudo enviar recordatorio a {cita.nombrePaciente} (intento {intentos})")
+        return False
 
-    def enviar_recordatorios(self):
-        while True:
-            try:
-                # Esperar conexión estable
-                if not self._esperar_conexion_whatsapp():
-                    time.sleep(60)
-                    continue
-
-                citas = obtener_citas_proximas()
-                if not citas:
-                    logger.info("No hay citas próximas para recordatorios")
-                    time.sleep(86400)
-                    continue
-
-                for cita in citas:
-                    if cita.confirmacionCita != "si":
-                        continue
-
-                    mensaje = self._crear_mensaje_recordatorio(cita)
-                    numero = f"+57{cita.telefonoPaciente}"
-                    
-                    if not self._enviar_mensaje_seguro(numero, mensaje):
-                        logger.error(f"No se pudo enviar recordatorio a {cita.nombrePaciente}")
-                        # Reintentar conexión si falla
-                        if not self._esperar_conexion_whatsapp():
-                            break  # Salir del bucle de citas si no se puede reconectar
-
-                    time.sleep(2)  # Pausa entre mensajes
-
-                time.sleep(86400)  # Esperar 24 horas
-
-            except Exception as e:
-                logger.error(f"Error crítico en recordatorios: {e}", exc_info=True)
-                time.sleep(3600)  # Esperar 1 hora antes de reintentar
+    def _nuevo_ritmo(self) -> RitmoAdaptativo:
+        return RitmoAdaptativo(
+            RECORDATORIOS_TASA, RECORDATORIOS_TASA_MIN, RECORDATORIOS_TASA_MAX, RECORDATORIOS_LATENCIA_OBJETIVO
+        )
+
+    def _enviar_con_ritmo(
+        self,
+        ritmo: RitmoAdaptativo,
+        cita: Cita,
+        enviar: Callable[[str, str, str], bool],
+        reconectar: Callable[[], bool],
+    ) -> bool:
+        """Envía un recordatorio cuando ``ritmo`` lo permite y ajusta la tasa con el resultado.
+
+        Tras varios fallos seguidos (WhatsApp limitando o la sesión caída) hace
+        una pausa creciente; si después no hay conexión lanza ConnectionError.
+        Devuelve si el recordatorio quedó resuelto (ver ``_anotar_recordatorio``).
+        """
+        ritmo.tomar()
+        inicio = time.monotonic()
+        # La clave evita repetir en la bandeja de salida un recordatorio ya entregado
+        enviado = enviar(f"+57{cita.telefonoPaciente}", self._crear_mensaje_recordatorio(cita), f"{TIPO_RECORDATORIO}:{cita.id}")
+        if enviado:
+            ritmo.exito(time.monotonic() - inicio)
+        else:
+            ritmo.fallo()
+        RECORDATORIOS_TASA_ACTUAL.fijar(ritmo.tasa)
+
+        if ritmo.limitado:
+            pausa = ritmo.pausa()
+            RECORDATORIOS_PAUSAS.incrementar()
+            logger.warning(f"{ritmo.fallos_limite} recordatorios fallidos seguidos; pausa de {pausa:.0f} s")
+            time.sleep(pausa)
+        # Un fallo con la sesión caída no es culpa del destinatario: no cuenta como intento
+        if not enviado and not reconectar():
+            RECORDATORIOS_FALLIDOS.incrementar()
+            raise ConnectionError("Se perdió la conexión con WhatsApp durante los recordatorios")
+        return self._anotar_recordatorio(cita, enviado)
+
+    def _enviar_recordatorios_en_pool(self, citas: List[Cita], guardar_cursor: Callable[[int], None]) -> Tuple[int, int]:
+        """Reparte los recordatorios entre las sesiones del pool y los envía en paralelo.
+
+        Cada sesión lleva su propio ritmo. El cursor avanza al final hasta la
+        cita anterior al primer fallo. Devuelve (intentados, fallidos).
+        """
+        self.pool.verificar_salud()
+        por_sesion = defaultdict(list)
+        for cita in citas:
+            if self._recordatorio_pendiente(cita):
+                por_sesion[self.pool.indice_para(f"+57{cita.telefonoPaciente}")].append(cita)
+        total = sum(len(lote) for lote in por_sesion.values())
+
+        with ThreadPoolExecutor(max_workers=len(por_sesion) or 1) as executor:
+            fallidas = set().union(*executor.map(lambda lote: self._enviar_lote_sesion(*lote), por_sesion.items()))
+        logger.info(f"Recordatorios resueltos: {total - len(fallidas)}/{total} en {len(por_sesion)} sesiones")
+
+        primera_fallida = min(fallidas, default=None)
+        resueltas = [cita.id for cita in citas if primera_fallida is None or cita.id < primera_fallida]
+        if resueltas:
+            guardar_cursor(max(resueltas))
+        return total, len(fallidas)
+
+    def _enviar_lote_sesion(self, indice: int, lote: List[Cita]) -> Set[int]:
+        """Envía un lote de recordatorios por una sola sesión del pool. Devuelve los ids sin enviar."""
+        fallidas = {cita.id for cita in lote}
+        ritmo = self._nuevo_ritmo()
+        try:
+            with self.pool.usar(indice) as driver:
+                for cita in lote:
+                    enviar = partial(self._enviar_por_sesion, driver)
+                    if self._enviar_con_ritmo(ritmo, cita, enviar, lambda: driver.iniciar_driver() is not None):
+                        fallidas.discard(cita.id)
+        except Exception as e:
+            logger.error(f"Sesión {indice} del pool falló con {len(fallidas)}/{len(lote)} recordatorios sin enviar: {e}")
+        return fallidas
+
+    def _enviar_por_sesion(self, driver: WhatsAppDriver, numero: str, mensaje: str, clave: Optional[str]) -> bool:
+        """Envío directo por una sesión del pool, registrado en la bandeja de salida."""
+        bandeja = self.transporte.bandeja_salida
+        if bandeja is None:
+            return driver.enviar_mensaje(numero, mensaje) in ENVIADOS
+        return bandeja.enviar(driver.enviar_mensaje, numero, mensaje, PRIORIDAD_RECORDATORIO, clave)
 
     def _esperar_conexion_whatsapp(self, timeout_min=5) -> bool:
         """Espera hasta que WhatsApp esté conectado."""
         timeout = time.time() + 60 * timeout_min
         while time.time() < timeout:
-            if whatsapp_driver.iniciar_driver():
+            if self.transporte.ejecutar(lambda driver: driver.iniciar_driver() is not None).result():
                 return True
             time.sleep(10)
         return False
 
-    def _enviar_mensaje_seguro(self, numero: str, mensaje: str) -> bool:
-        """Intenta enviar mensaje con múltiples reintentos."""
-        max_intentos = 3
-        for intento in range(max_intentos):
-            try:
-                if whatsapp_driver.enviar_mensaje(numero, mensaje):
-                    return True
-            except Exception as e:
-                logger.warning(f"Intento {intento + 1} fallido: {str(e)}")
-                time.sleep(5)
-        return False
+    def _enviar_mensaje_seguro(self, numero: str, mensaje: str, clave: Optional[str] = None) -> bool:
+        """Encola el mensaje con prioridad de recordatorio y espera su resultado.
+
+        Los reintentos por sesión inválida o errores de página ya los hace
+        ``WhatsAppDriver.enviar_mensaje`` dentro del despachador.
+        """
+        try:
+            return self.transporte.encolar(numero, mensaje, PRIORIDAD_RECORDATORIO, clave).result()
+        except Exception as e:
+            logger.warning(f"Envío de recordatorio fallido: {str(e)}")
+            return False
 
     def _crear_mensaje_recordatorio(self, cita) -> str:
         """Genera el texto del mensaje de recordatorio."""
@@ -609,28 +694,78 @@ class OHIBot:
             f"⏰ Te recomendamos llegar 15 minutos antes."
         )
         
+    def arrancar_servicios(self):
+        """Transporte, endpoint de métricas y planificador de recordatorios."""
+        self.transporte.iniciar()
+        if self.conversaciones:
+            self.conversaciones.iniciar()
+        if METRICAS_PUERTO:
+            try:
+                self.servidor_metricas = iniciar_servidor(METRICAS_PUERTO, METRICAS_HOST)
+                logger.info(f"Métricas en http://{METRICAS_HOST}:{METRICAS_PUERTO}/metrics")
+            except OSError as e:
+                logger.error(f"No se pudo abrir el puerto de métricas {METRICAS_PUERTO}: {e}")
+
+        # Hilo del planificador de recordatorios
+        # Un trabajo por shard: todos los procesos comparten la tabla del planificador
+        self.planificador.registrar(self.campana_recordatorios, self.enviar_recordatorios, RECORDATORIOS_HORA)
+        threading.Thread(
+            target=self.planificador.ejecutar,
+            name="planificador",
+            daemon=True
+        ).start()
+
+    def detener_servicios(self):
+        if self.servidor_metricas:
+            self.servidor_metricas.shutdown()
+        if self.conversaciones:
+            self.conversaciones.detener()
+        # Después de las conversaciones, que pueden encolar cancelaciones
+        detener_cola_correo()
+        self.planificador.detener()
+        self.transporte.detener()
+        if self.transporte.bandeja_salida:
+            self.transporte.bandeja_salida.cerrar()
+        whatsapp_driver.cerrar()
+        if self.pool:
+            self.pool.cerrar()
+        self.estado_usuarios.cerrar()
+        self.planificador.cerrar()
+        self.registro_envios.cerrar()
+        self.cursor_campanas.cerrar()
+
+    def atender_bandeja(self) -> None:
+        """Una vuelta del bucle principal: lee la bandeja, reparte los mensajes y espera los siguientes."""
+        self.obtener_mensajes_nuevos()
+        while self.bandeja.total_pendientes:
+            numero, mensaje, id_mensaje = self.bandeja.siguiente()
+            if self.conversaciones:
+                self.conversaciones.enviar(numero, mensaje, id_mensaje)
+            else:
+                self.procesar_mensaje(numero, mensaje, id_mensaje)
+        if time.monotonic() - self._ultimo_desalojo > 60:
+            self.desalojar_sesiones_inactivas()
+        if INGESTA_MODO == "observer":
+            # Las respuestas de los trabajadores esperan detrás de esta espera en el despachador
+            ocupado = self.conversaciones is not None and self.conversaciones.pendientes
+            self.esperar_mensajes_nuevos(ESPERA_CON_CONVERSACIONES if ocupado else 5)
+        else:
+            time.sleep(5)
+
     def iniciar(self):
         """Inicia el bot principal."""
         try:
-            # Hilo para recordatorios
-            threading.Thread(
-                target=self.enviar_recordatorios,
-                daemon=True
-            ).start()
+            self.arrancar_servicios()
 
             # Bucle principal
             logger.info("OHIBot iniciado. Esperando mensajes...")
             while True:
-                numero, mensaje = self.obtener_ultimo_mensaje()
-                if numero and mensaje:
-                    self.procesar_mensaje(numero, mensaje)
-                time.sleep(5)
+                self.atender_bandeja()
 
         except KeyboardInterrupt:
             logger.info("Deteniendo OHIBot...")
         finally:
-            whatsapp_driver.cerrar()
-            self.guardar_estado()
+            self.detener_servicios()
 
 if __name__ == "__main__":
     bot = OHIBot()
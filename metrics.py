@@ -0,0 +1,240 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histograma:
+    """Histograma de latencias (segundos) con buckets fijos, seguro entre hilos."""
+
+    def __init__(self, buckets: Sequence[float] = BUCKETS_LATENCIA):
+        self.buckets = tuple(sorted(buckets))
+        self._conteos = [0] * (len(self.buckets) + 1)
+        self.total = 0
+        self.suma = 0.0
+        self.maximo = 0.0
+        self._lock = threading.Lock()
+
+    def observar(self, valor: float) -> None:
+        with self._lock:
+            self._conteos[bisect.bisect_left(self.buckets, valor)] += 1
+            self.total += 1
+            self.suma += valor
+            if valor > self.maximo:
+                self.maximo = valor
+
+    @contextmanager
+    def medir(self):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(time.perf_counter() - inicio)
+
+    def percentil(self, q: float) -> float:
+        """Cota superior del bucket que contiene el percentil ``q`` (0-1)."""
+        with self._lock:
+            if not self.total:
+                return 0.0
+            objetivo = q * self.total
+            acumulado = 0
+            for i, conteo in enumerate(self._conteos):
+                acumulado += conteo
+                if acumulado >= objetivo:
+                    return self.buckets[i] if i < len(self.buckets) else self.maximo
+            return self.maximo
+
+    def instantanea(self) -> Tuple[Tuple[float, ...], List[int], float, int]:
+        """Buckets, conteos por bucket (el último es el desbordamiento), suma y total."""
+        with self._lock:
+            return self.buckets, list(self._conteos), self.suma, self.total
+
+    def resumen(self) -> Dict[str, float]:
+        return {
+            "total": self.total,
+            "promedio": self.suma / self.total if self.total else 0.0,
+            "p50": self.percentil(0.5),
+            "p99": self.percentil(0.99),
+            "maximo": self.maximo,
+        }
+
+
+class Contador:
+    """Valor que solo crece (eventos, errores, reintentos), seguro entre hilos.
+
+    Con ``funcion`` se lee al exponerlo de un total que ya lleva otro objeto
+    (p. ej. los aciertos de un ``lru_cache``).
+    """
+
+    def __init__(self, funcion: Optional[Callable[[], float]] = None):
+        self.valor = 0.0
+        self.funcion = funcion
+        self._lock = threading.Lock()
+
+    def incrementar(self, cantidad: float = 1) -> None:
+        with self._lock:
+            self.valor += cantidad
+
+    def leer(self) -> float:
+        if self.funcion is None:
+            return self.valor
+        try:
+            return float(self.funcion())
+        except Exception:
+            return math.nan
+
+
+class Medidor:
+    """Valor que sube y baja. Con ``funcion`` se calcula al exponerlo."""
+
+    def __init__(self, funcion: Optional[Callable[[], float]] = None):
+        self.valor = 0.0
+        self.funcion = funcion
+        self._lock = threading.Lock()
+
+    def fijar(self, valor: float) -> None:
+        with self._lock:
+            self.valor = valor
+
+    def incrementar(self, cantidad: float = 1) -> None:
+        with self._lock:
+            self.valor += cantidad
+
+    def decrementar(self, cantidad: float = 1) -> None:
+        self.incrementar(-cantidad)
+
+    def leer(self) -> float:
+        if self.funcion is None:
+            return self.valor
+        try:
+            return float(self.funcion())
+        except Exception:
+            return math.nan
+
+
+Etiquetas = Tuple[Tuple[str, str], ...]
+
+
+class RegistroMetricas:
+    """Métricas del proceso por nombre y etiquetas, exportables a Prometheus.
+
+    ``contador``, ``medidor`` e ``histograma`` devuelven siempre la misma
+    instancia para el mismo nombre y etiquetas, así que los módulos pueden
+    pedirlas al importarse y actualizarlas sin volver a consultar el registro.
+    """
+
+    def __init__(self):
+        self._familias: Dict[str, Tuple[str, str, Dict[Etiquetas, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def _obtener(self, tipo: str, nombre: str, ayuda: str, etiquetas: Dict[str, Any], crear: Callable[[], Any]):
+        clave = tuple(sorted((k, str(v)) for k, v in etiquetas.items()))
+        with self._lock:
+            familia = self._familias.get(nombre)
+            if familia is None:
+                familia = self._familias[nombre] = (tipo, ayuda, {})
+            elif familia[0] != tipo:
+                raise ValueError(f"La métrica {nombre} ya está registrada como {familia[0]}")
+            metrica = familia[2].get(clave)
+            if metrica is None:
+                metrica = familia[2][clave] = crear()
+            return metrica
+
+    def contador(self, nombre: str, ayuda: str, funcion: Optional[Callable[[], float]] = None, **etiquetas) -> Contador:
+        contador = self._obtener("counter", nombre, ayuda, etiquetas, Contador)
+        if funcion is not None:
+            contador.funcion = funcion
+        return contador
+
+    def medidor(self, nombre: str, ayuda: str, funcion: Optional[Callable[[], float]] = None, **etiquetas) -> Medidor:
+        medidor = self._obtener("gauge", nombre, ayuda, etiquetas, Medidor)
+        if funcion is not None:
+            medidor.funcion = funcion
+        return medidor
+
+    def histograma(self, nombre: str, ayuda: str, buckets: Sequence[float] = BUCKETS_LATENCIA, **etiquetas) -> Histograma:
+        return self._obtener("histogram", nombre, ayuda, etiquetas, lambda: Histograma(buckets))
+
+    def exponer(self) -> str:
+        """Todas las métricas en el formato de texto de Prometheus (0.0.4)."""
+        with self._lock:
+            familias = [(nombre, tipo, ayuda, list(metricas.items()))
+                        for nombre, (tipo, ayuda, metricas) in sorted(self._familias.items())]
+        lineas = []
+        for nombre, tipo, ayuda, metricas in familias:
+            lineas.append(f"# HELP {nombre} {ayuda}")
+            lineas.append(f"# TYPE {nombre} {tipo}")
+            for etiquetas, metrica in metricas:
+                if tipo == "histogram":
+                    lineas.extend(_lineas_histograma(nombre, etiquetas, metrica))
+                else:
+                    valor = metrica.leer()
+                    lineas.append(f"{nombre}{_formatear_etiquetas(etiquetas)} {_formatear_numero(valor)}")
+        return "\n".join(lineas) + "\n"
+
+
+def _formatear_etiquetas(etiquetas: Etiquetas) -> str:
+    if not etiquetas:
+        return ""
+    pares = ",".join(f'{k}="{_escapar(v)}"' for k, v in etiquetas)
+    return "{" + pares + "}"
+
+
+def _escapar(valor: str) -> str:
+    return valor.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _formatear_numero(valor: float) -> str:
+    if math.isnan(valor):
+        return "NaN"
+    if math.isinf(valor):
+        return "+Inf" if valor > 0 else "-Inf"
+    if valor == int(valor) and abs(valor) < 1e15:
+        return str(int(valor))
+    return repr(float(valor))
+
+
+def _lineas_histograma(nombre: str, etiquetas: Etiquetas, histograma: Histograma) -> List[str]:
+    buckets, conteos, suma, total = histograma.instantanea()
+    lineas = []
+    acumulado = 0
+    for limite, conteo in zip(buckets, conteos):
+        acumulado += conteo
+        lineas.append(f"{nombre}_bucket{_formatear_etiquetas(etiquetas + (('le', _formatear_numero(limite)),))} {acumulado}")
+    lineas.append(f"{nombre}_bucket{_formatear_etiquetas(etiquetas + (('le', '+Inf'),))} {total}")
+    lineas.append(f"{nombre}_sum{_formatear_etiquetas(etiquetas)} {_formatear_numero(suma)}")
+    lineas.append(f"{nombre}_count{_formatear_etiquetas(etiquetas)} {total}")
+    return lineas
+
+
+# Registro global del proceso
+registro = RegistroMetricas()
+
+
+def iniciar_servidor(puerto: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Sirve ``registro`` en ``http://host:puerto/metrics`` desde un hilo en segundo plano."""
+
+    class _ManejadorMetricas(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            cuerpo = registro.exponer().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+        def log_message(self, *args):
+            pass
+
+    servidor = ThreadingHTTPServer((host, puerto), _ManejadorMetricas)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name="metricas", daemon=True).start()
+    return servidor
@@ -0,0 +1,54 @@
+import re
+from functools import lru_cache
+from metrics import registro
+
+_RE_NO_PERMITIDOS = re.compile(r'[^\w\s.,;:?¿!¡]')
+
+# Una sola pasada: tildes y eñes a su letra base y borrado de los caracteres
+# ASCII que no son letras, números, espacios ni puntuación básica. El resto de
+# caracteres no ASCII (emojis) se descarta después al codificar.
+_TABLA_TRADUCCION = str.maketrans(
+    "áéíóúüÁÉÍÓÚÜñÑ",
+    "aeiouuAEIOUUnN",
+    "".join(chr(c) for c in range(128) if _RE_NO_PERMITIDOS.match(chr(c))),
+)
+
+_RE_LISTA = re.compile(r'(\d+)\.\s*')
+_RE_DOS_PUNTOS = re.compile(r':\s*')
+
+
+@lru_cache(maxsize=4096)
+def normalizar_mensaje(texto: str) -> str:
+    """Normaliza un mensaje para compararlo: sin tildes, emojis ni espacios repetidos.
+
+    Los patrones y la tabla de traducción se construyen una sola vez y los
+    resultados se memorizan, porque las plantillas del bot y las respuestas
+    habituales ("si", "cita", "cc") se repiten constantemente.
+    """
+    if not texto:
+        return ""
+
+    texto = texto.translate(_TABLA_TRADUCCION)
+    if not texto.isascii():
+        texto = texto.encode('ascii', 'ignore').decode('ascii')
+
+    # Espacios repetidos a uno solo (los de los extremos se quitan al final)
+    texto = " ".join(texto.split())
+    # Estandarizar listas ("1.medico" → "1. medico") y dos puntos ("fecha:2025" → "fecha: 2025")
+    if "." in texto:
+        texto = _RE_LISTA.sub(r'\1. ', texto)
+    if ":" in texto:
+        texto = _RE_DOS_PUNTOS.sub(': ', texto)
+
+    texto = texto.lower().strip()
+
+    # Manejar caso especial de "escribiendo..."
+    if "escribiendo" in texto:
+        return "escribiendo"
+    return texto
+
+
+registro.contador("ohibot_normalizador_cache_aciertos_total", "Mensajes normalizados desde la memoria",
+                  funcion=lambda: normalizar_mensaje.cache_info().hits)
+registro.contador("ohibot_normalizador_cache_fallos_total", "Mensajes normalizados desde cero",
+                  funcion=lambda: normalizar_mensaje.cache_info().misses)
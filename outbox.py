@@ -0,0 +1,239 @@
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Tuple
+from config import logger
+from metrics import registro
+
+PENDIENTE = "pendiente"
+ENTREGADO = "entregado"
+# Se pulsó "Enviar" pero no se vio la burbuja: pudo salir, así que no se reenvía
+SIN_CONFIRMAR = "sin_confirmar"
+FALLIDO = "fallido"
+VENCIDO = "vencido"
+# Estados de una clave que ya no se vuelve a enviar
+ENVIADOS = (ENTREGADO, SIN_CONFIRMAR)
+
+# (id, numero, mensaje, prioridad)
+MensajeSaliente = Tuple[int, str, str, int]
+
+# Reintentos de una transacción fallida: espera máxima (s) y cuántos se hacen al cerrar
+ESPERA_MAXIMA_REINTENTO = 5.0
+REINTENTOS_AL_CERRAR = 3
+
+
+class BandejaSalida:
+    """Bandeja de salida persistente: cada mensaje se escribe antes de enviarse.
+
+    Un hilo escritor agrupa las escrituras: confirma en una sola transacción
+    (un fsync, ``synchronous=FULL``) todo lo que llegó mientras se confirmaba
+    la anterior, así que con mucho volumen no se paga un fsync por mensaje y
+    con poco no se añade espera. ``registrar`` vuelve cuando el mensaje ya está
+    en disco; ``marcar`` no espera. Al arrancar, ``pendientes`` devuelve lo que
+    quedó sin entregar para reenviarlo.
+
+    ``clave`` hace idempotente un envío (p. ej. un recordatorio por cita):
+    registrar otra vez una clave ya enviada (``ENVIADOS``) no crea un mensaje
+    nuevo.
+    """
+
+    def __init__(self, ruta: str, canal: str = "principal", lote_maximo: int = 500):
+        self.ruta = ruta
+        self.canal = canal
+        self.lote_maximo = lote_maximo
+        self._conexion: Optional[sqlite3.Connection] = None
+        self._lock_conexion = threading.Lock()
+        self._altas: List[Tuple[Tuple[str, str, int, Optional[str]], Future]] = []
+        self._marcas: List[Tuple[str, float, int]] = []
+        self._condicion = threading.Condition()
+        self._hilo: Optional[threading.Thread] = None
+        self._cerrando = False
+        self.lotes = registro.histograma(
+            "ohibot_salida_lote_mensajes", "Escrituras confirmadas por transacción de la bandeja de salida",
+            buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500), canal=canal,
+        )
+        self.confirmaciones = registro.histograma(
+            "ohibot_salida_commit_segundos", "Duración de cada transacción de la bandeja de salida", canal=canal
+        )
+
+    def _conectar(self) -> sqlite3.Connection:
+        """Abre la base la primera vez que se usa (importar el módulo no crea archivos)."""
+        if self._conexion is None:
+            conexion = sqlite3.connect(self.ruta, timeout=30, check_same_thread=False)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA synchronous=FULL")
+            conexion.execute(
+                "CREATE TABLE IF NOT EXISTS salida ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, canal TEXT NOT NULL, clave TEXT, "
+                "numero TEXT NOT NULL, mensaje TEXT NOT NULL, prioridad INTEGER NOT NULL, "
+                "estado TEXT NOT NULL, intentos INTEGER NOT NULL DEFAULT 0, "
+                "creado REAL NOT NULL, actualizado REAL NOT NULL)"
+            )
+            conexion.execute("CREATE UNIQUE INDEX IF NOT EXISTS salida_clave ON salida (canal, clave)")
+            conexion.execute("CREATE INDEX IF NOT EXISTS salida_estado ON salida (canal, estado)")
+            conexion.commit()
+            self._conexion = conexion
+        return self._conexion
+
+    def _asegurar_escritor(self) -> None:
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=self._escritor, name=f"salida-{self.canal}", daemon=True)
+            self._hilo.start()
+
+    def registrar(
+        self, numero: str, mensaje: str, prioridad: int = 0, clave: Optional[str] = None
+    ) -> Tuple[int, Optional[str]]:
+        """Escribe el mensaje como pendiente y espera a que esté en disco.
+
+        Devuelve su id y el estado previo de ``clave`` (``None`` si es nuevo).
+        Una clave ya enviada se devuelve sin cambios.
+        """
+        futuro: Future = Future()
+        with self._condicion:
+            if self._cerrando:
+                raise RuntimeError("La bandeja de salida está cerrada")
+            self._asegurar_escritor()
+            self._altas.append(((numero, mensaje, prioridad, clave), futuro))
+            self._condicion.notify()
+        return futuro.result()
+
+    def marcar(self, id_salida: int, estado: str) -> None:
+        """Anota el resultado de un envío en la siguiente transacción."""
+        with self._condicion:
+            self._asegurar_escritor()
+            self._marcas.append((estado, time.time(), id_salida))
+            self._condicion.notify()
+
+    def enviar(
+        self,
+        enviar: Callable[[str, str], str],
+        numero: str,
+        mensaje: str,
+        prioridad: int = 0,
+        clave: Optional[str] = None,
+    ) -> bool:
+        """Registra, envía con ``enviar`` en este hilo y anota el resultado.
+
+        ``enviar`` devuelve el estado a anotar (``ENTREGADO``, ``SIN_CONFIRMAR``
+        o ``FALLIDO``). Devuelve si el mensaje salió o pudo salir.
+        """
+        id_salida, anterior = self.registrar(numero, mensaje, prioridad, clave)
+        if anterior in ENVIADOS:
+            return True
+        estado = FALLIDO
+        try:
+            estado = enviar(numero, mensaje)
+        finally:
+            self.marcar(id_salida, estado)
+        return estado in ENVIADOS
+
+    def pendientes(self, caducidad: float = 86400) -> List[MensajeSaliente]:
+        """Mensajes de este canal sin entregar, en orden. Los de más de ``caducidad`` s se dan por vencidos."""
+        limite = time.time() - caducidad
+        with self._lock_conexion:
+            conexion = self._conectar()
+            with conexion:
+                vencidos = conexion.execute(
+                    "UPDATE salida SET estado = ?, actualizado = ? WHERE canal = ? AND estado = ? AND creado < ?",
+                    (VENCIDO, time.time(), self.canal, PENDIENTE, limite),
+                ).rowcount
+            filas = conexion.execute(
+                "SELECT id, numero, mensaje, prioridad FROM salida WHERE canal = ? AND estado = ? ORDER BY id",
+                (self.canal, PENDIENTE),
+            ).fetchall()
+        if vencidos:
+            logger.warning(f"{vencidos} mensajes de la bandeja de salida vencidos sin enviar")
+        return [tuple(fila) for fila in filas]
+
+    def purgar(self, dias: int = 7) -> int:
+        """Borra los mensajes ya resueltos de hace más de ``dias`` días. Devuelve cuántos."""
+        limite = time.time() - dias * 86400
+        with self._lock_conexion:
+            conexion = self._conectar()
+            with conexion:
+                return conexion.execute(
+                    "DELETE FROM salida WHERE canal = ? AND estado != ? AND actualizado < ?",
+                    (self.canal, PENDIENTE, limite),
+                ).rowcount
+
+    def cerrar(self, timeout: float = 30) -> None:
+        """Confirma lo que quede en memoria y cierra la base."""
+        with self._condicion:
+            self._cerrando = True
+            self._condicion.notify()
+        if self._hilo:
+            self._hilo.join(timeout)
+            self._hilo = None
+        with self._lock_conexion:
+            if self._conexion is not None:
+                self._conexion.close()
+                self._conexion = None
+
+    def _escritor(self) -> None:
+        fallos = 0
+        while True:
+            with self._condicion:
+                while not self._altas and not self._marcas and not self._cerrando:
+                    self._condicion.wait()
+                if not self._altas and not self._marcas:
+                    return
+                altas, self._altas = self._altas[:self.lote_maximo], self._altas[self.lote_maximo:]
+                marcas, self._marcas = self._marcas, []
+            try:
+                with self.confirmaciones.medir():
+                    resultados = self._confirmar([datos for datos, _ in altas], marcas)
+            except Exception as e:
+                fallos += 1
+                logger.error(f"Error al escribir en la bandeja de salida: {e}", exc_info=True)
+                for _, futuro in altas:
+                    futuro.set_exception(e)
+                # Perder una marca dejaría el mensaje pendiente y se reenviaría al arrancar
+                with self._condicion:
+                    self._marcas[:0] = marcas
+                    if self._cerrando and fallos >= REINTENTOS_AL_CERRAR:
+                        ids = sorted({id_salida for _, _, id_salida in self._marcas})
+                        logger.error(f"Resultados de envío sin guardar al cerrar la bandeja de salida: {ids}")
+                        return
+                time.sleep(min(0.1 * 2 ** fallos, ESPERA_MAXIMA_REINTENTO))
+                continue
+            fallos = 0
+            self.lotes.observar(len(altas) + len(marcas))
+            for (_, futuro), resultado in zip(altas, resultados):
+                futuro.set_result(resultado)
+
+    def _confirmar(
+        self, altas: List[Tuple[str, str, int, Optional[str]]], marcas: List[Tuple[str, float, int]]
+    ) -> List[Tuple[int, Optional[str]]]:
+        """Una transacción con todas las altas y marcas del lote."""
+        ahora = time.time()
+        resultados = []
+        with self._lock_conexion:
+            conexion = self._conectar()
+            with conexion:
+                if marcas:
+                    conexion.executemany(
+                        "UPDATE salida SET estado = ?, actualizado = ?, intentos = intentos + 1 WHERE id = ?", marcas
+                    )
+                for numero, mensaje, prioridad, clave in altas:
+                    fila = None
+                    if clave is not None:
+                        fila = conexion.execute(
+                            "SELECT id, estado FROM salida WHERE canal = ? AND clave = ?", (self.canal, clave)
+                        ).fetchone()
+                    if fila is None:
+                        cursor = conexion.execute(
+                            "INSERT INTO salida (canal, clave, numero, mensaje, prioridad, estado, creado, actualizado) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (self.canal, clave, numero, mensaje, prioridad, PENDIENTE, ahora, ahora),
+                        )
+                        resultados.append((cursor.lastrowid, None))
+                        continue
+                    if fila[1] not in ENVIADOS:
+                        conexion.execute(
+                            "UPDATE salida SET numero = ?, mensaje = ?, prioridad = ?, estado = ?, actualizado = ? "
+                            "WHERE id = ?",
+                            (numero, mensaje, prioridad, PENDIENTE, ahora, fila[0]),
+                        )
+                    resultados.append((fila[0], fila[1]))
+        return resultados
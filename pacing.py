@@ -0,0 +1,98 @@
+import threading
+import time
+from typing import Callable, Optional
+
+
+class CuboTokens:
+    """Token bucket: ``tasa`` envíos por segundo con ráfagas de hasta ``capacidad``."""
+
+    def __init__(self, tasa: float, capacidad: float = 1.0, reloj: Callable[[], float] = time.monotonic):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self._reloj = reloj
+        self._tokens = capacidad
+        self._ultimo = reloj()
+        self._lock = threading.Lock()
+
+    def _rellenar(self, ahora: float) -> None:
+        self._tokens = min(self.capacidad, self._tokens + (ahora - self._ultimo) * self.tasa)
+        self._ultimo = ahora
+
+    def reservar(self) -> float:
+        """Toma un token y devuelve cuántos segundos hay que esperar para usarlo."""
+        with self._lock:
+            self._rellenar(self._reloj())
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.tasa
+
+    def tomar(self, detener: Optional[threading.Event] = None) -> float:
+        """Bloquea hasta disponer de un token. Devuelve los segundos esperados."""
+        espera = self.reservar()
+        if espera > 0:
+            if detener is not None:
+                detener.wait(espera)
+            else:
+                time.sleep(espera)
+        return espera
+
+
+class RitmoAdaptativo(CuboTokens):
+    """Token bucket que ajusta su tasa según cómo responde WhatsApp (AIMD).
+
+    Cada envío rápido sube la tasa un ``paso`` hasta ``tasa_maxima``; uno más
+    lento que ``latencia_objetivo`` la reduce un 10 % y un fallo a la mitad, sin
+    bajar de ``tasa_minima``. ``fallos_limite`` fallos seguidos se tratan como
+    limitación de WhatsApp: ``pausa`` devuelve una espera creciente antes de
+    seguir.
+    """
+
+    def __init__(
+        self,
+        tasa: float,
+        tasa_minima: float,
+        tasa_maxima: float,
+        latencia_objetivo: float = 5.0,
+        paso: float = 0.05,
+        fallos_limite: int = 3,
+        pausa_base: float = 30,
+        pausa_maxima: float = 900,
+        reloj: Callable[[], float] = time.monotonic,
+    ):
+        super().__init__(tasa, reloj=reloj)
+        self.tasa_minima = tasa_minima
+        self.tasa_maxima = tasa_maxima
+        self.latencia_objetivo = latencia_objetivo
+        self.paso = paso
+        self.fallos_limite = fallos_limite
+        self.pausa_base = pausa_base
+        self.pausa_maxima = pausa_maxima
+        self.fallos_seguidos = 0
+        self._pausas = 0
+
+    def exito(self, latencia: float) -> None:
+        with self._lock:
+            self.fallos_seguidos = 0
+            self._pausas = 0
+            if latencia > self.latencia_objetivo:
+                self.tasa = max(self.tasa_minima, self.tasa * 0.9)
+            else:
+                self.tasa = min(self.tasa_maxima, self.tasa + self.paso)
+
+    def fallo(self) -> None:
+        with self._lock:
+            self.fallos_seguidos += 1
+            self.tasa = max(self.tasa_minima, self.tasa * 0.5)
+
+    @property
+    def limitado(self) -> bool:
+        return self.fallos_seguidos >= self.fallos_limite
+
+    def pausa(self) -> float:
+        """Segundos a esperar tras detectar limitación; crece con cada pausa seguida."""
+        with self._lock:
+            segundos = min(self.pausa_base * 2 ** self._pausas, self.pausa_maxima)
+            self._pausas += 1
+            self.fallos_seguidos = 0
+            self.tasa = self.tasa_minima
+            self._tokens = 0.0
+            return segundos
@@ -0,0 +1,242 @@
+import heapq
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Tuple
+from config import logger
+
+
+def proxima_ejecucion(hora: str, desde: datetime) -> datetime:
+    """Siguiente instante con hora ``HH:MM`` estrictamente posterior a ``desde``."""
+    horas, minutos = map(int, hora.split(":"))
+    candidata = desde.replace(hour=horas, minute=minutos, second=0, microsecond=0)
+    if candidata <= desde:
+        candidata += timedelta(days=1)
+    return candidata
+
+
+class Planificador:
+    """Trabajos diarios a hora fija con la próxima ejecución persistida en SQLite.
+
+    Las horas se calculan sobre el reloj de pared, así que lo que tarda cada
+    ejecución no desplaza el horario. La próxima ejecución solo avanza cuando el
+    trabajo termina bien: si el proceso estuvo detenido a la hora prevista o se
+    cayó a mitad de una ejecución, el trabajo se ejecuta en cuanto arranca. Un
+    trabajo sin estado previo se ejecuta también al arrancar.
+
+    El trabajo recibe el turno que atiende (``programada``), no la hora real:
+    tras una caída de varios días se ejecuta una vez por cada turno perdido.
+
+    Un turno que falla se reintenta cada ``reintento`` s hasta que toca el
+    siguiente (y al menos durante ``ventana_reintento`` s desde su primer
+    fallo, para los turnos atrasados); después se abandona y se pasa al
+    siguiente, que así sale a su hora.
+    """
+
+    def __init__(self, ruta: str, reintento: float = 300, ventana_reintento: float = 3600):
+        self.reintento = reintento
+        self.ventana_reintento = ventana_reintento
+        self._conexion = sqlite3.connect(ruta, timeout=30, check_same_thread=False)
+        self._conexion.execute("PRAGMA journal_mode=WAL")
+        self._conexion.execute(
+            "CREATE TABLE IF NOT EXISTS trabajos (nombre TEXT PRIMARY KEY, proxima REAL NOT NULL)"
+        )
+        self._conexion.commit()
+        self._heap: List[Tuple[float, str]] = []
+        self._trabajos: Dict[str, Tuple[Callable[[datetime], object], str]] = {}
+        # Turno pendiente de cada trabajo (el persistido en "trabajos")
+        self._programadas: Dict[str, datetime] = {}
+        # Primer fallo del turno pendiente de cada trabajo
+        self._primer_fallo: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+
+    def registrar(self, nombre: str, funcion: Callable[[datetime], object], hora: str) -> None:
+        """Programa ``funcion(programada)`` todos los días a la hora ``HH:MM`` (hora local)."""
+        proxima_ejecucion(hora, datetime.now())  # valida el formato antes de guardar nada
+        with self._lock:
+            fila = self._conexion.execute(
+                "SELECT proxima FROM trabajos WHERE nombre = ?", (nombre,)
+            ).fetchone()
+            proxima = fila[0] if fila else time.time()
+            if fila and proxima <= time.time():
+                logger.info(f"Trabajo '{nombre}' atrasado desde {datetime.fromtimestamp(proxima):%Y-%m-%d %H:%M}, se ejecuta ahora")
+            self._trabajos[nombre] = (funcion, hora)
+            self._programadas[nombre] = datetime.fromtimestamp(proxima)
+            heapq.heappush(self._heap, (proxima, nombre))
+
+    def ejecutar_pendientes(self) -> int:
+        """Ejecuta los trabajos vencidos. Devuelve cuántos terminaron bien."""
+        completados = 0
+        while True:
+            with self._lock:
+                if not self._heap or self._heap[0][0] > time.time():
+                    return completados
+                _, nombre = heapq.heappop(self._heap)
+                funcion, hora = self._trabajos[nombre]
+                programada = self._programadas[nombre]
+
+            # El turno siguiente al atendido; si también pasó, se ejecuta enseguida
+            siguiente = proxima_ejecucion(hora, programada)
+            proxima = siguiente.timestamp()
+            inicio = time.monotonic()
+            try:
+                funcion(programada)
+            except Exception as e:
+                ahora = time.time()
+                limite = max(proxima, self._primer_fallo.setdefault(nombre, ahora) + self.ventana_reintento)
+                if ahora + self.reintento < limite:
+                    logger.error(f"Trabajo '{nombre}' falló, se reintenta en {self.reintento:.0f} s: {e}", exc_info=True)
+                    with self._lock:
+                        heapq.heappush(self._heap, (ahora + self.reintento, nombre))
+                    continue
+                logger.error(
+                    f"Trabajo '{nombre}' ({programada:%Y-%m-%d %H:%M}) abandonado tras fallar hasta el turno "
+                    f"siguiente: {e}", exc_info=True
+                )
+            else:
+                completados += 1
+                logger.info(
+                    f"Trabajo '{nombre}' ({programada:%Y-%m-%d %H:%M}) completado en {time.monotonic() - inicio:.1f} s, "
+                    f"próximo: {siguiente:%Y-%m-%d %H:%M}"
+                )
+
+            with self._lock:
+                self._primer_fallo.pop(nombre, None)
+                self._programadas[nombre] = siguiente
+                with self._conexion:
+                    self._conexion.execute(
+                        "INSERT INTO trabajos (nombre, proxima) VALUES (?, ?) "
+                        "ON CONFLICT(nombre) DO UPDATE SET proxima = excluded.proxima",
+                        (nombre, proxima),
+                    )
+                heapq.heappush(self._heap, (proxima, nombre))
+
+    def ejecutar(self) -> None:
+        """Bucle del hilo planificador hasta ``detener``."""
+        while not self._detener.is_set():
+            self.ejecutar_pendientes()
+            with self._lock:
+                espera = self._heap[0][0] - time.time() if self._heap else 60
+            # Esperas cortas para tolerar ajustes del reloj del sistema
+            self._detener.wait(min(max(espera, 0), 60))
+
+    def detener(self) -> None:
+        self._detener.set()
+
+    def cerrar(self) -> None:
+        self.detener()
+        with self._lock:
+            self._conexion.close()
+
+
+class RegistroEnvios:
+    """Bitácora de recordatorios enviados, por ``(cita_id, tipo)``.
+
+    Consultarla antes de cada envío y anotar cada envío en cuanto se confirma
+    hace que repetir una ejecución interrumpida solo envíe lo que faltaba.
+    También cuenta los intentos fallidos de cada recordatorio para poder
+    abandonar los que nunca van a salir.
+    """
+
+    def __init__(self, ruta: str):
+        self._conexion = sqlite3.connect(ruta, timeout=30, check_same_thread=False)
+        self._conexion.execute("PRAGMA journal_mode=WAL")
+        self._conexion.execute("PRAGMA synchronous=NORMAL")
+        self._conexion.execute(
+            "CREATE TABLE IF NOT EXISTS recordatorios_enviados ("
+            "cita_id INTEGER NOT NULL, tipo TEXT NOT NULL, enviado REAL NOT NULL, "
+            "PRIMARY KEY (cita_id, tipo))"
+        )
+        self._conexion.execute(
+            "CREATE TABLE IF NOT EXISTS recordatorios_fallidos ("
+            "cita_id INTEGER NOT NULL, tipo TEXT NOT NULL, intentos INTEGER NOT NULL, actualizado REAL NOT NULL, "
+            "PRIMARY KEY (cita_id, tipo))"
+        )
+        self._conexion.commit()
+        self._lock = threading.Lock()
+
+    def enviado(self, cita_id: int, tipo: str) -> bool:
+        with self._lock:
+            return self._conexion.execute(
+                "SELECT 1 FROM recordatorios_enviados WHERE cita_id = ? AND tipo = ?", (cita_id, tipo)
+            ).fetchone() is not None
+
+    def registrar(self, cita_id: int, tipo: str) -> None:
+        with self._lock, self._conexion:
+            self._conexion.execute(
+                "INSERT OR IGNORE INTO recordatorios_enviados (cita_id, tipo, enviado) VALUES (?, ?, ?)",
+                (cita_id, tipo, time.time()),
+            )
+
+    def intentos(self, cita_id: int, tipo: str) -> int:
+        """Intentos fallidos anotados para el recordatorio."""
+        with self._lock:
+            fila = self._conexion.execute(
+                "SELECT intentos FROM recordatorios_fallidos WHERE cita_id = ? AND tipo = ?", (cita_id, tipo)
+            ).fetchone()
+        return fila[0] if fila else 0
+
+    def anotar_fallo(self, cita_id: int, tipo: str) -> int:
+        """Suma un intento fallido y devuelve el total."""
+        with self._lock, self._conexion:
+            self._conexion.execute(
+                "INSERT INTO recordatorios_fallidos (cita_id, tipo, intentos, actualizado) VALUES (?, ?, 1, ?) "
+                "ON CONFLICT (cita_id, tipo) DO UPDATE SET intentos = intentos + 1, actualizado = excluded.actualizado",
+                (cita_id, tipo, time.time()),
+            )
+            return self._conexion.execute(
+                "SELECT intentos FROM recordatorios_fallidos WHERE cita_id = ? AND tipo = ?", (cita_id, tipo)
+            ).fetchone()[0]
+
+    def purgar(self, dias: int = 30) -> int:
+        """Borra los registros de hace más de ``dias`` días. Devuelve cuántos borró."""
+        limite = time.time() - dias * 86400
+        with self._lock, self._conexion:
+            self._conexion.execute("DELETE FROM recordatorios_fallidos WHERE actualizado < ?", (limite,))
+            return self._conexion.execute(
+                "DELETE FROM recordatorios_enviados WHERE enviado < ?", (limite,)
+            ).rowcount
+
+    def cerrar(self) -> None:
+        with self._lock:
+            self._conexion.close()
+
+
+class CursorCampana:
+    """Último id procesado de cada campaña, por clave (p. ej. la fecha de las citas).
+
+    Una campaña interrumpida retoma después de ``leer(nombre, clave)``; con
+    otra clave (la campaña del día siguiente) empieza desde 0.
+    """
+
+    def __init__(self, ruta: str):
+        self._conexion = sqlite3.connect(ruta, timeout=30, check_same_thread=False)
+        self._conexion.execute("PRAGMA journal_mode=WAL")
+        self._conexion.execute("PRAGMA synchronous=NORMAL")
+        self._conexion.execute(
+            "CREATE TABLE IF NOT EXISTS cursores_campana ("
+            "nombre TEXT PRIMARY KEY, clave TEXT NOT NULL, ultimo_id INTEGER NOT NULL)"
+        )
+        self._conexion.commit()
+        self._lock = threading.Lock()
+
+    def leer(self, nombre: str, clave: str) -> int:
+        with self._lock:
+            fila = self._conexion.execute(
+                "SELECT ultimo_id FROM cursores_campana WHERE nombre = ? AND clave = ?", (nombre, clave)
+            ).fetchone()
+        return fila[0] if fila else 0
+
+    def avanzar(self, nombre: str, clave: str, ultimo_id: int) -> None:
+        with self._lock, self._conexion:
+            self._conexion.execute(
+                "INSERT INTO cursores_campana (nombre, clave, ultimo_id) VALUES (?, ?, ?) "
+                "ON CONFLICT(nombre) DO UPDATE SET clave = excluded.clave, ultimo_id = excluded.ultimo_id",
+                (nombre, clave, ultimo_id),
+            )
+
+    def cerrar(self) -> None:
+        with self._lock:
+            self._conexion.close()
@@ -40,8 +40,18 @@ except Exception as e:
     exit()
 
 
+SCRIPT_ULTIMO_SALIENTE = """
+const filas = document.querySelectorAll('#main div[data-id^="true_"]');
+if (!filas.length) return null;
+const fila = filas[filas.length - 1];
+const tick = fila.querySelector('span[data-icon="msg-time"], span[data-icon="msg-check"], span[data-icon="msg-dblcheck"]');
+return [fila.getAttribute("data-id"), tick ? tick.getAttribute("data-icon") : null];
+"""
+
+
 def enviar_mensaje(numero, mensaje):
     try:
+        inicio = time.perf_counter()
         # Codificar mensaje para URL
         mensaje_codificado = quote(mensaje)
         url = f"https://web.whatsapp.com/send?phone={numero}&text={mensaje_codificado}"
@@ -49,12 +59,26 @@ def enviar_mensaje(numero, mensaje):
         driver.get(url)
         print("🔄 Cargando chat...")
 
-        time.sleep(8)
+        # Esperar a que el texto de la URL aparezca en la caja de mensaje
+        WebDriverWait(driver, 30).until(
+            lambda d: d.find_element(By.XPATH, '//footer//div[@contenteditable="true"]').text.strip()
+        )
+        ultimo = driver.execute_script(SCRIPT_ULTIMO_SALIENTE)
+        previo = ultimo[0] if ultimo else None
+
+        WebDriverWait(driver, 10).until(
+            EC.element_to_be_clickable((By.XPATH, "//footer//button[@data-tab='11' and @aria-label='Enviar']"))
+        ).click()
+
+        # Esperar a que la burbuja nueva pase del reloj (msg-time) al check:
+        # con el reloj el mensaje aún no salió y driver.quit() lo perdería
+        def burbuja_enviada(d):
+            ultimo = d.execute_script(SCRIPT_ULTIMO_SALIENTE)
+            return bool(ultimo and ultimo[0] != previo and ultimo[1] in ("msg-check", "msg-dblcheck"))
 
-        driver.find_element(By.XPATH, "//footer//button[@data-tab='11' and @aria-label='Enviar']").click()
+        WebDriverWait(driver, 30, poll_frequency=0.1).until(burbuja_enviada)
 
-        print("✅ Mensaje enviado con éxito!")
-        time.sleep(3)
+        print(f"✅ Mensaje enviado con éxito en {(time.perf_counter() - inicio) * 1000:.0f} ms!")
 
     except Exception as e:
         print(f"❌ Error al enviar mensaje: {str(e)}")
@@ -0,0 +1,184 @@
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional
+from config import logger, SESSION_DB_PATH, SHARD_INDICE, SHARD_TOTAL
+from metrics import registro
+from outbox import BandejaSalida, ENVIADOS, FALLIDO
+from whatsapp import WhatsAppDriver, whatsapp_driver
+
+PRIORIDAD_INTERACTIVA = 0
+PRIORIDAD_LECTURA = 1
+PRIORIDAD_RECORDATORIO = 10
+
+
+class DespachadorEnvios:
+    """Único hilo dueño del navegador; atiende una cola de tareas con prioridad.
+
+    Las respuestas del chatbot, las lecturas de la bandeja y los recordatorios
+    solo encolan trabajo aquí, así nunca compiten por ``driver.get``. A igual
+    prioridad se respeta el orden de llegada.
+
+    Con ``bandeja_salida`` cada mensaje queda en disco antes de encolarse y se
+    marca como entregado o fallido al terminar; al iniciar se reenvían los que
+    quedaron pendientes de una ejecución anterior.
+    """
+
+    def __init__(self, driver: WhatsAppDriver, nombre: str = "principal", bandeja_salida: Optional[BandejaSalida] = None):
+        self.driver = driver
+        self.bandeja_salida = bandeja_salida
+        self._cola: "queue.PriorityQueue" = queue.PriorityQueue()
+        self._secuencia = itertools.count()
+        self._hilo = None
+        self._en_vuelo: Dict[int, Future] = {}
+        self._lock = threading.Lock()
+        self.espera = registro.histograma("ohibot_despachador_espera_segundos", "Tiempo de las tareas en cola", despachador=nombre)
+        self.ejecucion = registro.histograma("ohibot_despachador_ejecucion_segundos", "Tiempo de ejecución de las tareas", despachador=nombre)
+        registro.medidor("ohibot_despachador_profundidad", "Tareas pendientes en la cola", funcion=lambda: self.profundidad, despachador=nombre)
+
+    def iniciar(self) -> None:
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._hilo = threading.Thread(target=self._bucle, name="despachador-envios", daemon=True)
+        self._hilo.start()
+        if self.bandeja_salida:
+            self._reenviar_pendientes()
+
+    def _reenviar_pendientes(self) -> None:
+        self.bandeja_salida.purgar()
+        pendientes = self.bandeja_salida.pendientes()
+        if pendientes:
+            logger.info(f"Reenviando {len(pendientes)} mensajes pendientes de la bandeja de salida")
+        for id_salida, numero, mensaje, prioridad in pendientes:
+            self._encolar_envio(id_salida, numero, mensaje, prioridad)
+
+    def detener(self, timeout: float = 30) -> None:
+        """Termina después de vaciar las tareas ya encoladas."""
+        if not self._hilo:
+            return
+        self._cola.put((float("inf"), next(self._secuencia), time.monotonic(), None, None))
+        self._hilo.join(timeout)
+        self._hilo = None
+
+    def ejecutar(self, funcion: Callable[[WhatsAppDriver], Any], prioridad: int = PRIORIDAD_LECTURA) -> Future:
+        """Encola ``funcion(driver)`` y devuelve un Future con su resultado."""
+        futuro: Future = Future()
+        self._cola.put((prioridad, next(self._secuencia), time.monotonic(), funcion, futuro))
+        return futuro
+
+    def encolar(
+        self, numero: str, mensaje: str, prioridad: int = PRIORIDAD_INTERACTIVA, clave: Optional[str] = None
+    ) -> Future:
+        """Encola el envío de un mensaje. El Future resuelve a ``True``/``False``.
+
+        ``True`` también si se pulsó "Enviar" sin ver la burbuja (``SIN_CONFIRMAR``
+        en la bandeja): ese mensaje no se reintenta. Con bandeja de salida vuelve
+        cuando el mensaje ya está en disco. Un envío con ``clave`` ya enviado
+        resuelve a ``True`` sin repetirse.
+        """
+        if self.bandeja_salida is None:
+            return self.ejecutar(lambda driver: driver.enviar_mensaje(numero, mensaje) in ENVIADOS, prioridad)
+        id_salida, anterior = self.bandeja_salida.registrar(numero, mensaje, prioridad, clave)
+        if anterior in ENVIADOS:
+            futuro: Future = Future()
+            futuro.set_result(True)
+            return futuro
+        with self._lock:
+            en_vuelo = self._en_vuelo.get(id_salida)
+        return en_vuelo or self._encolar_envio(id_salida, numero, mensaje, prioridad)
+
+    def _encolar_envio(self, id_salida: int, numero: str, mensaje: str, prioridad: int) -> Future:
+        def enviar(driver: WhatsAppDriver) -> bool:
+            estado = FALLIDO
+            try:
+                estado = driver.enviar_mensaje(numero, mensaje)
+            finally:
+                self.bandeja_salida.marcar(id_salida, estado)
+                with self._lock:
+                    self._en_vuelo.pop(id_salida, None)
+            return estado in ENVIADOS
+
+        # Bajo el lock para que la tarea no termine antes de quedar registrada
+        with self._lock:
+            futuro = self.ejecutar(enviar, prioridad)
+            self._en_vuelo[id_salida] = futuro
+        return futuro
+
+    @property
+    def profundidad(self) -> int:
+        return self._cola.qsize()
+
+    def estadisticas(self) -> Dict[str, Any]:
+        return {
+            "profundidad": self.profundidad,
+            "espera": self.espera.resumen(),
+            "ejecucion": self.ejecucion.resumen(),
+        }
+
+    def _bucle(self) -> None:
+        while True:
+            _, _, encolado, funcion, futuro = self._cola.get()
+            if funcion is None:
+                break
+            self.espera.observar(time.monotonic() - encolado)
+            if not futuro.set_running_or_notify_cancel():
+                continue
+            try:
+                with self.ejecucion.medir():
+                    resultado = funcion(self.driver)
+                futuro.set_result(resultado)
+            except Exception as e:
+                logger.error(f"Error en tarea del despachador: {e}", exc_info=True)
+                futuro.set_exception(e)
+
+
+class TransporteNulo:
+    """Transporte que no toca ningún navegador: los envíos se dan por hechos.
+
+    Tiene la misma interfaz que ``DespachadorEnvios`` para medir el chatbot
+    sin WhatsApp Web (benchmarks, pruebas de carga). Las tareas de navegador
+    devuelven ``None`` como si no hubiera sesión.
+    """
+
+    bandeja_salida = None
+
+    def __init__(self):
+        self.enviados = 0
+        self._lock = threading.Lock()
+
+    def iniciar(self) -> None:
+        pass
+
+    def detener(self, timeout: float = 30) -> None:
+        pass
+
+    def ejecutar(self, funcion: Callable[[WhatsAppDriver], Any], prioridad: int = PRIORIDAD_LECTURA) -> Future:
+        futuro: Future = Future()
+        futuro.set_result(None)
+        return futuro
+
+    def encolar(
+        self, numero: str, mensaje: str, prioridad: int = PRIORIDAD_INTERACTIVA, clave: Optional[str] = None
+    ) -> Future:
+        with self._lock:
+            self.enviados += 1
+        futuro: Future = Future()
+        futuro.set_result(True)
+        return futuro
+
+    @property
+    def profundidad(self) -> int:
+        return 0
+
+    def estadisticas(self) -> Dict[str, Any]:
+        return {"profundidad": 0, "enviados": self.enviados}
+
+
+# Instancia global del despachador, dueña de whatsapp_driver. Cada shard tiene su canal
+# en la bandeja de salida para no reenviar mensajes de otro proceso.
+despachador = DespachadorEnvios(
+    whatsapp_driver,
+    bandeja_salida=BandejaSalida(SESSION_DB_PATH, f"shard_{SHARD_INDICE}" if SHARD_TOTAL > 1 else "principal"),
+)
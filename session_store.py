@@ -0,0 +1,303 @@
+import json
+import os
+import sqlite3
+import threading
+import socket
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from config import logger
+
+
+class IndiceIdsVistos:
+    """Conjunto acotado de IDs de mensajes ya procesados.
+
+    Comprobar y agregar es O(1); al llenarse se descartan los IDs más antiguos.
+    """
+
+    __slots__ = ("_orden", "_ids")
+
+    def __init__(self, ids: Iterable[str] = (), capacidad: int = 50):
+        self._orden: deque = deque(maxlen=capacidad)
+        self._ids: Set[str] = set()
+        for id_mensaje in ids:
+            self.agregar(id_mensaje)
+
+    def agregar(self, id_mensaje: str) -> bool:
+        """Registra el ID. Devuelve False si ya se había visto."""
+        if id_mensaje in self._ids:
+            return False
+        if len(self._orden) == self._orden.maxlen:
+            self._ids.discard(self._orden[0])
+        self._orden.append(id_mensaje)
+        self._ids.add(id_mensaje)
+        return True
+
+    def __contains__(self, id_mensaje: str) -> bool:
+        return id_mensaje in self._ids
+
+    def __len__(self) -> int:
+        return len(self._orden)
+
+    def a_lista(self) -> List[str]:
+        return list(self._orden)
+
+
+class SessionStore:
+    """Almacén de sesiones en memoria con seguimiento de sesiones modificadas.
+
+    Se comporta como un diccionario ``numero -> SesionUsuario``. Asignar una
+    sesión la marca como modificada y ``guardar`` solo persiste esas sesiones.
+    Las subclases implementan ``_cargar`` y ``_escribir`` para un backend real.
+    """
+
+    # Solo un almacén con respaldo en disco puede desalojar sesiones de memoria
+    persistente = False
+
+    def __init__(self, serializar: Callable[[Any], Dict], deserializar: Callable[[Dict], Any]):
+        self._serializar = serializar
+        self._deserializar = deserializar
+        self._sesiones: Dict[str, Any] = {}
+        self._modificadas: Set[str] = set()
+        self._lock = threading.RLock()
+
+    def get(self, numero: str, default=None):
+        with self._lock:
+            sesion = self._sesiones.get(numero)
+            if sesion is None:
+                datos = self._cargar(numero)
+                if datos is not None:
+                    sesion = self._deserializar_seguro(numero, datos)
+                    if sesion is not None:
+                        self._sesiones[numero] = sesion
+            return sesion if sesion is not None else default
+
+    def __getitem__(self, numero: str):
+        sesion = self.get(numero)
+        if sesion is None:
+            raise KeyError(numero)
+        return sesion
+
+    def __setitem__(self, numero: str, sesion) -> None:
+        with self._lock:
+            self._sesiones[numero] = sesion
+            self._modificadas.add(numero)
+
+    def __contains__(self, numero: str) -> bool:
+        return self.get(numero) is not None
+
+    def __len__(self) -> int:
+        """Número de sesiones residentes en memoria."""
+        return len(self._sesiones)
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        with self._lock:
+            return iter(list(self._sesiones.items()))
+
+    def marcar_modificada(self, numero: str) -> None:
+        with self._lock:
+            if numero in self._sesiones:
+                self._modificadas.add(numero)
+
+    def guardar(self, numero: Optional[str] = None) -> int:
+        """Persiste las sesiones modificadas (o solo ``numero``). Devuelve cuántas escribió."""
+        with self._lock:
+            pendientes = [numero] if numero is not None else list(self._modificadas)
+            registros = {
+                n: self._serializar(self._sesiones[n])
+                for n in pendientes
+                if n in self._modificadas and n in self._sesiones
+            }
+            if not registros:
+                return 0
+            try:
+                self._escribir(registros)
+            except Exception as e:
+                logger.error(f"Error al guardar estado: {e}")
+                return 0
+            self._modificadas.difference_update(registros)
+            return len(registros)
+
+    def desalojar(self, es_inactiva: Callable[[Any], bool]) -> int:
+        """Saca de memoria las sesiones inactivas ya persistidas. Devuelve cuántas."""
+        if not self.persistente:
+            return 0
+        with self._lock:
+            self.guardar()
+            inactivas = [
+                numero for numero, sesion in self._sesiones.items()
+                if numero not in self._modificadas and es_inactiva(sesion)
+            ]
+            for numero in inactivas:
+                del self._sesiones[numero]
+            return len(inactivas)
+
+    @contextmanager
+    def bloqueo(self, numero: str):
+        """Acceso exclusivo a la sesión de ``numero`` entre procesos.
+
+        En un solo proceso no hace nada: el orden por número ya lo garantizan
+        ``PoolConversaciones`` y ``OHIBotAsync``.
+        """
+        yield
+
+    def cerrar(self) -> None:
+        self.guardar()
+
+    def _deserializar_seguro(self, numero: str, datos: Dict):
+        try:
+            return self._deserializar(datos)
+        except (KeyError, ValueError, TypeError) as e:
+            logger.warning(f"No se pudo cargar la sesión de {numero}: {e}")
+            return None
+
+    def _cargar(self, numero: str) -> Optional[Dict]:
+        return None
+
+    def _escribir(self, registros: Dict[str, Dict]) -> None:
+        pass
+
+
+class SQLiteSessionStore(SessionStore):
+    """Almacén de sesiones en SQLite (modo WAL), un registro por número.
+
+    Las sesiones se cargan bajo demanda la primera vez que se consultan, por lo
+    que el arranque no depende del número total de usuarios.
+
+    Con ``compartido`` varios procesos usan el mismo archivo: ``bloqueo`` toma
+    un arriendo por número en la tabla ``bloqueos_sesion`` y, si otro proceso
+    escribió la sesión desde la última vez, descarta la copia en memoria.
+    """
+
+    persistente = True
+
+    def __init__(
+        self,
+        ruta: str,
+        serializar: Callable[[Any], Dict],
+        deserializar: Callable[[Dict], Any],
+        compartido: bool = False,
+        espera_bloqueo: float = 10,
+        ttl_bloqueo: float = 60,
+    ):
+        super().__init__(serializar, deserializar)
+        self.ruta = ruta
+        self.compartido = compartido
+        self.espera_bloqueo = espera_bloqueo
+        self.ttl_bloqueo = ttl_bloqueo
+        self.dueno = f"{socket.gethostname()}:{os.getpid()}"
+        # numero -> "actualizado" de la versión en memoria
+        self._versiones: Dict[str, float] = {}
+        self._conexion = sqlite3.connect(ruta, timeout=30, check_same_thread=False)
+        self._conexion.execute("PRAGMA journal_mode=WAL")
+        self._conexion.execute("PRAGMA synchronous=NORMAL")
+        self._conexion.execute(
+            "CREATE TABLE IF NOT EXISTS sesiones ("
+            "numero TEXT PRIMARY KEY, datos TEXT NOT NULL, actualizado REAL NOT NULL)"
+        )
+        self._conexion.execute(
+            "CREATE TABLE IF NOT EXISTS bloqueos_sesion ("
+            "numero TEXT PRIMARY KEY, dueno TEXT NOT NULL, expira REAL NOT NULL)"
+        )
+        self._conexion.commit()
+
+    def importar_json(self, ruta_json: str) -> int:
+        """Migra un ``estado_usuarios.json`` heredado si la tabla está vacía."""
+        if not os.path.exists(ruta_json):
+            return 0
+        with self._lock:
+            if self._conexion.execute("SELECT 1 FROM sesiones LIMIT 1").fetchone():
+                return 0
+            try:
+                with open(ruta_json, "r") as f:
+                    data = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning(f"No se pudo migrar el estado desde {ruta_json}: {e}")
+                return 0
+            self._escribir(data)
+        try:
+            os.replace(ruta_json, f"{ruta_json}.migrado")
+        except FileNotFoundError:
+            # Otro proceso del mismo despliegue lo migró a la vez; el upsert es idempotente
+            pass
+        logger.info(f"Migradas {len(data)} sesiones desde {ruta_json}")
+        return len(data)
+
+    @contextmanager
+    def bloqueo(self, numero: str):
+        if not self.compartido:
+            yield
+            return
+        self._adquirir(numero)
+        try:
+            yield
+        finally:
+            with self._lock, self._conexion:
+                self._conexion.execute(
+                    "DELETE FROM bloqueos_sesion WHERE numero = ? AND dueno = ?", (numero, self.dueno)
+                )
+
+    def _adquirir(self, numero: str) -> None:
+        """Toma el arriendo de ``numero`` (libre, vencido o ya propio) o espera a que se libere."""
+        limite = time.monotonic() + self.espera_bloqueo
+        pausa = 0.005
+        while True:
+            with self._lock:
+                ahora = time.time()
+                with self._conexion:
+                    cursor = self._conexion.execute(
+                        "INSERT INTO bloqueos_sesion (numero, dueno, expira) VALUES (?, ?, ?) "
+                        "ON CONFLICT(numero) DO UPDATE SET dueno = excluded.dueno, expira = excluded.expira "
+                        "WHERE bloqueos_sesion.expira < ? OR bloqueos_sesion.dueno = excluded.dueno",
+                        (numero, self.dueno, ahora + self.ttl_bloqueo, ahora),
+                    )
+                if cursor.rowcount:
+                    self._descartar_si_obsoleta(numero)
+                    return
+            if time.monotonic() > limite:
+                raise TimeoutError(f"La sesión de {numero} sigue bloqueada por otro proceso")
+            time.sleep(pausa)
+            pausa = min(pausa * 2, 0.2)
+
+    def desalojar(self, es_inactiva: Callable[[Any], bool]) -> int:
+        with self._lock:
+            desalojadas = super().desalojar(es_inactiva)
+            if desalojadas:
+                self._versiones = {n: v for n, v in self._versiones.items() if n in self._sesiones}
+            return desalojadas
+
+    def _descartar_si_obsoleta(self, numero: str) -> None:
+        if numero not in self._sesiones:
+            return
+        fila = self._conexion.execute(
+            "SELECT actualizado FROM sesiones WHERE numero = ?", (numero,)
+        ).fetchone()
+        if fila and fila[0] != self._versiones.get(numero):
+            # Otro proceso la modificó; se recarga en el próximo get
+            del self._sesiones[numero]
+            self._modificadas.discard(numero)
+
+    def _cargar(self, numero: str) -> Optional[Dict]:
+        fila = self._conexion.execute(
+            "SELECT datos, actualizado FROM sesiones WHERE numero = ?", (numero,)
+        ).fetchone()
+        if not fila:
+            return None
+        self._versiones[numero] = fila[1]
+        return json.loads(fila[0])
+
+    def _escribir(self, registros: Dict[str, Dict]) -> None:
+        ahora = time.time()
+        with self._conexion:
+            self._conexion.executemany(
+                "INSERT INTO sesiones (numero, datos, actualizado) VALUES (?, ?, ?) "
+                "ON CONFLICT(numero) DO UPDATE SET datos = excluded.datos, actualizado = excluded.actualizado",
+                [(numero, json.dumps(datos, separators=(",", ":")), ahora) for numero, datos in registros.items()],
+            )
+        self._versiones.update(dict.fromkeys(registros, ahora))
+
+    def cerrar(self) -> None:
+        super().cerrar()
+        with self._lock:
+            self._conexion.close()
@@ -0,0 +1,150 @@
+"""Despliegue en varios procesos: un OHIBot por shard de números de teléfono.
+
+Cada proceso recibe ``SHARD_INDICE``/``SHARD_TOTAL``, su propio perfil de
+navegador (``WHATSAPP_SESION_DIR``: un dispositivo vinculado de la misma
+cuenta) y su propio puerto de métricas. Solo atiende los chats y envía los
+recordatorios de los números de su shard. Todos comparten ``SESSION_DB_PATH``
+(sesiones con bloqueo por número, planificador y bitácora de recordatorios).
+Un proceso que termina se relanza con una espera creciente.
+
+Uso:
+    python supervisor.py [--procesos N] [--perfiles ~/.config/ohibot/shards] [--script main.py]
+
+La primera vez cada perfil necesita escanear su QR (``WHATSAPP_PERFIL=escritorio``).
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+from config import logger, METRICAS_PUERTO, MAX_DISPOSITIVOS_VINCULADOS, DISPOSITIVOS_POR_PROCESO
+
+# Un proceso que aguantó esto se considera estable y su espera de reinicio vuelve a empezar
+SEGUNDOS_ESTABLE = 300
+
+
+def procesos_por_defecto() -> int:
+    """Un proceso por núcleo, sin pasar del límite de dispositivos vinculados.
+
+    Cada proceso ocupa ``DISPOSITIVOS_POR_PROCESO`` dispositivos (su sesión
+    principal más las del pool de ``WHATSAPP_POOL_SIZE``).
+    """
+    return max(1, min(os.cpu_count() or 1, MAX_DISPOSITIVOS_VINCULADOS // DISPOSITIVOS_POR_PROCESO))
+
+
+def entorno_shard(indice: int, total: int, perfiles: str, puerto_metricas: int = METRICAS_PUERTO) -> Dict[str, str]:
+    """Variables de entorno del proceso que atiende el shard ``indice``."""
+    entorno = dict(os.environ)
+    entorno.update({
+        "SHARD_INDICE": str(indice),
+        "SHARD_TOTAL": str(total),
+        "WHATSAPP_SESION_DIR": os.path.join(perfiles, f"shard_{indice}"),
+        "METRICAS_PUERTO": str(puerto_metricas + indice if puerto_metricas else 0),
+    })
+    return entorno
+
+
+class Supervisor:
+    """Lanza un proceso del bot por shard y relanza los que terminan."""
+
+    def __init__(
+        self,
+        procesos: int,
+        script: str = "main.py",
+        perfiles: str = "~/.config/ohibot/shards",
+        espera_maxima: float = 60,
+    ):
+        self.total = procesos
+        self.script = os.path.abspath(script)
+        self.perfiles = os.path.expanduser(perfiles)
+        self.espera_maxima = espera_maxima
+        self._procesos: List[Optional[subprocess.Popen]] = [None] * procesos
+        self._inicios = [0.0] * procesos
+        self._fallos = [0] * procesos
+        self._proximo_arranque = [0.0] * procesos
+        self._detenido = threading.Event()
+
+    def _lanzar(self, indice: int) -> None:
+        proceso = subprocess.Popen(
+            [sys.executable, self.script],
+            env=entorno_shard(indice, self.total, self.perfiles),
+            cwd=os.path.dirname(self.script),
+            # Ctrl+C llega solo al supervisor, que reenvía una única señal en _terminar
+            start_new_session=os.name != "nt",
+        )
+        self._procesos[indice] = proceso
+        self._inicios[indice] = time.monotonic()
+        logger.info(f"Shard {indice}/{self.total} iniciado (pid {proceso.pid})")
+
+    def vigilar(self, intervalo: float = 1.0) -> None:
+        """Mantiene vivos los shards hasta que se llame a ``detener``."""
+        try:
+            while not self._detenido.is_set():
+                ahora = time.monotonic()
+                for indice, proceso in enumerate(self._procesos):
+                    if proceso is None:
+                        if ahora >= self._proximo_arranque[indice]:
+                            self._lanzar(indice)
+                        continue
+                    codigo = proceso.poll()
+                    if codigo is None:
+                        continue
+                    if ahora - self._inicios[indice] > SEGUNDOS_ESTABLE:
+                        self._fallos[indice] = 0
+                    self._fallos[indice] += 1
+                    espera = min(2 ** self._fallos[indice], self.espera_maxima)
+                    logger.error(f"Shard {indice} terminó con código {codigo}; se relanza en {espera:.0f} s")
+                    self._procesos[indice] = None
+                    self._proximo_arranque[indice] = ahora + espera
+                self._detenido.wait(intervalo)
+        finally:
+            self._terminar()
+
+    def detener(self) -> None:
+        self._detenido.set()
+
+    def _terminar(self, timeout: float = 30) -> None:
+        """Pide a cada proceso que se detenga (SIGINT: cierra servicios y guarda sesiones)."""
+        vivos = [p for p in self._procesos if p is not None and p.poll() is None]
+        for proceso in vivos:
+            if os.name == "nt":
+                proceso.terminate()
+            else:
+                proceso.send_signal(signal.SIGINT)
+        for proceso in vivos:
+            try:
+                proceso.wait(timeout)
+            except subprocess.TimeoutExpired:
+                logger.warning(f"El proceso {proceso.pid} no se detuvo a tiempo; se fuerza")
+                proceso.kill()
+        logger.info("Supervisor detenido")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--procesos", type=int, default=procesos_por_defecto(), help="Número de shards")
+    parser.add_argument("--perfiles", default="~/.config/ohibot/shards", help="Directorio de perfiles del navegador")
+    parser.add_argument("--script", default="main.py", help="Punto de entrada de cada shard (main.py o async_bot.py)")
+    args = parser.parse_args(argv)
+    if args.procesos < 1 or args.procesos * DISPOSITIVOS_POR_PROCESO > MAX_DISPOSITIVOS_VINCULADOS:
+        parser.error(
+            f"--procesos {args.procesos} con {DISPOSITIVOS_POR_PROCESO} sesiones por proceso supera "
+            f"los {MAX_DISPOSITIVOS_VINCULADOS} dispositivos vinculados de WhatsApp"
+        )
+
+    supervisor = Supervisor(args.procesos, args.script, args.perfiles)
+    if os.name != "nt":
+        signal.signal(signal.SIGTERM, lambda *_: supervisor.detener())
+    logger.info(f"Supervisor con {args.procesos} shards")
+    try:
+        supervisor.vigilar()
+    except KeyboardInterrupt:
+        logger.info("Deteniendo supervisor...")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,5 @@
 import datetime
+import zlib
 
 def log(mensaje):
     """Guarda logs de actividad."""
@@ -8,3 +9,7 @@ def log(mensaje):
     except Exception as e:
         print(f"Error al escribir en el log: {e}")
 
+
+def shard_de(numero: str, total: int) -> int:
+    """Asigna un número de teléfono a uno de ``total`` shards de forma estable entre procesos."""
+    return zlib.crc32(numero.lstrip("+").encode()) % total if total > 1 else 0
@@ -1,24 +1,156 @@
 import os
 import time
 import logging
-from typing import Optional
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import unquote
 from selenium import webdriver
 from selenium.webdriver.common.by import By
+from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.edge.options import Options
 from selenium.webdriver.edge.service import Service
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from webdriver_manager.microsoft import EdgeChromiumDriverManager
-from selenium.common.exceptions import InvalidSessionIdException, WebDriverException
+from selenium.common.exceptions import InvalidSessionIdException, TimeoutException, WebDriverException
+from metrics import registro
+from utils import shard_de
 
 logger = logging.getLogger(__name__)
 
+# Resultados de WhatsAppDriver.enviar_mensaje (mismos valores que los estados de
+# outbox.py). Tras pulsar "Enviar" el mensaje pudo salir aunque no se viera su
+# burbuja: SIN_CONFIRMAR no se reintenta para no duplicarlo.
+ENTREGADO = "entregado"
+SIN_CONFIRMAR = "sin_confirmar"
+FALLIDO = "fallido"
+
+# Inserta texto en la caja enfocada como si se hubiera pegado (admite emojis)
+SCRIPT_INSERTAR_TEXTO = "arguments[0].focus(); document.execCommand('insertText', false, arguments[1]);"
+
+# Últimos mensajes visibles en el chat abierto, en orden: [data-id, texto]. Los
+# IDs entrantes empiezan por "false_"; los enviados por el propio bot por "true_".
+SCRIPT_MENSAJES_CHAT = """
+const filas = Array.from(document.querySelectorAll('#main div[data-id]')).slice(-arguments[0]);
+const mensajes = [];
+for (const fila of filas) {
+    const id = fila.getAttribute("data-id");
+    if (!id || !(id.startsWith("false_") || id.startsWith("true_"))) continue;
+    const texto = fila.querySelector("span.selectable-text");
+    mensajes.push([id, texto ? texto.innerText : ""]);
+}
+return mensajes;
+"""
+
+# Dirección de WhatsApp Web; se puede apuntar a la imitación local de
+# fake_whatsapp.py para pruebas y benchmarks sin red.
+WHATSAPP_URL = os.getenv("WHATSAPP_URL", "https://web.whatsapp.com").rstrip("/")
+
+# Perfil de arranque del navegador: "escritorio" (ventana visible, permite
+# escanear el QR) o "servidor" (headless, carga eager y sin imágenes, vídeo ni
+# fuentes; requiere un perfil con la sesión ya vinculada).
+PERFIL_NAVEGADOR = os.getenv("WHATSAPP_PERFIL", "escritorio")
+# User agent del perfil "servidor": con el de headless ("HeadlessChrome")
+# WhatsApp Web muestra su página de navegador no compatible.
+USER_AGENT_SERVIDOR = os.getenv(
+    "WHATSAPP_USER_AGENT",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/124.0.0.0 Safari/537.36 Edg/124.0.0.0",
+)
+
+# Perfil del navegador con la sesión vinculada; en despliegues de varios
+# procesos (supervisor.py) cada proceso usa el suyo.
+SESION_DIR = os.getenv("WHATSAPP_SESION_DIR", "~/.config/ohibot/whatsapp_session")
+# Perfiles de WhatsAppDriverPool: junto al perfil del proceso si se eligió uno,
+# para que los shards no abran los mismos directorios.
+POOL_DIR = (
+    os.path.normpath(SESION_DIR) + "_pool" if os.getenv("WHATSAPP_SESION_DIR") else "~/.config/ohibot/whatsapp_pool"
+)
+
+# Recursos que el perfil "servidor" no descarga
+URLS_BLOQUEADAS = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico",
+    "*.mp4", "*.webm", "*.ogg", "*.opus", "*.mp3",
+    "*.woff", "*.woff2", "*.ttf", "*.otf",
+    "*://media*.whatsapp.net/*", "*://pps.whatsapp.net/*",
+]
+
+_ruta_driver: Optional[str] = None
+_lock_ruta_driver = threading.Lock()
+
+
+def obtener_ruta_driver() -> str:
+    """Ruta del msedgedriver, resuelta una sola vez por proceso.
+
+    Se puede fijar con ``EDGE_DRIVER_PATH`` para no consultar a webdriver_manager.
+    """
+    global _ruta_driver
+    with _lock_ruta_driver:
+        if _ruta_driver is None:
+            inicio = time.perf_counter()
+            _ruta_driver = os.getenv("EDGE_DRIVER_PATH") or EdgeChromiumDriverManager().install()
+            logger.info(f"Driver de Edge resuelto en {time.perf_counter() - inicio:.1f} s: {_ruta_driver}")
+        return _ruta_driver
+
+
+def opciones_navegador(session_dir: str, perfil: str = PERFIL_NAVEGADOR) -> Options:
+    """Opciones de Edge para el perfil de arranque indicado."""
+    options = Options()
+    options.add_argument(f"--user-data-dir={session_dir}")
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+    if perfil == "servidor":
+        options.add_argument("--headless=new")
+        options.add_argument(f"--user-agent={USER_AGENT_SERVIDOR}")
+        options.add_argument("--window-size=1280,900")
+        options.add_argument("--blink-settings=imagesEnabled=false")
+        options.add_argument("--mute-audio")
+        options.page_load_strategy = "eager"
+        options.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
+    else:
+        options.add_argument("--start-maximized")
+    return options
+
+
+# Última burbuja saliente del chat abierto: [data-id, icono de estado]. El
+# icono es "msg-time" (pendiente), "msg-check" o "msg-dblcheck" (enviado).
+SCRIPT_ULTIMO_SALIENTE = """
+const filas = document.querySelectorAll('#main div[data-id^="true_"]');
+if (!filas.length) return null;
+const fila = filas[filas.length - 1];
+const tick = fila.querySelector('span[data-icon="msg-time"], span[data-icon="msg-check"], span[data-icon="msg-dblcheck"]');
+return [fila.getAttribute("data-id"), tick ? tick.getAttribute("data-icon") : null];
+"""
+
+XPATH_CAJA_MENSAJE = '//footer//div[@contenteditable="true"]'
+XPATH_BOTON_ENVIAR = '//button[@aria-label="Enviar"]'
+
+
 class WhatsAppDriver:
-    def __init__(self):
+    def __init__(self, session_dir: Optional[str] = None, url_base: str = WHATSAPP_URL):
         self.driver = None
+        self.url_base = url_base.rstrip("/")
         self.max_reintentos = 3
         self.reintento_espera = 5  # segundos
-        self.session_dir = os.path.expanduser("~/.config/ohibot/whatsapp_session")
+        self.session_dir = os.path.expanduser(session_dir or SESION_DIR)
+        self.envio_rapido = os.getenv("WHATSAPP_ENVIO_RAPIDO", "1") == "1"
+        self.chat_abierto: Optional[str] = None
+
+        sesion = os.path.basename(self.session_dir)
+        self.latencias = {
+            modo: registro.histograma("ohibot_envio_segundos", "Duración de cada envío hasta ver la burbuja", modo=modo, sesion=sesion)
+            for modo in ("rapido", "url")
+        }
+        self.arranques = registro.histograma(
+            "ohibot_arranque_navegador_segundos", "Duración de arranques y reconexiones del navegador",
+            buckets=(1, 2, 5, 10, 20, 30, 60, 120), sesion=sesion,
+        )
+        self.envios_fallidos = registro.contador("ohibot_envios_fallidos_total", "Envíos abandonados tras agotar los reintentos", sesion=sesion)
+        self.reintentos = registro.contador("ohibot_envio_reintentos_total", "Reintentos de envío por error o sesión inválida", sesion=sesion)
+        self.reconexiones = registro.contador("ohibot_reconexiones_total", "Arranques del navegador para recuperar la sesión", sesion=sesion)
+        # Envíos cuya burbuja no apareció a tiempo
+        self.sin_confirmar = registro.contador("ohibot_envios_sin_confirmar_total", "Envíos sin burbuja saliente visible a tiempo", sesion=sesion)
         
         # Asegurar que el directorio existe
         os.makedirs(self.session_dir, exist_ok=True)
@@ -28,25 +160,31 @@ class WhatsAppDriver:
         if self.driver and self._verificar_conexion_activa():
             return self.driver
 
+        inicio = time.perf_counter()
+        reconexion = self.arranques.total > 0
         for intento in range(self.max_reintentos):
             try:
-                if self.driver:
-                    self.driver.quit()
-
-                options = Options()
-                options.add_argument("--start-maximized")
-                options.add_argument(f"--user-data-dir={self.session_dir}")
-                options.add_argument("--no-sandbox")
-                options.add_argument("--disable-dev-shm-usage")
+                self._descartar_driver()
 
-                service = Service(EdgeChromiumDriverManager().install())
-                self.driver = webdriver.Edge(service=service, options=options)
-                self.driver.get("https://web.whatsapp.com/")
+                service = Service(obtener_ruta_driver())
+                self.driver = webdriver.Edge(service=service, options=opciones_navegador(self.session_dir))
+                self.chat_abierto = None
+                if PERFIL_NAVEGADOR == "servidor":
+                    self.driver.execute_cdp_cmd("Network.enable", {})
+                    self.driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": URLS_BLOQUEADAS})
+                self.driver.get(f"{self.url_base}/")
 
                 WebDriverWait(self.driver, 30).until(
                     EC.presence_of_element_located((By.XPATH, '//div[@role="grid"]'))
                 )
-                logger.info("Sesión de WhatsApp iniciada correctamente")
+                duracion = time.perf_counter() - inicio
+                self.arranques.observar(duracion)
+                if reconexion:
+                    self.reconexiones.incrementar()
+                logger.info(
+                    f"Sesión de WhatsApp {'reconectada' if reconexion else 'iniciada'} correctamente "
+                    f"en {duracion:.1f} s (perfil {PERFIL_NAVEGADOR}, intento {intento + 1})"
+                )
                 return self.driver
 
             except Exception as e:
@@ -57,6 +195,16 @@ class WhatsAppDriver:
                     logger.critical("No se pudo iniciar el driver después de varios intentos")
                     return None
 
+    def _descartar_driver(self) -> None:
+        """Cierra el navegador actual sin fallar si la sesión ya estaba muerta."""
+        if self.driver is None:
+            return
+        try:
+            self.driver.quit()
+        except WebDriverException:
+            pass
+        self.driver = None
+
     def _verificar_conexion_activa(self) -> bool:
         """Verifica si la sesión del navegador sigue activa."""
         try:
@@ -68,47 +216,261 @@ class WhatsAppDriver:
         except (InvalidSessionIdException, WebDriverException):
             return False
 
-    def enviar_mensaje(self, contacto: str, mensaje: str) -> bool:
-        """Envía mensaje con manejo de reconexión automática."""
+    def enviar_mensaje(self, contacto: str, mensaje: str) -> str:
+        """Envía mensaje con manejo de reconexión automática.
+
+        Primero intenta la ruta rápida (chat ya abierto o búsqueda en la app) y
+        solo navega por URL si no llegó a pulsar "Enviar". Devuelve
+        ``ENTREGADO``, ``SIN_CONFIRMAR`` o ``FALLIDO``.
+        """
         for intento in range(self.max_reintentos):
             try:
                 if not self._verificar_conexion_activa():
                     self.iniciar_driver()
                     if not self.driver:
-                        return False
+                        break
 
-                url = f"https://web.whatsapp.com/send?phone={contacto}&text={mensaje}"
-                self.driver.get(url)
-
-                WebDriverWait(self.driver, 15).until(
-                    EC.presence_of_element_located((By.XPATH, '//div[@contenteditable="true"]'))
-                )
-                time.sleep(2)
-
-                boton_enviar = WebDriverWait(self.driver, 10).until(
-                    EC.element_to_be_clickable((By.XPATH, '//button[@aria-label="Enviar"]'))
-                )
-                boton_enviar.click()
-                logger.info(f"Mensaje enviado a {contacto}")
-                return True
+                inicio = time.perf_counter()
+                modo = "rapido"
+                resultado = self._enviar_en_chat(contacto, mensaje) if self.envio_rapido and intento == 0 else None
+                if resultado is None:
+                    modo = "url"
+                    resultado = self._enviar_por_url(contacto, mensaje)
+                duracion = time.perf_counter() - inicio
+                self.latencias[modo].observar(duracion)
+                if resultado == ENTREGADO:
+                    logger.info(f"Mensaje enviado a {contacto} ({modo}, {duracion * 1000:.0f} ms)")
+                return resultado
 
             except InvalidSessionIdException:
                 logger.warning(f"Sesión inválida, reintentando... (Intento {intento + 1})")
                 self.driver = None
+                self.chat_abierto = None
+                self.reintentos.incrementar()
                 time.sleep(self.reintento_espera)
             except Exception as e:
                 logger.error(f"Error al enviar mensaje: {str(e)}")
+                self.chat_abierto = None
                 if intento < self.max_reintentos - 1:
+                    self.reintentos.incrementar()
                     time.sleep(self.reintento_espera)
                 else:
-                    return False
+                    break
+        self.envios_fallidos.incrementar()
+        return FALLIDO
+
+    def _enviar_por_url(self, contacto: str, mensaje: str) -> str:
+        """Ruta original: recarga WhatsApp Web con el chat y el texto en la URL."""
+        url = f"{self.url_base}/send?phone={contacto}&text={mensaje}"
+        self.driver.get(url)
+
+        # El texto de la URL se carga en la caja cuando el chat está listo
+        WebDriverWait(self.driver, 15).until(
+            lambda d: d.find_element(By.XPATH, XPATH_CAJA_MENSAJE).text.strip()
+        )
+        previo = self._ultimo_saliente()
+        WebDriverWait(self.driver, 10).until(
+            EC.element_to_be_clickable((By.XPATH, XPATH_BOTON_ENVIAR))
+        ).click()
+        self.chat_abierto = contacto
+        return ENTREGADO if self._esperar_confirmacion(contacto, previo) else SIN_CONFIRMAR
+
+    def _enviar_en_chat(self, contacto: str, mensaje: str) -> Optional[str]:
+        """Escribe en la caja de texto del chat sin recargar la página.
+
+        Devuelve ``None`` si no llegó a pulsar "Enviar", para usar la URL.
+        """
+        try:
+            if self.chat_abierto != contacto and not self._abrir_chat_por_busqueda(contacto):
+                return None
+
+            caja = WebDriverWait(self.driver, 5).until(
+                EC.element_to_be_clickable((By.XPATH, XPATH_CAJA_MENSAJE))
+            )
+            caja.click()
+            # Los mensajes llegan codificados para URL (saltos como %0A). El
+            # texto se inserta por JS porque send_keys no admite emojis.
+            for i, linea in enumerate(unquote(mensaje).split("\n")):
+                if i:
+                    caja.send_keys(Keys.SHIFT, Keys.ENTER)
+                if linea:
+                    self.driver.execute_script(SCRIPT_INSERTAR_TEXTO, caja, linea)
+
+            previo = self._ultimo_saliente()
+            WebDriverWait(self.driver, 5).until(
+                EC.element_to_be_clickable((By.XPATH, XPATH_BOTON_ENVIAR))
+            ).click()
+            self.chat_abierto = contacto
+        except InvalidSessionIdException:
+            raise
+        except WebDriverException:
+            logger.warning(f"Ruta rápida no disponible para {contacto}, se usará la URL")
+            self.chat_abierto = None
+            return None
+        # Ya se pulsó "Enviar": a partir de aquí no se recurre a la URL para no duplicar
+        return ENTREGADO if self._esperar_confirmacion(contacto, previo) else SIN_CONFIRMAR
+
+    def _ultimo_saliente(self) -> Optional[str]:
+        ultimo = self.driver.execute_script(SCRIPT_ULTIMO_SALIENTE)
+        return ultimo[0] if ultimo else None
+
+    def _esperar_confirmacion(self, contacto: str, previo: Optional[str], timeout: float = 15) -> bool:
+        """Espera a que aparezca la nueva burbuja saliente con su icono de estado.
+
+        Nunca lanza: se llama después de pulsar "Enviar" y un error aquí no
+        debe llevar a reenviar el mensaje.
+        """
+        def burbuja_nueva(driver):
+            ultimo = driver.execute_script(SCRIPT_ULTIMO_SALIENTE)
+            return bool(ultimo and ultimo[0] != previo and ultimo[1])
+
+        try:
+            WebDriverWait(self.driver, timeout, poll_frequency=0.1).until(burbuja_nueva)
+            return True
+        except TimeoutException:
+            logger.warning(f"No se vio la burbuja del mensaje a {contacto} tras {timeout:.0f} s")
+        except WebDriverException as e:
+            logger.warning(f"No se pudo confirmar el mensaje a {contacto}: {e}")
+            self.chat_abierto = None
+        self.sin_confirmar.incrementar()
         return False
 
+    def _abrir_chat_seguro(self, contacto: str) -> bool:
+        try:
+            return self._abrir_chat_por_busqueda(contacto)
+        except InvalidSessionIdException:
+            raise
+        except WebDriverException:
+            return False
+
+    def _abrir_chat_por_busqueda(self, contacto: str) -> bool:
+        """Cambia de chat con el buscador del panel lateral.
+
+        Al terminar se vacía el buscador: mientras tenga texto la lista de
+        chats queda filtrada y los escaneos de la bandeja no ven los demás.
+        """
+        buscador = WebDriverWait(self.driver, 5).until(
+            EC.element_to_be_clickable((By.XPATH, '//div[@contenteditable="true"][@data-tab="3"]'))
+        )
+        buscador.click()
+        buscador.send_keys(Keys.CONTROL, "a")
+        buscador.send_keys(contacto)
+
+        resultado = WebDriverWait(self.driver, 5).until(
+            EC.element_to_be_clickable((By.XPATH, '//div[@role="grid"]//div[contains(@class, "_ak8q")]//span[@title]'))
+        )
+        if resultado.get_attribute("title").replace(" ", "") != contacto:
+            buscador.send_keys(Keys.ESCAPE)
+            return False
+        resultado.click()
+        buscador.send_keys(Keys.ESCAPE)
+        return True
+
+    def leer_mensajes_entrantes(self, contacto: str, limite: int = 20) -> List[Tuple[str, str]]:
+        """Abre el chat de ``contacto`` y devuelve sus últimos mensajes como (data-id, texto).
+
+        Incluye los salientes (``true_``) para saber qué entrantes ya tienen respuesta.
+        """
+        if self.chat_abierto != contacto and not self._abrir_chat_seguro(contacto):
+            self.driver.get(f"{self.url_base}/send?phone={contacto}")
+            WebDriverWait(self.driver, 15).until(
+                EC.presence_of_element_located((By.XPATH, XPATH_CAJA_MENSAJE))
+            )
+        self.chat_abierto = contacto
+        return self.driver.execute_script(SCRIPT_MENSAJES_CHAT, limite) or []
+
+    def estadisticas_envio(self) -> Dict[str, object]:
+        """Latencia por mensaje (hasta ver la burbuja enviada) de la ruta rápida frente a la URL."""
+        estadisticas: Dict[str, object] = {modo: histograma.resumen() for modo, histograma in self.latencias.items()}
+        estadisticas["sin_confirmar"] = self.sin_confirmar.valor
+        return estadisticas
+
     def cerrar(self):
         """Cierra el driver de manera segura."""
         if self.driver:
             self.driver.quit()
             self.driver = None
 
+
+class WhatsAppDriverPool:
+    """Varias sesiones de WhatsApp Web, cada una con su propio perfil de navegador.
+
+    Cada número de destino se asigna siempre a la misma sesión (shard) para que
+    el paciente reciba los mensajes desde la misma cuenta; si esa sesión no
+    está sana se usa la siguiente disponible. Una sesión solo la usa un hilo a
+    la vez: se toma con ``checkout`` y se devuelve con ``checkin``.
+    """
+
+    def __init__(self, tamano: int, base_dir: Optional[str] = None):
+        base_dir = os.path.expanduser(base_dir or POOL_DIR)
+        self.drivers: List[WhatsAppDriver] = [
+            WhatsAppDriver(os.path.join(base_dir, f"sesion_{i}")) for i in range(tamano)
+        ]
+        self._ocupados: Set[int] = set()
+        self._sanos: Set[int] = set(range(tamano))
+        self._condicion = threading.Condition()
+
+    def __len__(self) -> int:
+        return len(self.drivers)
+
+    def indice_para(self, numero: str) -> int:
+        """Sesión asignada a ``numero``, saltando a la siguiente sana si hace falta."""
+        preferido = shard_de(numero, len(self.drivers))
+        for desplazamiento in range(len(self.drivers)):
+            indice = (preferido + desplazamiento) % len(self.drivers)
+            if indice in self._sanos:
+                return indice
+        return preferido
+
+    def checkout(self, indice: int, timeout: Optional[float] = None) -> Optional[WhatsAppDriver]:
+        """Reserva la sesión ``indice``. Devuelve ``None`` si no se libera a tiempo."""
+        with self._condicion:
+            if not self._condicion.wait_for(lambda: indice not in self._ocupados, timeout):
+                return None
+            self._ocupados.add(indice)
+            return self.drivers[indice]
+
+    def checkin(self, driver: WhatsAppDriver, sano: bool = True) -> None:
+        indice = self.drivers.index(driver)
+        with self._condicion:
+            self._ocupados.discard(indice)
+            if sano:
+                self._sanos.add(indice)
+            else:
+                self._sanos.discard(indice)
+            self._condicion.notify_all()
+
+    @contextmanager
+    def usar(self, indice: int, timeout: Optional[float] = None):
+        driver = self.checkout(indice, timeout)
+        if driver is None:
+            raise TimeoutError(f"La sesión {indice} del pool sigue ocupada")
+        sano = True
+        try:
+            yield driver
+        except (InvalidSessionIdException, WebDriverException):
+            sano = False
+            raise
+        finally:
+            self.checkin(driver, sano and driver._verificar_conexion_activa())
+
+    def verificar_salud(self) -> Dict[int, bool]:
+        """Arranca o comprueba cada sesión libre y actualiza cuáles están sanas."""
+        estado = {}
+        for indice in range(len(self.drivers)):
+            driver = self.checkout(indice, timeout=0)
+            if driver is None:
+                estado[indice] = indice in self._sanos
+                continue
+            sano = driver.iniciar_driver() is not None
+            self.checkin(driver, sano)
+            estado[indice] = sano
+        logger.info(f"Pool de WhatsApp: {sum(estado.values())}/{len(estado)} sesiones sanas")
+        return estado
+
+    def cerrar(self) -> None:
+        for driver in self.drivers:
+            driver.cerrar()
+
 # Instancia global del driver
 whatsapp_driver = WhatsAppDriver()
\ No newline at end of file
@@ -0,0 +1,105 @@
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+from config import logger
+from metrics import registro
+from utils import shard_de
+
+# (numero, mensaje, data-id o None)
+Procesador = Callable[[str, str, Optional[str]], None]
+
+
+class PoolConversaciones:
+    """Reparte los mensajes entrantes entre N hilos según el número del paciente.
+
+    ``shard_de`` asigna cada número siempre al mismo hilo, así que los mensajes
+    de un paciente se procesan en orden estricto y los de pacientes distintos
+    (con sus consultas a Supabase) en paralelo. ``procesar`` debe ser seguro
+    entre hilos para números distintos, como ``OHIBot.procesar_mensaje``.
+    """
+
+    def __init__(self, procesar: Procesador, trabajadores: int = 4, nombre: str = "principal"):
+        self.procesar = procesar
+        self.nombre = nombre
+        self._colas: List["queue.Queue"] = [queue.Queue() for _ in range(trabajadores)]
+        self._hilos: List[threading.Thread] = []
+        self._procesados = [0] * trabajadores
+        self._inicio = time.monotonic()
+        self._ocupado = [
+            registro.contador("ohibot_trabajador_ocupado_segundos_total", "Tiempo procesando mensajes por trabajador",
+                             pool=nombre, trabajador=i)
+            for i in range(trabajadores)
+        ]
+        for i in range(trabajadores):
+            registro.medidor("ohibot_trabajador_profundidad", "Mensajes en cola por trabajador",
+                             funcion=lambda i=i: self._colas[i].qsize(), pool=nombre, trabajador=i)
+            registro.medidor("ohibot_trabajador_utilizacion", "Fracción del tiempo ocupado desde el arranque",
+                             funcion=lambda i=i: self.utilizacion(i), pool=nombre, trabajador=i)
+
+    def __len__(self) -> int:
+        return len(self._colas)
+
+    def iniciar(self) -> None:
+        if self._hilos:
+            return
+        self._inicio = time.monotonic()
+        for i, cola in enumerate(self._colas):
+            hilo = threading.Thread(target=self._bucle, args=(i, cola), name=f"{self.nombre}-{i}", daemon=True)
+            hilo.start()
+            self._hilos.append(hilo)
+
+    def detener(self, timeout: float = 30) -> None:
+        """Termina después de procesar los mensajes ya encolados."""
+        for cola in self._colas:
+            cola.put(None)
+        for hilo in self._hilos:
+            hilo.join(timeout)
+        self._hilos = []
+
+    def enviar(self, numero: str, mensaje: str, id_mensaje: Optional[str] = None) -> int:
+        """Encola el mensaje en el trabajador de ``numero``. Devuelve su índice."""
+        indice = shard_de(numero, len(self._colas))
+        self._colas[indice].put((numero, mensaje, id_mensaje))
+        return indice
+
+    @property
+    def pendientes(self) -> int:
+        """Mensajes encolados o en proceso en todos los trabajadores."""
+        return sum(cola.unfinished_tasks for cola in self._colas)
+
+    def esperar(self) -> None:
+        """Bloquea hasta que todos los mensajes encolados se hayan procesado."""
+        for cola in self._colas:
+            cola.join()
+
+    def utilizacion(self, indice: int) -> float:
+        transcurrido = time.monotonic() - self._inicio
+        return self._ocupado[indice].valor / transcurrido if transcurrido > 0 else 0.0
+
+    def estadisticas(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "trabajador": i,
+                "profundidad": cola.qsize(),
+                "procesados": self._procesados[i],
+                "utilizacion": round(self.utilizacion(i), 3),
+            }
+            for i, cola in enumerate(self._colas)
+        ]
+
+    def _bucle(self, indice: int, cola: "queue.Queue") -> None:
+        while True:
+            tarea = cola.get()
+            try:
+                if tarea is None:
+                    return
+                inicio = time.perf_counter()
+                try:
+                    self.procesar(*tarea)
+                except Exception as e:
+                    logger.error(f"Error procesando mensaje de {tarea[0]}: {e}", exc_info=True)
+                self._ocupado[indice].incrementar(time.perf_counter() - inicio)
+                self._procesados[indice] += 1
+            finally:
+                cola.task_done()